@@ -1,18 +1,504 @@
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.internet.protocol import ServerFactory
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
+from zope.interface import implementer
 from random import getrandbits
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right, insort
+from fnmatch import translate
+import re
+from itertools import islice
+from array import array
+from time import time, localtime, mktime, strftime, strptime
+from hmac import compare_digest
+
+DELIMITER = LineOnlyReceiver.delimiter
+#what to do with a client whose outbound queue is full: forget the oldest lines, forget room chatter (but never private
+#messages or command replies), or hang up on them
+SLOW_POLICIES = ("drop-oldest", "drop-chatter", "disconnect")
+#flood control, with --flood-control: (tokens a second, most tokens saved up) for every line a connection sends, for
+#chat lines and for some commands in particular, and for all the chat in one room
+FLOOD_LIMITS = {"line": (10, 40), "chat": (5, 20), "join": (1, 10), "msg": (2, 10), "rooms": (0.5, 5), "room": (50, 200)}
+
+
+class OrderedSet(OrderedDict):
+   #membership in O(1), iteration in insertion order. Only the keys mean anything.
+   def __init__(self, items=()):
+      OrderedDict.__init__(self)
+      for item in items:
+         self[item] = None
+         
+   def add(self, item):
+      self[item] = None
+      
+   def remove(self, item):
+      del self[item]
+      
+   def discard(self, item):
+      self.pop(item, None)
+      
+   def last(self):
+      return next(reversed(self), None)
+
+
+class RoomList(list):
+   #the same interface as OrderedSet for the handful of rooms one person is in, at a fraction of the memory; used for
+   #User.channels in compact mode
+   __slots__ = ()
+
+   def add(self, item):
+      if item not in self:
+         self.append(item)
+
+   def discard(self, item):
+      if item in self:
+         self.remove(item)
+
+   def last(self):
+      return self[-1] if self else None
+
+
+class TimerWheel(object):
+   #A hashed timer wheel: one LoopingCall, ticking every `tick` seconds, for any number of timeouts. Something waiting
+   #is filed in the slot for the tick it falls due on, and its expire() is called on that tick; timeouts longer than a
+   #turn of the wheel just stay in their slot for another turn. Scheduling and cancelling are a set add and remove.
+   def __init__(self, tick=1.0, slots=512, clock=reactor):
+      self.tick = tick
+      self.slots = [set() for i in xrange(slots)]
+      self.ticks = 0 #how many times it has ticked
+      self.clock = clock
+      self.looping = None
+      
+   def start(self):
+      self.looping = task.LoopingCall.withCount(self.advance)
+      self.looping.clock = self.clock
+      self.looping.start(self.tick, now=False)
+      
+   def stop(self):
+      if self.looping is not None and self.looping.running:
+         self.looping.stop()
+         
+   def schedule(self, item, delay):
+      #item.expire() is called in delay seconds, rounded up to a whole tick
+      self.cancel(item)
+      item.due = self.ticks + max(1, -int(-delay // self.tick))
+      self.slots[item.due % len(self.slots)].add(item)
+      
+   def cancel(self, item):
+      if item.due is not None:
+         self.slots[item.due % len(self.slots)].discard(item)
+         item.due = None
+         
+   def advance(self, count=1):
+      #the reactor can fall behind, in which case this makes up for every tick it missed
+      for i in xrange(count):
+         self.ticks += 1
+         slot = self.slots[self.ticks % len(self.slots)]
+         due = [item for item in slot if item.due == self.ticks]
+         for item in due:
+            slot.discard(item)
+            item.due = None
+         for item in due:
+            item.expire()
+
+
+class TokenBucket(object):
+   #rate tokens a second, with up to most saved up, for admission control; see ChatFactory.refuse and let_in
+   def __init__(self, rate, most, clock=reactor):
+      self.rate = rate
+      self.most = max(1, most)
+      self.clock = clock
+      self.tokens = self.most
+      self.when = clock.seconds()
+      
+   def refill(self):
+      now = self.clock.seconds()
+      self.tokens = min(self.most, self.tokens + (now - self.when) * self.rate)
+      self.when = now
+      
+   def take(self, owe=0):
+      #take a token if there is one, or on credit, up to owe of them
+      self.refill()
+      if self.tokens < 1 - owe:
+         return False
+      self.tokens -= 1
+      return True
+      
+   def wait(self):
+      #seconds until there will be a token
+      self.refill()
+      return max(0, (1 - self.tokens) / self.rate)
+
+
+class Histogram(object):
+   #Counts of non-negative integers in buckets a quarter of an octave wide, which is cheap enough to update on every line
+   #and good to within 25%. 0-3 are counted exactly; above that the key is the bit length and the two bits after the top one.
+   def __init__(self):
+      self.counts = {}
+      self.max = 0
+      
+   def add(self, value):
+      if value > self.max:
+         self.max = value
+      if value > 3:
+         bits = value.bit_length()
+         value = bits << 2 | (value >> (bits - 3)) & 3
+      counts = self.counts
+      counts[value] = counts.get(value, 0) + 1
+      
+   @property
+   def n(self):
+      return sum(self.counts.itervalues())
+      
+   def merge(self, other):
+      for key, count in other.counts.iteritems():
+         self.counts[key] = self.counts.get(key, 0) + count
+      self.max = max(self.max, other.max)
+      return self
+      
+   def percentile(self, p):
+      #the top of the bucket the pth percentile is in
+      wanted, seen = p / 100.0 * self.n, 0
+      for key in sorted(self.counts):
+         seen += self.counts[key]
+         if seen >= wanted:
+            if key <= 3:
+               return key
+            return min(((5 + (key & 3)) << ((key >> 2) - 3)) - 1, self.max)
+      return 0
+      
+   def summary(self, unit=""):
+      return "p50 {0}{3}, p99 {1}{3}, max {2}{3}".format(self.percentile(50), self.percentile(99), self.max, unit)
+
+
+class Stats(object):
+   #what the server has been doing, for /stats and the metrics page. Times are in microseconds.
+   def __init__(self):
+      self.connections = 0
+      self.lines = {} #kind of line (LOGIN, CHAT or a command's name) -> Histogram of the time to handle it
+      self.fanout_size = Histogram()
+      self.fanout_time = Histogram()
+      self.bytes_closed = 0 #written to connections that are gone now
+      self.lag = Histogram() #how late the reactor ran the lag check
+      self.events = None #the factory's chat_events.EventLog, if any, for the rooms to log their writes to
+      
+   def line(self, kind, elapsed):
+      h = self.lines.get(kind)
+      if h is None:
+         h = self.lines[kind] = Histogram()
+      h.add(elapsed)
+      
+   def all_lines(self):
+      return reduce(Histogram.merge, self.lines.itervalues(), Histogram())
+      
+   def bytes_out(self, factory):
+      return self.bytes_closed + sum(con.bytes_out for con in factory.connected)
+         
+   def report(self, factory):
+      lines = ["Connections: {0}, logged in: {1}, rooms: {2}".format(self.connections, len(factory.users), len(factory.channels)),
+               "Lines received: {0} ({1})".format(self.all_lines().n, self.all_lines().summary("us")),
+               "Bytes written: {0}".format(self.bytes_out(factory)),
+               "Room writes: {0}, viewers per write: {1}".format(self.fanout_size.n, self.fanout_size.summary()),
+               "Room write time: {0}".format(self.fanout_time.summary("us")),
+               "Reactor lag: {0}".format(self.lag.summary("us")),
+               "Dropped for slow readers: {0} lines, {1} disconnects".format(factory.dropped, factory.slow_disconnects),
+               "Dropped by flood control: {0} lines".format(factory.flood_dropped),
+               "Timed out: {0} logins, {1} idle".format(factory.login_timeouts, factory.idle_timeouts),
+               "Refused connections: {0} when full, {1} over the limit per IP, {2} over the accept rate".format(
+                  factory.refused["full"], factory.refused["per-ip"], factory.refused["rate"]),
+               "Waiting to log in: {0}".format(factory.staged())]
+      if self.events is not None:
+         lines.append("Event log: {0} written, {1} dropped".format(self.events.written, self.events.dropped))
+      busiest = max(factory.connected, key=lambda con: con.bytes_out) if factory.connected else None
+      if busiest is not None and busiest.me is not None:
+         lines.append("Busiest connection: {0}, {1} bytes".format(busiest.me.name, busiest.bytes_out))
+      for kind in sorted(self.lines):
+         h = self.lines[kind]
+         lines.append("{0}: {1} ({2})".format(kind if kind.isupper() else "/" + kind, h.n, h.summary("us")))
+      return lines
+      
+   def exposition(self, factory):
+      #the Prometheus text format
+      out = ["die_connections {0}".format(self.connections),
+             "die_users {0}".format(len(factory.users)),
+             "die_rooms {0}".format(len(factory.channels)),
+             "die_bytes_written_total {0}".format(self.bytes_out(factory)),
+             "die_dropped_lines_total {0}".format(factory.dropped),
+             "die_slow_disconnects_total {0}".format(factory.slow_disconnects),
+             "die_flood_dropped_lines_total {0}".format(factory.flood_dropped),
+             "die_login_timeouts_total {0}".format(factory.login_timeouts),
+             "die_idle_timeouts_total {0}".format(factory.idle_timeouts),
+             "die_login_queue {0}".format(factory.staged())]
+      for reason in sorted(factory.refused):
+         out.append('die_refused_connections_total{{reason="{0}"}} {1}'.format(reason, factory.refused[reason]))
+      if self.events is not None:
+         out.extend(["die_events_written_total {0}".format(self.events.written),
+                     "die_events_dropped_total {0}".format(self.events.dropped)])
+      def histogram(name, h, labels=""):
+         braced = "{" + labels + "}" if labels else ""
+         out.append("{0}_count{1} {2}".format(name, braced, h.n))
+         for q in (50, 99):
+            out.append('{0}{{{1}quantile="0.{2}"}} {3}'.format(name, labels + "," if labels else "", q, h.percentile(q)))
+         out.append("{0}_max{1} {2}".format(name, braced, h.max))
+      histogram("die_room_write_viewers", self.fanout_size)
+      histogram("die_room_write_microseconds", self.fanout_time)
+      histogram("die_reactor_lag_microseconds", self.lag)
+      for kind in sorted(self.lines):
+         histogram("die_line_microseconds", self.lines[kind], 'kind="{0}"'.format(kind))
+      return "\n".join(out) + "\n"
+
+
+class Scrollback(object):
+   #the last lines said in a room, replayed to whoever joins, and what /history reads when nothing is kept on disk.
+   #last and since answer the same way chat_history.RoomHistory does, with (number, when, line)s through a Deferred.
+   def __init__(self, size):
+      self.lines = deque(maxlen=size)
+      self.next = 0
+      
+   def __len__(self):
+      return len(self.lines)
+      
+   def append(self, when, message):
+      self.lines.append((self.next, when, message))
+      self.next += 1
+      
+   def replay(self):
+      return "".join([line + DELIMITER for seq, when, line in self.lines])
+      
+   def last(self, n, before=None):
+      lines = [l for l in self.lines if before is None or l[0] < before]
+      return defer.succeed(lines[-n:])
+      
+   def since(self, when, n, after=None):
+      if after is not None:
+         lines = [l for l in self.lines if l[0] > after]
+      else:
+         lines = [l for l in self.lines if l[1] >= when]
+      return defer.succeed(lines[:n])
+
+
+def parse_since(text, now=None):
+   #"90s", "10m", "2h" or "1d" ago, "14:30" today or "2014-06-01T14:30", as a time(); None if it's none of those
+   now = time() if now is None else now
+   units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+   if text[-1:] in units and text[:-1].isdigit():
+      return now - int(text[:-1]) * units[text[-1]]
+   for format in ("%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+      try:
+         return mktime(strptime(text, format))
+      except ValueError:
+         pass
+   try:
+      t = strptime(text, "%H:%M")
+   except ValueError:
+      return None
+   today = localtime(now)
+   return mktime((today.tm_year, today.tm_mon, today.tm_mday, t.tm_hour, t.tm_min, 0, 0, 0, -1))
+   
+
+class RoomDirectory(object):
+   #The public rooms, for /rooms: their names in order, and the same names grouped by member count. Rooms report every
+   #join, part and change of privacy through update, so a listing only ever looks at the rooms it shows (and, for a
+   #substring search, their names).
+   def __init__(self):
+      self.names = [] #sorted
+      self.sizes = {} #name -> member count, as last reported
+      self.by_size = {} #member count -> names of the rooms that size
+      self.size_order = [] #the member counts in by_size, ascending
+      self.sorted_sizes = {} #member count -> by_size[count] sorted, kept until that count's rooms change
+      
+   def __len__(self):
+      return len(self.names)
+      
+   def update(self, room):
+      listed = self.sizes.get(room.name)
+      size = len(room.users)
+      if room.private:
+         self.discard(room)
+      elif listed is None:
+         insort(self.names, room.name)
+         self.sizes[room.name] = size
+         self._file(room.name, size)
+      elif listed != size:
+         self.sizes[room.name] = size
+         self._unfile(room.name, listed)
+         self._file(room.name, size)
+         
+   def discard(self, room):
+      listed = self.sizes.pop(room.name, None)
+      if listed is not None:
+         del self.names[bisect_left(self.names, room.name)]
+         self._unfile(room.name, listed)
+         
+   def _file(self, name, size):
+      rooms = self.by_size.get(size)
+      if rooms is None:
+         rooms = self.by_size[size] = set()
+         insort(self.size_order, size)
+      rooms.add(name)
+      self.sorted_sizes.pop(size, None)
+      
+   def _unfile(self, name, size):
+      rooms = self.by_size[size]
+      rooms.remove(name)
+      if not rooms:
+         del self.by_size[size]
+         del self.size_order[bisect_left(self.size_order, size)]
+      self.sorted_sizes.pop(size, None)
+      
+   def _largest(self, skip):
+      #names, biggest rooms first and alphabetical within a size, after passing over the first skip
+      for size in reversed(self.size_order):
+         rooms = self.by_size[size]
+         if skip >= len(rooms):
+            skip -= len(rooms)
+            continue
+         names = self.sorted_sizes.get(size)
+         if names is None:
+            names = self.sorted_sizes[size] = sorted(rooms)
+         for name in islice(names, skip, None):
+            yield name
+         skip = 0
+         
+   def page(self, start, count, search="", prefix=False, by_size=False):
+      #up to count (name, member count)s from the start'th match on, and whether there are more after them
+      if by_size:
+         names = self._largest(0 if search else start)
+         if search:
+            names = islice((n for n in names if (n.startswith(search) if prefix else search in n)), start, None)
+         found = list(islice(names, count + 1))
+      elif prefix:
+         first = bisect_left(self.names, search) + start #the names starting with search are the ones from here on that do
+         found = [n for n in self.names[first:first + count + 1] if n.startswith(search)]
+      elif search:
+         found = list(islice((n for n in self.names if search in n), start, start + count + 1))
+      else:
+         found = self.names[start:start + count + 1]
+      return [(name, self.sizes[name]) for name in found[:count]], len(found) > count
+      
+
+class SortedNames(object):
+   #Strings in order, in chunks of at most 2 * CHUNK: finding the chunk for one is a bisect, and adding or removing it
+   #moves at most that many pointers however many there are, where one sorted list would move all of them.
+   CHUNK = 512
+   
+   def __init__(self):
+      self.chunks = [] #each sorted, none empty
+      self.firsts = [] #the first name in each chunk
+      
+   def add(self, name):
+      if not self.chunks:
+         self.chunks.append([name])
+         self.firsts.append(name)
+         return
+      i = max(0, bisect_right(self.firsts, name) - 1)
+      chunk = self.chunks[i]
+      insort(chunk, name)
+      self.firsts[i] = chunk[0]
+      if len(chunk) > 2 * self.CHUNK:
+         self.chunks.insert(i + 1, chunk[self.CHUNK:])
+         self.firsts.insert(i + 1, chunk[self.CHUNK])
+         del chunk[self.CHUNK:]
+         
+   def remove(self, name):
+      i = bisect_right(self.firsts, name) - 1
+      chunk = self.chunks[i]
+      del chunk[bisect_left(chunk, name)]
+      if chunk:
+         self.firsts[i] = chunk[0]
+      else:
+         del self.chunks[i], self.firsts[i]
+         
+   def since(self, name):
+      #the names from name on, in order
+      i = max(0, bisect_right(self.firsts, name) - 1)
+      for chunk in islice(self.chunks, i, None):
+         for n in (chunk if chunk[0] >= name else islice(chunk, bisect_left(chunk, name), None)):
+            yield n
+
+
+class UserIndex(dict):
+   #ChatFactory.users, name -> User, which also keeps the names case-folded: so that nobody can take a name that
+   #differs from someone else's only in case (see ChatProtocol.handle_LOGIN), so that /msg and the like find people
+   #however their names are typed, and in order, for /who.
+   def __init__(self):
+      dict.__init__(self)
+      self.folded = {} #folded name -> name
+      self.names = SortedNames() #the folded names
+      
+   def __setitem__(self, name, user):
+      key = name.lower()
+      if key == name:
+         key = name #no need for a copy
+      if key not in self.folded:
+         self.folded[key] = name
+         self.names.add(key)
+      dict.__setitem__(self, name, user)
+      
+   def __delitem__(self, name):
+      dict.__delitem__(self, name)
+      key = name.lower()
+      if self.folded.get(key) == name:
+         del self.folded[key]
+         self.names.remove(key)
+         
+   def find(self, name):
+      #the user called name, whatever the case, or None
+      name = self.folded.get(name.lower())
+      return None if name is None else self.get(name)
+      
+   def page(self, start, count, pattern="", room=None):
+      #Up to count names starting with pattern, or matching it if it has * or ? in it, case-insensitively and in
+      #order, from the start'th match on, and whether there are more after them; just the people in room, if given.
+      pattern = pattern.lower()
+      fixed = pattern.split("*", 1)[0].split("?", 1)[0] #all the names that match start with this
+      if pattern in (fixed, fixed + "*"):
+         match = None #everything from fixed on, until the names stop starting with it
+      else:
+         match = re.compile(translate(pattern)).match
+      if room is not None and len(room.users) * 8 < len(self.folded):
+         #fewer to look at this way than by going through everyone
+         names = iter(sorted(k for k in (user.name.lower() for user in room.users) if k.startswith(fixed)))
+      else:
+         names = self.names.since(fixed)
+         if room is not None:
+            names = (k for k in names if self[self.folded[k]] in room.users)
+      found = []
+      for key in names:
+         if not key.startswith(fixed):
+            break
+         if match is None or match(key):
+            if start:
+               start -= 1
+               continue
+            found.append(self.folded[key])
+            if len(found) > count:
+               break
+      return found[:count], len(found) > count
 
 
 class Channel(object):
-   def __init__(self, name, creator, topic=""):
+   buckets = None #for flood control, see ChatProtocol.admit
+   reaping = None #the call that will remove this room now that it's empty, see ChatFactory.vacated
+   absent_ops = None #names of ops restored from a snapshot who haven't logged back in yet, see ChatFactory.op_back
+   
+   def __init__(self, name, creator, topic="", stats=None, scrollback=0, history=None, directory=None):
       self.name = name
+      self.stats = stats
+      self.scrollback = Scrollback(scrollback) if scrollback else None
+      self.log = history.open(name) if history is not None else None #see chat_history
+      self.directory = directory
       self.topic = topic
-      self.users = []
-      self.ops = [creator]
+      self.users = OrderedSet()
+      self.viewers = set() #the members whose current room is this one, kept up to date by User.current
+      self.ops = OrderedSet()
+      if creator is not None: #None when it comes back from a snapshot, see chat_snapshot
+         self.add_op(creator)
       self.private = False
       self.token = ""
+      self.relist()
       
    def join(self, user):
       if user in self.users:
@@ -21,7 +507,8 @@ class Channel(object):
          if self.name not in user.tokens or user.tokens[self.name] != self.token:
             user.write("This room is protected, and you lack the necessary authentication token.")
             return False
-      self.users.append(user)
+      self.users.add(user)
+      self.relist()
       if self.topic != "":
          user.write("Welcome to {0}. Today's topic: ".format(self.name)+self.topic)
       return True
@@ -29,26 +516,112 @@ class Channel(object):
    def part(self, user, message):
       self.write('User {0} has left ("{1}")'.format(user.name, message))
       self.users.remove(user)
+      self.viewers.discard(user)
+      self.relist()
       
    def chat(self, user, message):
       self.write('{0}: {1}'.format(user.name, message))
              
    def write(self, message):
-      for other in self.users:
-         if other.current == self:
-            other.write(message)
+      #frame the line once and hand the same string to every viewer's transport
+      start = time()
+      frame = message + DELIMITER
+      for other in self.viewers:
+         other.con.sendFrame(frame, True)
+      if self.scrollback is not None:
+         self.scrollback.append(start, message)
+      if self.log is not None:
+         self.log.append(start, message) #only queued here; the writing happens in the history thread
+      if self.stats is not None:
+         us = int((time() - start) * 1e6)
+         self.stats.fanout_size.add(len(self.viewers))
+         self.stats.fanout_time.add(us)
+         if self.stats.events is not None:
+            self.stats.events.sampled("fanout", self.name, len(self.viewers), us)
+         
+   def add_op(self, user):
+      self.ops.add(user)
+      if not user.opped:
+         user.opped = set()
+      user.opped.add(self)
+      
+   def remove_op(self, user):
+      self.ops.discard(user)
+      if self in user.opped:
+         user.opped.remove(self)
+      
+   def changed(self):
+      #called whenever the topic, privacy, protection or ops change; see chat_cluster.ClusterChannel
+      self.relist()
+      
+   def relist(self):
+      #tell the directory, after any change to who is here or whether the room is private
+      if self.directory is not None:
+         self.directory.update(self)
+
+
+class CompactChannel(Channel):
+   #Channel without a __dict__, for ChatFactory(compact=True). buckets and reaping still get one if they are ever set.
+   __slots__ = ("name", "stats", "scrollback", "log", "directory", "topic", "users", "viewers", "ops", "private", "token")
 
       
 class User(object):
+   operator = False
+   history_cursor = None #(room, forwards, line number, page size) for /history more
+   #The rooms they are in, the rooms they are an op in (joined or not) and their tokens for protected rooms. Most
+   #people have few or none of these, so the empty tuple stands in for each of them until it's first needed.
+   channels = ()
+   opped = ()
+   tokens = ()
+   room_list = OrderedSet #what channels becomes
+   
    def __init__(self, name, con):
       self.name = name
       self.con = con
-      self.channels = [None]
-      self.current = None
-      self.tokens = {}
+      self._current = None
+   
+   @property
+   def current(self):
+      return self._current
+   
+   @current.setter
+   def current(self, channel):
+      if self._current is not None:
+         self._current.viewers.discard(self)
+      if channel is not None:
+         channel.viewers.add(self)
+      self._current = channel
       
    def write(self, message): #deferred candidate?
       self.con.sendLine(message)
+      
+   def grant(self, channel, token):
+      if not self.tokens:
+         self.tokens = {}
+      self.tokens[channel] = token
+      
+   def entered(self, channel):
+      if not self.channels:
+         self.channels = self.room_list()
+      self.channels.add(channel)
+      
+   def left(self, channel):
+      #returns the room they were in before, if any
+      self.channels.remove(channel)
+      if not self.channels:
+         self.channels = ()
+         return None
+      return self.channels.last()
+
+
+class CompactUser(User):
+   #User without a __dict__, for ChatFactory(compact=True); only operators and people paging through /history get one
+   __slots__ = ("name", "con", "_current", "channels", "opped", "tokens")
+   room_list = RoomList
+
+   def __init__(self, name, con):
+      User.__init__(self, name, con)
+      self.channels = self.opped = self.tokens = ()
    
 class Command(object):
    """This class is used to execute commands, i.e., any line received from the client beginning with "/" will be handled here.
@@ -70,43 +643,82 @@ class Command(object):
       user.write(user.con.commands[cmd][1])
    
    @staticmethod
-   def list_rooms(user):
-      if len(user.con.channels) == 0 or len(user.con.channels) <= user.con.private[0]:
-         user.write("No active rooms.")
-         return
-      user.write("Active rooms are:")
-      for room in user.con.channels:
-         if user.con.channels[room].private == True:
-            continue
-         else:
-            user.write("* {0} ({1})".format(room, len(user.con.channels[room].users)))
-      user.write("end of list.")
+   def list_rooms(user, query=""):
+      #[size] [text or prefix*] [page], in any order: biggest first, names containing text or starting with prefix
+      words = query.split()
+      by_size = "size" in words
+      pages = [w for w in words if w.isdigit()]
+      page = max(1, int(pages[-1])) if pages else 1
+      search = " ".join(w for w in words if w != "size" and not w.isdigit())
+      prefix = search.endswith("*")
+      if prefix:
+         search = search[:-1]
+      if not user.con.directory:
+         return user.write("No active rooms.")
+      count = user.con.factory.rooms_page
+      rooms, more = user.con.directory.page((page - 1) * count, count, search, prefix, by_size)
+      if not rooms:
+         return user.write("No rooms match." if search or page > 1 else "No active rooms.")
+      frames = ["Active rooms are:" + DELIMITER]
+      frames.extend(["* {0} ({1}){2}".format(name, size, DELIMITER) for name, size in rooms])
+      if more:
+         again = [w for w in words if not w.isdigit()] + [str(page + 1)]
+         frames.append("Type /rooms {0} for more.{1}".format(" ".join(again), DELIMITER))
+      frames.append("end of list." + DELIMITER)
+      user.con.sendFrame("".join(frames)) #the whole page in one write
+      
+   @staticmethod
+   def who(user, query=""):
+      #[name or pattern] [in room] [page], in any order: who is online, or in a room, with names starting with name or
+      #matching pattern, with * and ?
+      words = query.split()
+      room = None
+      if "in" in words:
+         i = words.index("in")
+         room = user.con.channels.get(words[i + 1] if i + 1 < len(words) else "")
+         if room is None or (room.private and user not in room.users):
+            return user.write("No such room.")
+         del words[i:i + 2]
+      pages = [w for w in words if w.isdigit()]
+      page = max(1, int(pages[-1])) if pages else 1
+      pattern = " ".join(w for w in words if not w.isdigit())
+      count = user.con.factory.who_page
+      names, more = user.con.users.page((page - 1) * count, count, pattern, room)
+      if not names:
+         return user.write("Nobody matches.")
+      frames = ["Online are:" + DELIMITER if room is None else "In {0} are:{1}".format(room.name, DELIMITER)]
+      frames.extend(["* {0}{1}".format(name, DELIMITER) for name in names])
+      if more:
+         again = ([pattern] if pattern else []) + (["in", room.name] if room is not None else []) + [str(page + 1)]
+         frames.append("Type /who {0} for more.{1}".format(" ".join(again), DELIMITER))
+      frames.append("end of list." + DELIMITER)
+      user.con.sendFrame("".join(frames)) #the whole page in one write
       
    @staticmethod
    def msg(me, you, message):
-      if you not in me.con.users:
+      you = me.con.users.find(you)
+      if you is None:
          me.write("No such person.")
       else:
-         you = me.con.users[you]
          you.write('{0} says, "{1}"'.format(me.name, message))
       
    @staticmethod   
    def disconnect(user, message):
-      room = user.channels.pop()
-      while room is not None:
-         room.part(user, message)
-         room = user.channels.pop()
+      user.con.why = "quit: " + message
+      user.con.logout(message)
       user.write("BYE")
+      user.con.flush()
       user.con.transport.loseConnection()
       
    @staticmethod
    def join(user, channel, topic=""):
       if channel not in user.con.channels: #if channel does not exist on the server
-         user.con.channels[channel] = Channel(channel, user, topic)
+         room = user.con.factory.create_channel(channel, user, topic)
+         user.con.channels[room.name] = room
       user.write("entering room: {0}".format(channel))
       channel = user.con.channels[channel]
       if channel.join(user) == True:
-         user.channels.append(channel)
+         user.entered(channel)
          user.current = channel
          for other in channel.users:
             st = "* "+other.name
@@ -114,24 +726,27 @@ class Command(object):
                st+=" (** this is you)"
             user.write(st)
          user.write("end of list")
+         if channel.scrollback:
+            user.con.sendFrame(channel.scrollback.replay(), True)
       else:
          user.write("Failed to enter {0}".format(channel.name))
          
    @staticmethod
    def part(user, message):
       if user.current is not None:
-         user.current.part(user, message)
-         user.channels.remove(user.current)
-         user.current = user.channels[-1]
+         room = user.current
+         room.part(user, message)
+         user.current = user.left(room)
+         user.con.factory.vacated(room)
       else:
          user.write("You are not in a room.")
       
    @staticmethod
    def switch(user, channel):
-      if channel in user.con.channels:
-         if channel in user.channels:
-            user.current = channel
-            return
+      room = user.con.channels.get(channel)
+      if room is not None and room in user.channels:
+         user.current = room
+         return
       user.con.handle_COMMAND('join {0}'.format(channel))
          
    @staticmethod
@@ -139,6 +754,7 @@ class Command(object):
       if user.current is None: return
       if user in user.current.ops:
          user.current.topic = topic
+         user.current.changed()
          user.write("Topic set.")
          
    @staticmethod
@@ -153,18 +769,16 @@ class Command(object):
          if channel.private == False:
             channel.private = True
             user.write("{0} is now private.".format(channel.name))
-            user.con.private[0] += 1
          else:
             channel.private = False
             user.write("{0} is no longer private.".format(channel.name))
-            user.con.private[0] -= 1
+         channel.changed()
          
    @staticmethod
    def toggleop(user, other, channel=""):
-      if other not in user.con.users:
+      other = user.con.users.find(other)
+      if other is None:
          return user.write("No such person.")
-      else:
-         other = user.con.users[other]
       if user == other: #avoid some weird situations
          return
       if channel=="" and user.current is not None: channel = user.current
@@ -176,20 +790,21 @@ class Command(object):
          except LookupError: return
       if user in channel.ops:
          if other not in channel.ops:
-            channel.ops.append(other)
+            channel.add_op(other)
+            channel.changed()
             user.write("Op status granted for "+other.name)
             other.write("You have been given op status for "+channel.name)
          else:
-            channel.ops.remove(other)
+            channel.remove_op(other)
+            channel.changed()
             user.write("Op status removed from "+other.name)
             other.write("Your op status for {0} has been revoked.".format(channel.name))
          
    @staticmethod
    def invite(user, other, channel=""):
-      if other not in user.con.users:
+      other = user.con.users.find(other)
+      if other is None:
          return user.write("No such person.")
-      else:
-         other = user.con.users[other]
       if channel == "" and user.current is not None: channel = user.current
       elif channel == "" and user.current is None: return
       else:
@@ -198,7 +813,7 @@ class Command(object):
       if channel.private and user not in channel.ops:
          return user.write("You aren't qualified to do that. Ask an op to invite your little friend.")
       other.write("{0} has invited you to join {1}. If you want to accept, type '/join {1}'".format(user.name, channel.name))
-      other.tokens[channel.name]=channel.token
+      other.grant(channel.name, channel.token)
       
    @staticmethod
    def protect(user, channel=""):
@@ -210,7 +825,8 @@ class Command(object):
       if user in channel.ops:
          channel.token=getrandbits(128) #pointless to use real security, since the server doesn't use SSL and all data is in the clear
          for p in channel.ops:
-            p.tokens[channel.name]=channel.token
+            p.grant(channel.name, channel.token)
+         channel.changed()
          user.write("Okay, {0} is now protected.".format(channel.name))
             
    @staticmethod
@@ -222,69 +838,493 @@ class Command(object):
          except LookupError: return
       if user in channel.ops:
          channel.token = ""
+         channel.changed()
          user.write("Removed protection from {0}".format(channel.name))
+         
+   @staticmethod
+   def oper(user, password):
+      expected = user.con.factory.operator_password
+      if expected is not None and compare_digest(password, expected):
+         user.operator = True
+         user.write("You are now an operator.")
+      else:
+         user.write("Wrong password.")
+         
+   @staticmethod
+   def stats(user):
+      if not user.operator:
+         return user.write("You aren't qualified to do that. Operators only.")
+      for line in user.con.factory.stats.report(user.con.factory):
+         user.write(line)
+         
+   @staticmethod
+   def machine(user):
+      user.con.start_machine()
+
+   @staticmethod
+   def pong(user, token=""):
+      pass #the line itself was the point; see ChatProtocol.expire
+      
+   @staticmethod
+   def history(user, what="", when=""):
+      room = user.current
+      if room is None:
+         return user.write("Join a channel first.")
+      source = room.log or room.scrollback
+      if source is None:
+         return user.write("No history is kept for {0}.".format(room.name))
+      page = user.con.factory.history_page
+      if what == "more":
+         if user.history_cursor is None or user.history_cursor[0] is not room:
+            return user.write("No more history.")
+         room, forwards, seq, n = user.history_cursor
+         d = source.since(None, n, after=seq) if forwards else source.last(n, before=seq)
+      elif what == "since":
+         start = parse_since(when)
+         if start is None:
+            return user.write("Since when? Try 10m, 2h, 14:30 or 2014-06-01T14:30.")
+         forwards, n = True, page
+         d = source.since(start, n)
+      elif what == "" or what.isdigit():
+         forwards, n = False, min(int(what or page), page)
+         if n == 0:
+            return
+         d = source.last(n)
+      else:
+         return user.write("Try /history 20, /history since 10m or /history more.")
+      d.addCallback(Command.show_history, user, room, forwards, n)
+      
+   @staticmethod
+   def show_history(lines, user, room, forwards, n):
+      if not lines:
+         user.history_cursor = None
+         return user.write("No more history.")
+      frames = ["[{0}] {1}{2}".format(strftime("%Y-%m-%d %H:%M:%S", localtime(when)), line, DELIMITER) for seq, when, line in lines]
+      if len(lines) == n:
+         user.history_cursor = (room, forwards, lines[-1][0] if forwards else lines[0][0], n)
+         frames.append("Type /history more for more." + DELIMITER)
+      else:
+         user.history_cursor = None
+      user.con.sendFrame("".join(frames)) #however long the page, it goes out in one write
             
 
 
 
+#Every command is registered exactly once, here, rather than in each ChatProtocol. A signature lists the arguments a command
+#takes after its name; 'message', 'topic' and 'query' swallow the rest of the line, anything else takes a single word. Each signature
+#is turned into a parser up front, so dispatching a line is a single split plus a slice.
+COMMANDS = {} #name -> (handler, help text)
+DISPATCH = {} #name -> (handler, argument parser)
+
+def _parser(signature):
+   for i, s in enumerate(signature):
+      if s in ('message', 'topic', 'query'):
+         return lambda args: args[:i] + [" ".join(args[i:])]
+   n = len(signature)
+   return lambda args: args[:n]
+
+def register(name, handler, signature, help):
+   COMMANDS[name] = (handler, help)
+   DISPATCH[name] = (handler, _parser(signature))
+
+register("commands", Command.list_commands, (), "See all documented commands.")
+register("help", Command.help_command, ('cmd',), "Get information on a given command")
+register("msg", Command.msg, ('user', 'message'), "Send a private message.")
+register("part", Command.part, ('message',), "Leave the current room, or a specified room.")
+register("join", Command.join, ('channel', 'topic'), "Join a room, or create a new one if it doesn't already exist.")
+register("quit", Command.disconnect, ('message',), "Leave the server.")
+register("who", Command.who, ('query',), "See who is online, a page at a time: '/who ann' for names starting with 'ann', '/who *bot*' or '/who a?n' for names that match, '/who in lobby' for the people in a room, '/who 2' for the second page.")
+register("rooms", Command.list_rooms, ('query',), "See a list of active rooms, a page at a time: '/rooms 2' for the second page, '/rooms size' for the biggest first, '/rooms chat' for rooms with 'chat' in their name, '/rooms chat*' for those starting with it.")
+register("switch", Command.switch, ('channel',), "Switch to another room. You will remain in both rooms, but only see messages from the current room.")
+register("topic", Command.topic, ('topic',), "Set a new topic for the current room. Note that you must be a channel operator to do this.")
+register("toggleprivate", Command.toggleprivate, ('channel',), "Toggle the private setting on a channel. The current channel is affected by default.")
+register("toggleop", Command.toggleop, ('other', 'channel'), "Toggle operator powers on another user for a given channel. Default is the current channel.")
+register("invite", Command.invite, ('other', 'channel'), "Invite a user to a channel. Defaults to the current channel. If the channel is private, you must be an op.")
+register("protect", Command.protect, ('channel',), "Protect a channel with a (pseudo)random token. Any user without the token will not be able to join.")
+register("unprotect", Command.unprotect, ('channel',), "Clear the protection on a channel. Default this channel.")
+register("oper", Command.oper, ('password',), "Become a server operator, given the operator password.")
+register("stats", Command.stats, (), "See what the server has been up to. Operators only.")
+register("pong", Command.pong, ('token',), "Answer the server's PING. Anything else you send answers it too.")
+register("machine", Command.machine, (), "Switch to machine mode, for bots: JSON requests and replies. See chat_machine.py.")
+register("history", Command.history, ('what', 'when'), "See what was said in this room: '/history 20' for the last 20 lines, '/history since 10m' (or 14:30, or 2014-06-01T14:30), then '/history more' for the next page.")
+
+
+@implementer(IPushProducer)
 class ChatProtocol(LineOnlyReceiver):
+   commands = COMMANDS
+   #Outbound backpressure. The protocol registers itself as the transport's producer, so the transport pauses it once
+   #its own buffer is full; from then on lines wait in the backlog, within the factory's limits, until it resumes.
+   #These stay class attributes until a client actually falls behind, so keeping up costs nothing per connection.
+   paused = False
+   bytes_out = 0
+   backlog = None
+   backlog_bytes = 0
+   dropped = 0
+   slow = False
+   #With the factory's coalesce on, lines for a connection are held here until the end of the reactor turn (or
+   #coalesce_delay) and then handed to the transport in one writeSequence, in the order they were sent. See also
+   #dataReceived.
+   pending = None
+   pending_bytes = 0
+   #Flood control: token buckets, made on first use, and the lines waiting for them
+   buckets = None
+   waiting = None
+   catching_up = None
+   warned = False
+   #Timeouts, on the factory's TimerWheel: the tick this connection is due to be looked at, the tick it last sent a
+   #line on, and the tick it was sent a PING on, if it has been
+   due = None
+   seen = 0
+   pinged = None
+   #a chat_machine.MachineMode, once they have asked for machine mode
+   machine = None
+   why = None #why the server (or /quit) ended the connection, for the event log
+   host = None #where they connected from, with a limit on connections per IP
    
-   def __init__(self, users, channels, private):
+   def __init__(self, users, channels, directory):
       self.users = users
       self.channels = channels
-      self.private = private
+      self.directory = directory
       self.state = "LOGIN"
       self.me = None
-      #it seems really silly to have to put this here, but Python does not allow you to refer to a class within its own definition,
-      #ergo this is the next best thing. I've gotta get back into Ruby...
-      self.commands = {"commands": (Command.list_commands, "See all documented commands."),
-                       "help": (Command.help_command, "Get information on a given command"),
-                       "msg" : (Command.msg, "Send a private message."),
-                       "part" : (Command.part, "Leave the current room, or a specified room."),
-                       "join" : (Command.join, "Join a room, or create a new one if it doesn't already exist."),
-                       "quit" : (Command.disconnect, "Leave the server."),
-                       "rooms" : (Command.list_rooms, "See a list of active rooms"),
-                       "switch" : (Command.switch, "Switch to another room. You will remain in both rooms, but only see messages from the current room."),
-                       "topic" : (Command.topic, "Set a new topic for the current room. Note that you must be a channel operator to do this."),
-                       "toggleprivate" : (Command.toggleprivate, "Toggle the private setting on a channel. The current channel is affected by default."),
-                       "toggleop" : (Command.toggleop, "Toggle operator powers on another user for a given channel. Default is the current channel."),
-                       "invite" : (Command.invite, "Invite a user to a channel. Defaults to the current channel. If the channel is private, you must be an op."),
-                       "protect" : (Command.protect, "Protect a channel with a (pseudo)random token. Any user without the token will not be able to join."),
-                       "unprotect" : (Command.unprotect, "Clear the protection on a channel. Default this channel.")
-                       }
-      self.signatures = {"commands" : (), "help" : ('cmd',), "msg" : ('user', 'message'), "part" : ('message',),
-                         "join" : ('channel', 'topic'), "quit" : ('message',), "rooms": (), "switch": ('channel',), "topic": ('topic',),
-                         "toggleprivate": ('channel',), "toggleop": ('other', 'channel'), "invite": ('other', 'channel'), "protect": ('channel',),
-                         "unprotect": ('channel',)}
+      
+   def sendLine(self, line):
+      self.sendFrame(line + DELIMITER)
+      
+   def sendFrame(self, data, chatter=False): #data already ends with the delimiter, e.g. a frame shared by a whole channel
+      if self.machine is not None:
+         data = self.machine.encode(data, chatter)
+         if data is None: #it's part of a reply
+            return
+      self.bytes_out += len(data)
+      if self.paused:
+         self.enqueue(data, chatter)
+      elif self.factory.coalesce:
+         self.hold(data)
+      else:
+         self.transport.write(data)
+         
+   def hold(self, data):
+      if self.pending is None:
+         self.pending = [data]
+         self.factory.flush_soon(self)
+      else:
+         self.pending.append(data)
+      self.pending_bytes += len(data)
+      if self.pending_bytes >= self.factory.coalesce_bytes:
+         self.flush()
+         
+   def flush(self):
+      pending = self.pending
+      if pending:
+         self.pending, self.pending_bytes = None, 0
+         self.transport.writeSequence(pending)
+         
+   def enqueue(self, data, chatter):
+      if self.slow:
+         return
+      if self.backlog is None:
+         self.backlog = deque()
+      size = len(data)
+      if not self.fits(size):
+         policy = self.factory.slow_policy
+         if policy == "disconnect":
+            return self.drop_slow_consumer()
+         self.evict(size, policy == "drop-chatter")
+         if not self.fits(size):
+            if chatter or policy == "drop-oldest":
+               return self.count_drops(1)
+            return self.drop_slow_consumer() #it's full of lines we promised not to drop
+      self.backlog.append((data, chatter))
+      self.backlog_bytes += size
+      
+   def fits(self, size):
+      return self.backlog_bytes + size <= self.factory.queue_bytes and len(self.backlog) < self.factory.queue_messages
+      
+   def evict(self, size, chatter_only):
+      backlog = self.backlog
+      if not chatter_only:
+         dropped = 0
+         while backlog and not self.fits(size):
+            self.backlog_bytes -= len(backlog.popleft()[0])
+            dropped += 1
+         return self.count_drops(dropped)
+      #chatter can be anywhere in the queue, so make one pass and keep everything that isn't the oldest chatter
+      limit, most = self.factory.queue_bytes - size, self.factory.queue_messages - 1
+      total, count, dropped = self.backlog_bytes, len(backlog), 0
+      kept = deque()
+      for data, chatter in backlog:
+         if chatter and (total > limit or count > most):
+            total -= len(data)
+            count -= 1
+            dropped += 1
+         else:
+            kept.append((data, chatter))
+      self.backlog, self.backlog_bytes = kept, total
+      self.count_drops(dropped)
+      
+   def count_drops(self, n):
+      self.dropped += n
+      self.factory.dropped += n
+      
+   def drop_slow_consumer(self):
+      self.count_drops(len(self.backlog) + 1)
+      self.factory.slow_disconnects += 1
+      self.slow = True
+      self.why = "too slow to read"
+      self.backlog, self.backlog_bytes = None, 0
+      self.transport.abortConnection()
+      
+   def pauseProducing(self):
+      self.paused = True
+      self.flush() #whatever is held back was sent before the pause, so it goes ahead of the backlog
+      
+   def resumeProducing(self):
+      self.paused = False
+      backlog = self.backlog
+      while backlog and not self.paused: #writing can pause us again
+         data = backlog.popleft()[0]
+         self.backlog_bytes -= len(data)
+         self.transport.write(data)
+         
+   def stopProducing(self):
+      self.backlog, self.backlog_bytes = None, 0
       
    def connectionMade(self):
+      self.attached()
       self.sendLine("Welcome to DIE: Denizens of the Internet Effusing")
       self.sendLine("Login name?")
+
+   def attached(self):
+      #everything connectionMade does but the greeting, which a connection handed over from another process already had
+      self.factory.stats.connections += 1
+      self.factory.connected.add(self)
+      self.transport.registerProducer(self, True)
+      if self.factory.recorder is not None:
+         self.factory.recorder.opened(self)
+      self.seen = self.factory.wheel.ticks
+      if self.me is None and self.factory.login_timeout:
+         self.factory.wheel.schedule(self, self.factory.login_timeout)
+      elif self.me is not None and self.factory.idle_timeout:
+         self.factory.wheel.schedule(self, self.factory.idle_timeout)
       
    def connectionLost(self, reason):
-      if self.me.name in self.users:
-         del self.users[self.me.name]
+      self.factory.stats.connections -= 1
+      self.factory.stats.bytes_closed += self.bytes_out
+      self.factory.connected.discard(self)
+      if self.host is not None:
+         self.factory.left(self.host)
+      if self.factory.recorder is not None:
+         self.factory.recorder.closed(self)
+      self.pending = None
+      if self.catching_up is not None and self.catching_up.active():
+         self.catching_up.cancel()
+      self.waiting = None
+      self.factory.wheel.cancel(self)
+      if self.me is not None:
+         self.me.current = None #no point telling them they left
+      if self.factory.events is not None:
+         self.factory.events.add("disconnect", id(self), self.me.name if self.me is not None else None,
+                                 self.why or reason.value)
+      self.logout("Connection lost")
+      
+   def logout(self, message):
+      #Let go of the user everywhere: their rooms, the ops lists they're on and the name. For /quit and for connections
+      #that just go away, so it's fine to call twice.
+      me = self.me
+      if me is None or self.users.get(me.name) is not me:
+         return
+      left = list(reversed(me.channels)) #most recently joined first
+      for room in left:
+         room.part(me, message)
+      me.channels = ()
+      me.current = None
+      for room in list(me.opped):
+         room.remove_op(me)
+      del self.users[me.name]
+      for room in left:
+         self.factory.vacated(room)
+         
+   def dataReceived(self, data):
+      if self.factory.recorder is not None:
+         self.factory.recorder.received(self, data)
+      LineOnlyReceiver.dataReceived(self, data)
+      #Everything these lines produced goes to the transports now, while the reactor is still handling reads, so the
+      #transports' own buffering can merge it with whatever the other reads this turn produce before they next send.
+      #Lines written at any other time wait for flush_due.
+      if self.factory.unflushed and not self.factory.coalesce_delay:
+         self.factory.flush_all()
          
    def lineReceived(self, line):
+      self.seen = self.factory.wheel.ticks #just a reference to an int that's already there
+      if self.waiting is not None:
+         return self.wait(line)
       if self.state == "LOGIN":
+         if self.factory.login_bucket is not None and not self.factory.login_slot():
+            return self.stage(line)
+      elif self.factory.limits:
+         delay = self.admit(line)
+         if delay:
+            return self.wait(line, delay)
+      self.process(line)
+      
+   def admit(self, line):
+      #Take a token from each bucket this line counts against and return 0; or, if any is short, take none and return
+      #how long until they will all have one. A connection's buckets are (tokens, when they were counted) pairs in one
+      #array, at the factory's slots, and refill as they are used.
+      factory = self.factory
+      limits, slots, now = factory.limits, factory.slots, factory.clock.seconds()
+      if self.machine is not None:
+         kind = self.machine.kind(line)
+      else:
+         kind = "chat" if line[:1] != "/" else line[1:].split(" ", 1)[0]
+      if self.buckets is None:
+         self.buckets = array("d", factory.full_buckets)
+      wanted = [(self.buckets, slots["line"], limits["line"])] if "line" in slots else []
+      if kind in slots and kind != "line":
+         wanted.append((self.buckets, slots[kind], limits[kind]))
+      room = self.me.current
+      if kind == "chat" and "room" in limits and room is not None:
+         if room.buckets is None:
+            room.buckets = array("d", (limits["room"][1], 0))
+         wanted.append((room.buckets, 0, limits["room"]))
+      delay = 0
+      for buckets, i, (rate, most) in wanted:
+         buckets[i] = min(most, buckets[i] + (now - buckets[i + 1]) * rate)
+         buckets[i + 1] = now
+         if buckets[i] < 1:
+            delay = max(delay, (1 - buckets[i]) / rate)
+      if not delay:
+         for buckets, i, limit in wanted:
+            buckets[i] -= 1
+      return delay
+      
+   def wait(self, line, delay=0):
+      if self.waiting is None:
+         self.waiting = deque()
+         self.transport.pauseProducing() #stop reading from them until they catch up, so TCP pushes back on the client
+         self.catching_up = self.factory.clock.callLater(delay, self.catch_up)
+      if len(self.waiting) < self.factory.flood_queue:
+         self.waiting.append(line)
+      else:
+         self.factory.flood_dropped += 1
+         if self.machine is not None:
+            return self.machine.refuse(line, "dropped: sending too fast")
+         if not self.warned:
+            self.warned = True
+            self.sendLine("You are sending too fast, so some of what you sent was dropped.")
+            
+   def stage(self, line):
+      #hold their login, and whatever they send after it, until the factory has a slot for it; see ChatFactory.let_in
+      self.waiting = deque([line])
+      self.transport.pauseProducing()
+      self.factory.queue_login(self)
+            
+   def catch_up(self, login=False):
+      #carry on with the lines held back: login is True when the factory has just given them a login slot
+      self.catching_up = None
+      while self.waiting:
+         if self.state == "LOGIN" and self.factory.login_bucket is not None:
+            if not login: #their last try didn't log them in, so this one waits its turn too
+               return self.factory.queue_login(self)
+            login = False
+         elif self.factory.limits:
+            delay = self.admit(self.waiting[0])
+            if delay:
+               self.catching_up = self.factory.clock.callLater(delay, self.catch_up)
+               return
+         self.process(self.waiting.popleft())
+         if self.state not in ("LOGIN", "NEW TEXACO"): #a subclass is holding lines back itself, e.g. chat_cluster's
+            break                                     #CLAIMING, so the rest go to it as if they'd just come in
+      held, self.waiting = self.waiting, None
+      self.warned = False
+      self.transport.resumeProducing()
+      for line in held or ():
+         self.lineReceived(line)
+      
+   def process(self, line):
+      start = time()
+      if self.machine is not None:
+         kind = self.machine.handle(line)
+      elif self.state == "LOGIN":
+         kind = "LOGIN"
          self.handle_LOGIN(line)
       else:
          if line[0] == '/':
-            self.handle_COMMAND(line[1:])
+            kind = self.handle_COMMAND(line[1:]) or "INVALID"
          else:
+            kind = "CHAT"
             self.handle_CHAT(line)
+      us = int((time() - start) * 1e6)
+      self.factory.stats.line(kind, us)
+      events = self.factory.events
+      if events is not None and self.me is not None:
+         if kind == "CHAT":
+            events.sampled("chat", self.me.name, self.me.current.name if self.me.current is not None else None, us)
+         else:
+            events.add("command", self.me.name, kind, us)
             
    def handle_LOGIN(self, name):
-      if name in self.users:
+      if name == "/machine" and self.machine is None:
+         return self.start_machine()
+      if self.users.find(name) is not None: #Ann and ann would be too easy to mix up
          self.sendLine("Sorry, name taken.")
          return
       if not name.isalnum():
          self.sendLine("Please use alphanumeric characters only.")
       else:
-         self.sendLine("Welcome {0}!".format(name))
-         self.me = User(name, self)
-         self.users[name] = self.me
-         self.state = "NEW TEXACO"
+         self.login(name)
+         
+   def login(self, name):
+      self.sendLine("Welcome {0}!".format(name))
+      if self.factory.compact:
+         name = intern(name)
+      self.me = self.factory.user(name, self)
+      self.users[name] = self.me
+      self.state = "NEW TEXACO"
+      if name in self.factory.absent_ops:
+         self.factory.op_back(self.me)
+      if self.factory.events is not None:
+         self.factory.events.add("login", id(self), name)
+      if self.factory.idle_timeout:
+         self.factory.wheel.schedule(self, self.factory.idle_timeout)
+      else:
+         self.factory.wheel.cancel(self)
+         
+   def start_machine(self):
+      import chat_machine
+      if self.machine is None:
+         self.machine = chat_machine.MachineMode(self)
+      self.sendFrame(chat_machine.dumps({"event": "machine", "version": chat_machine.VERSION}), None)
+
+   def expire(self):
+      #the TimerWheel's call, when this connection's login or idle timeout (or the wait for an answer to a PING) is up
+      factory, wheel = self.factory, self.factory.wheel
+      if self.me is None:
+         if self.waiting is not None: #waiting for a login slot, which isn't their fault
+            return wheel.schedule(self, factory.login_timeout)
+         factory.login_timeouts += 1
+         return self.time_out("You took too long to log in.")
+      quiet = (wheel.ticks - self.seen) * wheel.tick
+      if self.pinged is not None:
+         if self.seen < self.pinged:
+            factory.idle_timeouts += 1
+            return self.time_out("No answer to PING.")
+         self.pinged = None
+      elif quiet >= factory.idle_timeout and factory.ping_timeout:
+         self.pinged = wheel.ticks
+         self.sendLine("PING (type /pong, or anything at all, to stay connected)")
+         return wheel.schedule(self, factory.ping_timeout)
+      elif quiet >= factory.idle_timeout:
+         factory.idle_timeouts += 1
+         return self.time_out("You have been idle too long.")
+      wheel.schedule(self, factory.idle_timeout - quiet)
+      
+   def time_out(self, message):
+      self.why = message
+      self.sendLine(message)
+      self.flush()
+      self.transport.loseConnection()
          
    def handle_CHAT(self,message):
       room = self.me.current
@@ -293,45 +1333,434 @@ class ChatProtocol(LineOnlyReceiver):
       else:
          room.chat(self.me, message)
          
-   def handle_COMMAND(self, cmd):
-      cmd = cmd.split()
-      if len(cmd) > 1:
-         cmd, args = cmd[0], cmd[1:]
-      else:
-         cmd, args = cmd[0], [""]
-      if cmd not in self.commands:
+   def handle_COMMAND(self, line):
+      args = line.split()
+      try:
+         cmd, parse = DISPATCH[args[0]]
+      except LookupError:
          self.sendLine('Invalid command. To see a list of commands, type "/commands". For command-specific help, type "/help <command>"')
       else:
-         sig = self.signatures[cmd]
-         cmd = self.commands[cmd][0]
-         _ = []
-         if sig == ():
-            cmd(self.me)
-         else:
-            for s in sig:
-               if s in ('message', 'topic'):
-                  _.append(" ".join(args))
-                  break
-               else:
-                  try:
-                     _.append(args.pop(0))
-                  except LookupError:
-                     pass
-            cmd(self.me, *_)
+         cmd(self.me, *parse(args[1:] or [""]))
+         return args[0] #for the stats
+
+
+class CompactChatProtocol(ChatProtocol, object):
+   #ChatProtocol for ChatFactory(compact=True). What every connection has goes in slots instead of a __dict__, so an
+   #idle connection has none; the lazy attributes above still get one once they are set, i.e. once the connection
+   #falls behind, floods or coalesces. The slots that shadow class attributes have to be set here. (twisted's
+   #protocols are old-style classes, whose instances always have a __dict__; object makes this one new-style.)
+   __slots__ = ("users", "channels", "directory", "state", "me", "factory", "transport", "connected", "_buffer",
+                "bytes_out", "seen", "due")
+
+   def __init__(self, users, channels, directory):
+      self.transport, self.connected, self._buffer = None, 0, b""
+      self.bytes_out, self.seen, self.due = 0, 0, None
+      ChatProtocol.__init__(self, users, channels, directory)
+
             
 class ChatFactory(ServerFactory):
-   def __init__(self):
+   def __init__(self, queue_bytes=1 << 20, queue_messages=2000, slow_policy="drop-oldest", operator_password=None,
+                lag_interval=0.1, clock=reactor, scrollback=20, history=None, history_page=50,
+                rooms_page=50, who_page=50, coalesce=False, coalesce_delay=0, coalesce_bytes=64 << 10, limits=None,
+                flood_queue=100, reap_grace=300, login_timeout=60, idle_timeout=0, ping_timeout=0, compact=False,
+                events=None, recorder=None, max_connections=0, max_per_ip=0, accept_rate=0, accept_burst=0,
+                login_rate=0, login_burst=0):
+      if slow_policy not in SLOW_POLICIES:
+         raise ValueError("slow_policy must be one of " + ", ".join(SLOW_POLICIES))
       self.channels = {}
-      self.users = {}
-      self.private = [0] #making self.private a list ensures that it will be passed by reference, rather than copied.
+      self.users = UserIndex()
+      self.directory = RoomDirectory() #the public rooms, for /rooms
+      #limits on what is held back for each client that stops reading, and what happens when they're reached
+      self.queue_bytes = queue_bytes
+      self.queue_messages = queue_messages
+      self.slow_policy = slow_policy
+      self.dropped = 0
+      self.slow_disconnects = 0
+      self.operator_password = operator_password #/oper with this makes you an operator, who can see /stats
+      self.stats = Stats()
+      self.connected = set() #every ChatProtocol, logged in or not
+      self.clock = clock
+      self.lag_interval = lag_interval
+      self.lag_check = None
+      self.scrollback = scrollback #lines each room keeps in memory to replay on /join
+      self.history = history #a chat_history.History, if rooms are logged to disk
+      self.history_page = history_page #most lines /history sends at once
+      self.rooms_page = rooms_page #most rooms /rooms lists at once
+      self.who_page = who_page #most names /who lists at once
+      #write coalescing: hold each connection's lines for up to coalesce_delay seconds (0 is the end of this reactor
+      #turn) or coalesce_bytes, whichever comes first; see ChatProtocol.hold
+      self.coalesce = coalesce
+      self.coalesce_delay = coalesce_delay
+      self.coalesce_bytes = coalesce_bytes
+      self.unflushed = set()
+      self.flushing = None
+      self.limits = limits #flood control, e.g. FLOOD_LIMITS; None for none
+      if limits:
+         kinds = sorted(kind for kind in limits if kind != "room") #room buckets belong to the rooms
+         self.slots = dict((kind, 2 * i) for i, kind in enumerate(kinds)) #where each kind's bucket is in a connection's
+         self.full_buckets = array("d", [n for kind in kinds for n in (limits[kind][1], 0)])
+      self.flood_queue = flood_queue #most lines held back for a connection that's over its limits, after which they're dropped
+      self.flood_dropped = 0
+      self.reap_grace = reap_grace #how long a protected room outlives its last member; others go straight away
+      self.absent_ops = {} #name -> the rooms they were an op in when a snapshot was restored without them
+      #Seconds to log in in, to stay quiet for after that, and to answer the PING sent when they have been quiet that
+      #long (without pings, being quiet that long is enough to be disconnected). 0 turns each of them off.
+      self.login_timeout = login_timeout
+      self.idle_timeout = idle_timeout
+      self.ping_timeout = ping_timeout
+      self.login_timeouts = 0
+      self.idle_timeouts = 0
+      self.wheel = TimerWheel(clock=clock)
+      self.events = self.stats.events = events #a chat_events.EventLog, if what happens is logged
+      self.recorder = recorder #a chat_trace.Recorder, if what clients send is recorded
+      self.snapshots = None #a chat_snapshot.Snapshots, once started, which writes the last one in stopFactory
+      #Admission control, for reconnect storms: most connections in all and from one IP, new connections and logins a
+      #second (with bursts of up to the _bursts, by default a second's worth). 0 turns each of them off. Once new
+      #connections are over their rate, the port stops accepting until the rate allows another, which leaves the rest
+      #waiting in the listen backlog; the ones it has already accepted by then come in on credit, up to another
+      #burst's worth, and only past that are they refused. Logins over their rate queue up, see let_in.
+      self.max_connections = max_connections
+      self.max_per_ip = max_per_ip
+      self.per_ip = {} #host -> how many connections from it, with max_per_ip
+      self.accept_bucket = TokenBucket(accept_rate, accept_burst or accept_rate, clock) if accept_rate else None
+      self.login_bucket = TokenBucket(login_rate, login_burst or login_rate, clock) if login_rate else None
+      self.login_queue = deque() #connections waiting for a login slot, oldest first
+      self.staging = None #the call that lets the next of them in
+      self.refused = {"full": 0, "per-ip": 0, "rate": 0}
+      self.port = None #what's listening for them, set by main; see pause_accepting
+      self.resuming = None
+      self.handing_over = False #while chat_snapshot hands the port over to a new process, when it stays stopped
+      #compact: connections, users and rooms without a __dict__ each, and names interned. Saves memory on lots of idle
+      #connections; see CompactChatProtocol.
+      self.compact = compact
+      if compact:
+         self.protocol, self.user, self.channel = self.compact_classes
+      
+   def startFactory(self):
+      #measure how late the reactor gets around to a call scheduled every lag_interval
+      self.lag_check = task.LoopingCall(self.check_lag)
+      self.lag_check.clock = self.clock
+      self.last_check = self.clock.seconds()
+      self.lag_check.start(self.lag_interval, now=False)
+      self.wheel.start()
+      
+   def stopFactory(self):
+      if self.lag_check is not None and self.lag_check.running:
+         self.lag_check.stop()
+      self.wheel.stop()
+      if self.history is not None:
+         self.history.close()
+      if self.recorder is not None:
+         self.recorder.close()
+      if self.snapshots is not None:
+         self.snapshots.last()
+      self.stop_admitting()
+      if self.flushing is not None:
+         self.flushing.cancel()
+         self.flush_all()
+         
+   def vacated(self, room):
+      #called when someone leaves a room, which goes away if that was the last of them
+      if room.users:
+         return
+      if room.token != "" and self.reap_grace:
+         if room.reaping is None:
+            room.reaping = self.clock.callLater(self.reap_grace, self.reap, room)
+         else:
+            room.reaping.reset(self.reap_grace)
+      else:
+         self.reap(room)
+         
+   def reap(self, room):
+      if room.reaping is not None and room.reaping.active():
+         room.reaping.cancel()
+      room.reaping = None
+      if room.users or self.channels.get(room.name) is not room: #someone came back in time
+         return
+      del self.channels[room.name]
+      self.directory.discard(room)
+      for op in list(room.ops):
+         room.remove_op(op)
+      for name in room.absent_ops or ():
+         rooms = self.absent_ops[name]
+         rooms.discard(room)
+         if not rooms:
+            del self.absent_ops[name]
+      if room.log is not None:
+         room.log.close()
+         
+   def op_back(self, user):
+      #someone who was an op when the snapshot was taken has logged back in, so they are again
+      for room in self.absent_ops.pop(user.name):
+         room.absent_ops.discard(user.name)
+         room.add_op(user)
+         
+   def flush_soon(self, protocol):
+      self.unflushed.add(protocol)
+      if self.flushing is None:
+         self.flushing = self.clock.callLater(self.coalesce_delay, self.flush_due)
+         
+   def flush_due(self):
+      self.flushing = None
+      self.flush_all()
+      
+   def flush_all(self):
+      unflushed, self.unflushed = self.unflushed, set()
+      for protocol in unflushed:
+         protocol.flush()
+         
+   def check_lag(self):
+      now = self.clock.seconds()
+      self.stats.lag.add(max(0, int((now - self.last_check - self.lag_interval) * 1e6)))
+      self.last_check = now
       
+   protocol, user, channel = ChatProtocol, User, Channel
+   compact_classes = CompactChatProtocol, CompactUser, CompactChannel
+   
    def buildProtocol(self, addr):
-      return ChatProtocol(self.users, self.channels, self.private)
+      host = None
+      if addr is not None: #otherwise it's come back from a snapshot, and was let in long ago
+         if self.max_per_ip:
+            host = addr[0] if type(addr) is tuple else getattr(addr, "host", None) #chat_loop's addresses are tuples
+         refused = self.refuse(host)
+         if refused is not None:
+            self.refused[refused] += 1
+            return None #the port closes the connection
+      p = self.protocol(self.users, self.channels, self.directory)
+      p.factory = self
+      if host is not None:
+         p.host = host
+         self.per_ip[host] = self.per_ip.get(host, 0) + 1
+      if self.events is not None:
+         self.events.add("connect", id(p), addr)
+      return p
+      
+   def refuse(self, host):
+      #why a new connection from host can't come in, if it can't
+      if self.max_connections and len(self.connected) >= self.max_connections:
+         return "full"
+      if host is not None and self.per_ip.get(host, 0) >= self.max_per_ip:
+         return "per-ip"
+      if self.accept_bucket is not None:
+         if not self.accept_bucket.take(self.accept_bucket.most):
+            return "rate"
+         if self.accept_bucket.tokens < 1:
+            self.pause_accepting()
+      return None
+      
+   def left(self, host):
+      n = self.per_ip[host] - 1
+      if n:
+         self.per_ip[host] = n
+      else:
+         del self.per_ip[host]
+         
+   def pause_accepting(self):
+      #leave new connections in the listen backlog until the accept rate is back in credit
+      if self.resuming is None and getattr(self.port, "stopReading", None) is not None:
+         self.port.stopReading()
+         self.resuming = self.clock.callLater(self.accept_bucket.wait(), self.resume_accepting)
+         
+   def resume_accepting(self):
+      wait = self.accept_bucket.wait()
+      if wait: #what came in on credit isn't paid off yet
+         self.resuming = self.clock.callLater(wait, self.resume_accepting)
+      else:
+         self.resuming = None
+         if not self.handing_over:
+            self.port.startReading()
+      
+   def stop_admitting(self):
+      #cancel the calls that let more connections and logins in, for now; see start_admitting
+      for call in (self.staging, self.resuming):
+         if call is not None and call.active():
+            call.cancel()
+      self.staging = self.resuming = None
+      
+   def start_admitting(self):
+      #start the port and the login queue again after stop_admitting, or as soon as their rates allow
+      if self.accept_bucket is not None and self.accept_bucket.wait():
+         self.pause_accepting()
+      else:
+         self.port.startReading()
+      if self.staged() and self.staging is None:
+         self.staging = self.clock.callLater(self.login_bucket.wait(), self.let_in)
+      
+   def login_slot(self):
+      #whether someone can log in right now, ahead of anyone already waiting
+      return not self.login_queue and self.login_bucket.take()
+      
+   def queue_login(self, protocol):
+      self.login_queue.append(protocol)
+      if self.staging is None:
+         self.staging = self.clock.callLater(self.login_bucket.wait(), self.let_in)
+         
+   def let_in(self):
+      #the staged login queue: take in as many waiting logins as the login rate allows, oldest first, and come back
+      #when it allows another
+      self.staging = None
+      queue = self.login_queue
+      while queue:
+         if queue[0].waiting is None: #gone
+            queue.popleft()
+         elif self.login_bucket.take():
+            queue.popleft().catch_up(True)
+         else:
+            break
+      if queue and self.staging is None:
+         self.staging = self.clock.callLater(self.login_bucket.wait(), self.let_in)
+         
+   def staged(self):
+      return sum(1 for protocol in self.login_queue if protocol.waiting is not None)
+      
+   def create_channel(self, name, creator, topic):
+      if self.compact:
+         name = intern(name)
+      return self.channel(name, creator, topic, self.stats, self.scrollback, self.history, self.directory)
 
-def main():
+def serve_metrics(port, factory):
+   #the factory's Stats, in the Prometheus text format, on http://127.0.0.1:<port>/
+   from twisted.web.resource import Resource
+   from twisted.web.server import Site
+   class Metrics(Resource):
+      isLeaf = True
+      def render_GET(self, request):
+         request.setHeader("content-type", "text/plain; version=0.0.4")
+         return factory.stats.exposition(factory)
+   return reactor.listenTCP(port, Site(Metrics()), interface="127.0.0.1")
+
+def options():
+   from argparse import ArgumentParser, SUPPRESS
+   parser = ArgumentParser(description="DIE: Denizens of the Internet Effusing")
+   parser.add_argument("--port", type=int, default=9399)
+   parser.add_argument("--workers", type=int, default=1, help="run this many worker processes sharing the port")
+   parser.add_argument("--backend", choices=("twisted", "loop"), default="twisted",
+                       help="the event loop to run on: Twisted's reactor, or the asyncio-style loop in chat_loop.py")
+   parser.add_argument("--hub", help=SUPPRESS) #set for the workers spawned by --workers
+   parser.add_argument("--worker-id", type=int, default=0, help=SUPPRESS)
+   parser.add_argument("--queue-bytes", type=int, default=1 << 20, help="most bytes held back for a client that stops reading")
+   parser.add_argument("--queue-messages", type=int, default=2000, help="most lines held back for a client that stops reading")
+   parser.add_argument("--slow-policy", choices=SLOW_POLICIES, default="drop-oldest", help="what to do when a client's queue is full")
+   parser.add_argument("--operator-password", help="the password for /oper; without one, nobody can be an operator")
+   parser.add_argument("--coalesce", action="store_true", help="write each connection's lines once per reactor turn")
+   parser.add_argument("--coalesce-delay", type=float, default=0, help="with --coalesce, hold lines for up to this many seconds")
+   parser.add_argument("--flood-control", action="store_true", help="rate limit what each connection sends")
+   parser.add_argument("--limit", action="append", default=[], metavar="KIND=RATE/MOST",
+                       help="set one flood control limit, e.g. chat=5/20 for 5 lines a second with up to 20 saved up; "
+                            "the kinds are line, chat, room, and command names such as join. Implies --flood-control.")
+   parser.add_argument("--login-timeout", type=float, default=60, help="seconds a connection has to log in; 0 for forever")
+   parser.add_argument("--idle-timeout", type=float, default=0, help="seconds someone can stay quiet before being disconnected (or, with --ping, sent a PING); 0 for forever")
+   parser.add_argument("--ping", type=float, default=0, metavar="SECONDS", help="with --idle-timeout, PING quiet people and give them this long to answer")
+   parser.add_argument("--compact", action="store_true", help="use less memory per connection, for lots of idle ones")
+   parser.add_argument("--backlog", type=int, default=50, help="connections the kernel holds for the server to accept")
+   parser.add_argument("--max-connections", type=int, default=0, help="refuse connections beyond this many; 0 for no limit")
+   parser.add_argument("--max-per-ip", type=int, default=0, help="refuse connections beyond this many from one IP; 0 for no limit")
+   parser.add_argument("--accept-rate", type=float, default=0, help="new connections let in a second, the rest waiting in the backlog; 0 for no limit")
+   parser.add_argument("--accept-burst", type=float, default=0, help="new connections let in at once, with --accept-rate; a second's worth by default")
+   parser.add_argument("--login-rate", type=float, default=0, help="logins a second, the rest waiting their turn; 0 for no limit")
+   parser.add_argument("--login-burst", type=float, default=0, help="logins at once, with --login-rate; a second's worth by default")
+   parser.add_argument("--reap-grace", type=float, default=300, help="seconds a protected room lasts once everyone has left")
+   parser.add_argument("--scrollback", type=int, default=20, help="lines each room replays to people who join; 0 for none")
+   parser.add_argument("--history-dir", help="log every room under this directory, for /history")
+   parser.add_argument("--history-open", type=int, default=128, metavar="N", help="rooms whose --history-dir logs are kept open at once, the most recently used")
+   parser.add_argument("--metrics-port", type=int, help="serve metrics over HTTP on this local port (plus the worker id, with --workers)")
+   parser.add_argument("--snapshot", metavar="FILE", help="save the rooms to FILE now and then, and bring them back from it on startup")
+   parser.add_argument("--snapshot-interval", type=float, default=60, help="seconds between --snapshot saves")
+   parser.add_argument("--handover", metavar="PATH", help="let a new process take over from this one through the Unix socket PATH")
+   parser.add_argument("--take-over", action="store_true", help="take over from the process at --handover PATH, connections and all")
+   parser.add_argument("--event-log", metavar="FILE", help="log what happens, and the server's messages, to FILE from a thread of its own instead of to stdout")
+   parser.add_argument("--event-sample", type=int, default=100, metavar="N", help="log one in N chat lines and room writes")
+   parser.add_argument("--event-ring", type=int, default=1 << 16, help="most events waiting to be written before more are dropped")
+   parser.add_argument("--event-rotate", type=int, default=64 << 20, metavar="BYTES", help="start a new --event-log file after this many bytes")
+   parser.add_argument("--event-keep", type=int, default=10, help="old --event-log files to keep")
+   parser.add_argument("--record", metavar="FILE", help="record everything clients send to FILE, to play back with chat_trace.py")
+   return parser
+
+def factory_config(args):
+   #the ChatFactory keyword arguments that come from the command line
+   history = None
+   if args.history_dir is not None:
+      import os
+      from chat_history import History
+      #each worker sees only the rooms it has people in, so each keeps a log of its own
+      history = History(args.history_dir if args.hub is None else os.path.join(args.history_dir, str(args.worker_id)),
+                        open_logs=args.history_open)
+   recorder = None
+   if args.record is not None:
+      from chat_trace import Recorder
+      recorder = Recorder(args.record if args.hub is None else "{0}-worker{1}".format(args.record, args.worker_id))
+   limits = None
+   if args.flood_control or args.limit:
+      limits = dict(FLOOD_LIMITS)
+      for limit in args.limit:
+         kind, rate = limit.split("=")
+         rate, most = rate.split("/")
+         limits[kind] = (float(rate), float(most))
+   return dict(queue_bytes=args.queue_bytes, queue_messages=args.queue_messages, slow_policy=args.slow_policy,
+               operator_password=args.operator_password, scrollback=args.scrollback, history=history,
+               coalesce=args.coalesce, coalesce_delay=args.coalesce_delay, limits=limits, reap_grace=args.reap_grace,
+               login_timeout=args.login_timeout, idle_timeout=args.idle_timeout, ping_timeout=args.ping,
+               compact=args.compact, events=args.events, recorder=recorder, max_connections=args.max_connections,
+               max_per_ip=args.max_per_ip, accept_rate=args.accept_rate, accept_burst=args.accept_burst,
+               login_rate=args.login_rate, login_burst=args.login_burst)
+
+def start_logging(args):
+   #where the log goes: to stdout, or with --event-log through a chat_events.EventLog, which is returned
    import sys
-   log.startLogging(sys.stdout)
-   reactor.listenTCP(9399, ChatFactory())
+   if args.event_log is None:
+      log.startLogging(sys.stdout)
+      return None
+   import atexit
+   from chat_events import EventLog
+   path = args.event_log
+   if args.hub is not None: #a worker; the parent has the file itself
+      path = "{0}-worker{1}".format(path, args.worker_id)
+   events = EventLog(path, size=args.event_ring, sample=args.event_sample, rotate_bytes=args.event_rotate,
+                     keep=args.event_keep)
+   if not args.take_over: #otherwise main starts it once the old process has closed the file, see chat_snapshot
+      events.start()
+   atexit.register(events.stop)
+   log.startLoggingWithObserver(events.observe, setStdout=False)
+   return events
+
+def main():
+   args = options().parse_args()
+   args.events = start_logging(args)
+   if args.backend == "loop":
+      import chat_loop
+      return chat_loop.main(args)
+   if args.hub is not None or args.workers > 1:
+      if args.snapshot is not None or args.handover is not None:
+         raise SystemExit("--snapshot and --handover don't work with --workers.")
+      import chat_cluster
+      return chat_cluster.main(args)
+   if args.take_over and args.handover is None:
+      raise SystemExit("--take-over needs --handover PATH.")
+   factory = ChatFactory(**factory_config(args))
+   if args.snapshot is not None or args.handover is not None:
+      import chat_snapshot
+   if args.snapshot is not None:
+      if not args.take_over: #the old process hands over its rooms as they are
+         chat_snapshot.restore_file(factory, args.snapshot)
+      chat_snapshot.Snapshots(factory, args.snapshot, args.snapshot_interval).start()
+   def listening(port):
+      factory.port = port
+      if args.events is not None and args.events.thread is None: #taken over, and the old process is gone
+         args.events.start()
+      if args.metrics_port is not None:
+         serve_metrics(args.metrics_port, factory)
+      if args.handover is not None:
+         chat_snapshot.listen(factory, port, args.handover)
+   if args.take_over:
+      def failed(reason):
+         if args.events is not None: #the old process carries on with the file
+            import sys
+            log.addObserver(log.FileLogObserver(sys.stderr).emit)
+         log.err(reason, "Couldn't take over")
+         reactor.stop()
+      chat_snapshot.take_over(factory, args.handover).addCallbacks(listening, failed)
+   else:
+      listening(reactor.listenTCP(args.port, factory, backlog=args.backlog))
    reactor.run()
 
 if __name__ == "__main__":
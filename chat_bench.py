@@ -0,0 +1,696 @@
+"""Rough benchmarks for the chat server. These drive ChatFactory in-process over StringTransports, so they measure the
+server's own work and nothing of the network. Run them with `python chat_bench.py <benchmark> [count]`, or with no
+arguments to see what is available."""
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+
+from twisted.test import proto_helpers
+
+from chat import FLOOD_LIMITS, ChatFactory, Command, Histogram
+
+
+def rss():
+   """Resident set size of this process, in bytes."""
+   with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class BufferingTransport(proto_helpers.StringTransport):
+   #buffers writes the way a real twisted transport does, by appending to a list, so that StringTransport's BytesIO
+   #doesn't dominate the numbers
+   def write(self, data):
+      self.buffer.append(data)
+      
+   def writeSequence(self, seq):
+      self.buffer.extend(seq)
+      
+   def clear(self):
+      self.buffer = []
+      
+   def value(self):
+      return "".join(self.buffer)
+
+def connect(factory, transport=proto_helpers.StringTransport):
+   proto = factory.buildProtocol(('127.0.0.1', 0))
+   tr = transport()
+   proto.makeConnection(tr)
+   return proto, tr
+
+def report(name, **results):
+   print(name)
+   for key in sorted(results):
+      print("   {0}: {1}".format(key, results[key]))
+
+
+def bench_logins(n=100000):
+   #the same scenario as test_multi1 in chat_test_1.py
+   factory = ChatFactory()
+   gc.collect()
+   before = rss()
+   start = time.time()
+   for i in xrange(n):
+      proto, tr = connect(factory)
+      proto.dataReceived("user{0}\r\n".format(i))
+      tr.clear()
+   elapsed = time.time() - start
+   gc.collect()
+   report("logins", connections=n, seconds=round(elapsed, 3), logins_per_sec=int(n / elapsed),
+          bytes_per_connection=(rss() - before) // n)
+
+def bench_commands(n=200000):
+   factory = ChatFactory()
+   proto, tr = connect(factory)
+   proto.dataReceived("bencher\r\n/join bench\r\n")
+   lines = ["/commands", "/help msg", "/topic benchmarking is fun", "/rooms", "/msg bencher hello there"]
+   start = time.time()
+   for i in xrange(n):
+      proto.lineReceived(lines[i % len(lines)])
+      if i & 1023 == 0:
+         tr.clear()
+   elapsed = time.time() - start
+   report("commands", commands=n, seconds=round(elapsed, 3), commands_per_sec=int(n / elapsed))
+
+def bench_fanout(members=5000, messages=200):
+   #one big room where every other member has switched away to a room of their own
+   factory = ChatFactory()
+   cons = []
+   for i in xrange(members):
+      proto, tr = connect(factory, BufferingTransport)
+      proto.dataReceived("user{0}\r\n/join big\r\n".format(i))
+      if i % 2:
+         proto.dataReceived("/join away{0}\r\n".format(i))
+      cons.append((proto, tr))
+   for proto, tr in cons:
+      tr.clear()
+   speaker = cons[0][0]
+   elapsed = 0.0
+   for i in xrange(messages):
+      start = time.time()
+      speaker.lineReceived("message number {0}".format(i))
+      elapsed += time.time() - start
+      if i & 15 == 0:
+         for proto, tr in cons:
+            tr.clear()
+   report("fanout", members=members, messages=messages, seconds=round(elapsed, 3),
+          messages_per_sec=int(messages / elapsed), deliveries_per_sec=int(messages * ((members + 1) // 2) / elapsed))
+
+def bench_membership(n=2000):
+   #join/part and toggleop against rooms of increasing size. The members never look at the room, so the fanout of part
+   #messages stays out of the numbers.
+   for size in (10, 1000, 50000):
+      factory = ChatFactory()
+      op, _ = connect(factory, BufferingTransport)
+      op.dataReceived("op\r\n/join room\r\n")
+      room = factory.channels["room"]
+      members = []
+      for i in xrange(size):
+         proto, _ = connect(factory, BufferingTransport)
+         proto.dataReceived("user{0}\r\n".format(i))
+         room.join(proto.me)
+         members.append(proto.me)
+      churn = members[-n:]
+      start = time.time()
+      for user in churn:
+         room.part(user, "brb")
+         room.join(user)
+      joinpart = time.time() - start
+      opped = members[:n]
+      start = time.time()
+      for user in opped:
+         Command.toggleop(op.me, user.name)
+      for user in opped:
+         Command.toggleop(op.me, user.name)
+      toggleop = time.time() - start
+      report("membership", members=size, joinpart_per_sec=int(len(churn) / joinpart),
+             toggleop_per_sec=int(2 * len(opped) / toggleop))
+
+def bench_rooms(n=100000, repeat=5):
+   #n public rooms of 1 to 7 members, then /rooms in each of its forms, and how fast joins and parts go while the
+   #listing is kept up to date. Nobody is looking at any of the rooms, so parts cost no fanout.
+   factory = ChatFactory()
+   users = []
+   for i in xrange(1000):
+      proto, _ = connect(factory, BufferingTransport)
+      proto.dataReceived("user{0}\r\n".format(i))
+      users.append(proto.me)
+   start = time.time()
+   for i in xrange(n):
+      name = "room{0}".format(i)
+      room = factory.channels[name] = factory.create_channel(name, users[0], "")
+      for j in xrange(i % 7 + 1):
+         room.join(users[(i + j) % len(users)])
+   build = time.time() - start
+   asker, tr = connect(factory, BufferingTransport)
+   asker.dataReceived("asker\r\n")
+   results = {}
+   for key, query in (("first_page", ""), ("page_1000", "1000"), ("by_size", "size"), ("by_size_page_1000", "size 1000"),
+                      ("prefix", "room4242*"), ("substring", "m4242")):
+      tr.clear()
+      start = time.time()
+      for i in xrange(repeat):
+         asker.dataReceived("/rooms {0}\r\n".format(query))
+      results[key + "_ms"] = round((time.time() - start) * 1000 / repeat, 2)
+      results[key + "_bytes"] = len(tr.value()) // repeat
+   rooms = [factory.channels["room{0}".format(i)] for i in xrange(0, n, max(1, n // 10000))]
+   start = time.time()
+   for room in rooms:
+      user = next(iter(room.users))
+      room.part(user, "brb")
+      room.join(user)
+   joinpart = time.time() - start
+   report("rooms", rooms=n, build_seconds=round(build, 3), joinpart_per_sec=int(len(rooms) / joinpart), **results)
+
+def bench_coalesce(members=1000, messages=500, burst=10):
+   #Over loopback with the real reactor: members clients in one room, one of whom says messages lines, burst at a time
+   #every millisecond, with coalescing off, once per reactor turn, and held for up to 5ms. Every client runs in this
+   #process too, so the rates are for the whole thing; send() calls are the server's own, counted at writeSomeData.
+   from twisted.internet import defer, protocol, reactor, tcp, task
+   sends = [0]
+   writeSomeData = tcp.Server.writeSomeData
+   def counting(self, data):
+      sends[0] += 1
+      return writeSomeData(self, data)
+   tcp.Server.writeSomeData = counting
+
+   class Member(protocol.Protocol):
+      heard = 0
+      def connectionMade(self):
+         self.transport.write("m{0}\r\n/join room\r\n".format(self.factory.joined))
+         self.factory.joined += 1
+      def dataReceived(self, data):
+         self.heard += data.count("m0: ")
+         if self.heard >= messages and self.factory.waiting is not None and all(m.heard >= messages for m in self.factory.members):
+            d, self.factory.waiting = self.factory.waiting, None
+            d.callback(None)
+
+   @defer.inlineCallbacks
+   def run():
+      for label, config in (("off", {}), ("turn", dict(coalesce=True)), ("5ms", dict(coalesce=True, coalesce_delay=0.005))):
+         server = ChatFactory(**config)
+         port = reactor.listenTCP(0, server, interface="127.0.0.1")
+         clients = protocol.ClientFactory()
+         clients.protocol, clients.joined, clients.members, clients.waiting = Member, 0, [], None
+         endpoint = ("127.0.0.1", port.getHost().port)
+         for i in xrange(members):
+            clients.members.append((yield protocol.ClientCreator(reactor, lambda: clients.buildProtocol(None)).connectTCP(*endpoint)))
+         while "room" not in server.channels or len(server.channels["room"].users) < members:
+            yield task.deferLater(reactor, 0.05, lambda: None)
+         yield task.deferLater(reactor, 0.2, lambda: None)
+         talker = clients.members[0]
+         clients.waiting = defer.Deferred()
+         sends[0] = 0
+         start = time.time()
+         lines = ["hello {0}\r\n".format(i) for i in xrange(messages)]
+         def say():
+            if lines:
+               talker.transport.writeSequence(lines[:burst])
+               del lines[:burst]
+         talking = task.LoopingCall(say)
+         talking.start(0.001)
+         yield clients.waiting
+         elapsed = time.time() - start
+         talking.stop()
+         report("coalesce", mode=label, members=members, messages=messages, seconds=round(elapsed, 3),
+                deliveries_per_sec=int(members * messages / elapsed), sends=sends[0],
+                sends_per_sec=int(sends[0] / elapsed), sends_per_delivery=round(sends[0] / float(members * messages), 3))
+         for m in clients.members:
+            m.transport.abortConnection()
+         yield port.stopListening()
+         yield task.deferLater(reactor, 0.5, lambda: None)
+      reactor.stop()
+   reactor.callWhenRunning(run)
+   reactor.run()
+   tcp.Server.writeSomeData = writeSomeData
+
+def bench_flood(listeners=200, lines=20000, seconds=5):
+   #Over loopback with the real reactor: one client pastes lines into a room of listeners, while two others in a quiet
+   #room of their own ping each other four times a second. Reports how long the pings took to arrive, without and then with
+   #flood control at its defaults.
+   from twisted.internet import defer, protocol, reactor, task
+
+   class Client(protocol.Protocol):
+      def __init__(self, name, room, latency):
+         self.name, self.room, self.latency, self.buffer = name, room, latency, ""
+      def connectionMade(self):
+         self.transport.write("{0}\r\n/join {1}\r\n".format(self.name, self.room))
+      def dataReceived(self, data):
+         if self.latency is not None:
+            self.buffer += data
+            received, self.buffer = self.buffer.rsplit("\r\n", 1)
+            for line in received.split("\r\n"):
+               if line.startswith("pinger: "):
+                  self.latency.add(int((time.time() - float(line[8:])) * 1e6))
+
+   @defer.inlineCallbacks
+   def run():
+      for label, limits in (("off", None), ("on", FLOOD_LIMITS)):
+         server = ChatFactory(limits=limits)
+         port = reactor.listenTCP(0, server, interface="127.0.0.1")
+         latency = Histogram()
+         clients = []
+         def connect(name, room, latency=None):
+            creator = protocol.ClientCreator(reactor, Client, name, room, latency)
+            return creator.connectTCP("127.0.0.1", port.getHost().port).addCallback(clients.append)
+         for i in xrange(listeners):
+            yield connect("l{0}".format(i), "flood")
+         yield connect("flooder", "flood")
+         yield connect("pinger", "quiet")
+         yield connect("ponger", "quiet", latency)
+         yield task.deferLater(reactor, 0.5, lambda: None)
+         flooder, pinger = clients[-3], clients[-2]
+         flooder.transport.write("".join("flooding {0}\r\n".format(i) for i in xrange(lines)))
+         ping = task.LoopingCall(lambda: pinger.transport.write("{0!r}\r\n".format(time.time())))
+         ping.start(0.25) #well within the default limits
+         yield task.deferLater(reactor, seconds, lambda: None)
+         ping.stop()
+         delivered = server.stats.fanout_size.n
+         report("flood", flood_control=label, listeners=listeners, pasted=lines, room_writes=delivered,
+                flood_dropped=server.flood_dropped, pings=latency.n, ping_latency=latency.summary("us"),
+                reactor_lag=server.stats.lag.summary("us"))
+         for c in clients:
+            c.transport.abortConnection()
+         yield port.stopListening()
+         yield task.deferLater(reactor, 0.5, lambda: None)
+      reactor.stop()
+   reactor.callWhenRunning(run)
+   reactor.run()
+
+def bench_limiter(n=100000):
+   #what flood control costs to keep: n connections that have each said a line, with and without it. Each runs in a
+   #child process of its own, so neither inherits the other's heap.
+   for limits in (None, FLOOD_LIMITS):
+      pid = os.fork()
+      if pid:
+         os.waitpid(pid, 0)
+         continue
+      factory = ChatFactory(limits=limits)
+      connections = []
+      gc.collect()
+      before = rss()
+      start = time.time()
+      for i in xrange(n):
+         proto, tr = connect(factory, BufferingTransport)
+         proto.dataReceived("user{0}\r\nhello\r\n".format(i))
+         tr.clear()
+         connections.append(proto)
+      elapsed = time.time() - start
+      gc.collect()
+      report("limiter", flood_control=limits is not None, connections=n, logins_and_lines_per_sec=int(n / elapsed),
+             bytes_per_connection=(rss() - before) // n)
+      sys.stdout.flush()
+      os._exit(0)
+
+def bench_memory(n=100000):
+   #what an idle connection costs, logged in and sitting in a room of ten, at 10000 connections and at n, with and
+   #without compact mode; each in a child process of its own, as for limiter
+   for count in sorted(set((10000, n))):
+      for compact in (False, True):
+         pid = os.fork()
+         if pid:
+            os.waitpid(pid, 0)
+            continue
+         factory = ChatFactory(compact=compact)
+         connections = []
+         gc.collect()
+         before = rss()
+         for i in xrange(count):
+            proto, tr = connect(factory, BufferingTransport)
+            proto.dataReceived("user{0}\r\n/join room{1}\r\n".format(i, i // 10))
+            tr.clear()
+            connections.append(proto)
+         gc.collect()
+         report("memory", compact=compact, connections=count, bytes_per_connection=(rss() - before) // count)
+         sys.stdout.flush()
+         os._exit(0)
+
+def bench_backends(clients=1000, seconds=5):
+   #The same load, by way of chat_load.py over real sockets, against a server on Twisted's reactor and on chat_loop's
+   #loop: a big room talking faster than the server can keep up with, for throughput, then rooms of ten at a steady
+   #rate, for latency. The clients run on the same machine, so compare the two and not the numbers themselves.
+   here = os.path.dirname(os.path.abspath(__file__))
+   for scenario, rate in (("bigroom", 500), ("smallrooms", 2000)):
+      for backend in ("twisted", "loop"):
+         result = json.loads(subprocess.check_output([sys.executable, os.path.join(here, "chat_load.py"), scenario,
+                                                      "--spawn", "--backend", backend, "--clients", str(clients),
+                                                      "--duration", str(seconds), "--rate", str(rate), "--json"]))
+         report("backends", backend=backend, scenario=scenario, offered_lines_per_sec=rate,
+                delivered_per_sec=result["delivered_per_sec"], login_per_sec=result["login_per_sec"],
+                latency_ms=result["latency_ms"], server_rss_bytes=result["server_rss_bytes"])
+         sys.stdout.flush()
+
+def server_cpu(pid):
+   #seconds of CPU pid has used
+   with open("/proc/{0}/stat".format(pid)) as f:
+      fields = f.read().rsplit(")", 1)[1].split()
+   return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def bench_loops(members=500, lines=2000):
+   #The event loops themselves: a server on each backend in a process of its own, members plain sockets in one room
+   #read by a poll loop here, and one of them saying lines lines as fast as the server takes them. The server's CPU time
+   #per line delivered holds still when this process competes with it for the core, where wall-clock rates don't.
+   import select
+   import socket
+   here = os.path.dirname(os.path.abspath(__file__))
+   for backend in ("twisted", "loop"):
+      probe = socket.socket()
+      probe.bind(("127.0.0.1", 0))
+      port = probe.getsockname()[1]
+      probe.close()
+      with open(os.devnull, "w") as quiet:
+         server = subprocess.Popen([sys.executable, os.path.join(here, "chat.py"), "--port", str(port), "--backend",
+                                    backend, "--scrollback", "0", "--queue-bytes", str(1 << 30), "--queue-messages",
+                                    str(1 << 30)], stdout=quiet, stderr=subprocess.STDOUT)
+      try:
+         for attempt in xrange(100):
+            try:
+               socket.create_connection(("127.0.0.1", port)).close()
+               break
+            except socket.error:
+               time.sleep(0.1)
+         socks = []
+         for i in xrange(members):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall("user{0}\r\n/join lobby\r\n".format(i))
+            seen = ""
+            while "end of list" not in seen:
+               seen += sock.recv(1 << 16)
+            sock.setblocking(0)
+            socks.append(sock)
+         poller, by_fd = select.poll(), {}
+         for sock in socks:
+            poller.register(sock, select.POLLIN)
+            by_fd[sock.fileno()] = sock
+         def drain(timeout):
+            #everything waiting for any of them, as how many lines each got
+            got = 0
+            for fd, event in poller.poll(timeout):
+               try:
+                  got += by_fd[fd].recv(1 << 20).count("\n")
+               except socket.error:
+                  pass
+            return got
+         while drain(200):
+            pass
+         talker, data = socks[0], "".join("line {0}\r\n".format(i) for i in xrange(lines))
+         wanted, received = members * lines, 0
+         cpu, start = server_cpu(server.pid), time.time()
+         while received < wanted and time.time() - start < 120:
+            if data:
+               try:
+                  data = data[talker.send(data):]
+               except socket.error:
+                  pass
+            received += drain(10)
+         elapsed, cpu = time.time() - start, server_cpu(server.pid) - cpu
+         report("loops", backend=backend, members=members, lines=lines, delivered=received,
+                deliveries_per_sec=int(received / elapsed), server_cpu_us_per_delivery=round(cpu * 1e6 / received, 2))
+         sys.stdout.flush()
+         for sock in socks:
+            sock.close()
+      finally:
+         server.terminate()
+         server.wait()
+
+def bench_restore(users=100000, rooms=10000):
+   #a snapshot of users connections in rooms rooms with their scrollback full: how long it takes to make, how big it is
+   #and how long a new process takes to bring it all back
+   import chat_snapshot
+   factory = ChatFactory()
+   connections = []
+   for i in xrange(users):
+      proto, tr = connect(factory, BufferingTransport)
+      proto.dataReceived("user{0}\r\n/join room{1}\r\n".format(i, i % rooms))
+      connections.append(proto)
+   for proto in connections[:rooms * 20]:
+      proto.dataReceived("a line for the scrollback\r\n")
+   start = time.time()
+   data = chat_snapshot.dump(factory, connections)
+   dumped = time.time() - start
+   start = time.time()
+   found, complete = chat_snapshot.load(data)
+   new = ChatFactory()
+   chat_snapshot.restore(new, found, [lambda p: BufferingTransport()] * users)
+   restored = time.time() - start
+   report("restore", users=users, rooms=rooms, snapshot_bytes=len(data), dump_ms=int(dumped * 1000),
+          restore_ms=int(restored * 1000), restored_users=len(new.users), restored_rooms=len(new.channels))
+
+def bench_machine(rooms=500, repeat=20):
+   #A bot joining rooms rooms and saying something in each: first in the server alone, in the text protocol and in
+   #machine mode, for what the JSON costs; then over a real socket to a server of its own, waiting for each reply
+   #before sending the next command as a text client has to, and all at once in machine mode.
+   import socket
+   def text_lines(i):
+      return ["/join room{0}".format(i), "hello room{0}".format(i)]
+   def machine_lines(i):
+      return [json.dumps({"id": 2 * i, "cmd": "join", "args": ["room{0}".format(i)]}),
+              json.dumps({"id": 2 * i + 1, "cmd": "say", "room": "room{0}".format(i), "args": ["hello"]})]
+   for mode, lines in (("text", text_lines), ("machine", machine_lines)):
+      lines = [line for i in xrange(rooms) for line in lines(i)]
+      elapsed = 0
+      for n in xrange(repeat):
+         factory = ChatFactory()
+         proto, tr = connect(factory, BufferingTransport)
+         proto.dataReceived('/machine\r\n{"id":0,"cmd":"login","args":["bot"]}\r\n' if mode == "machine" else "bot\r\n")
+         start = time.time()
+         for line in lines:
+            proto.lineReceived(line)
+         elapsed += time.time() - start
+      report("machine", mode=mode, where="in process", commands_per_sec=int(len(lines) * repeat / elapsed))
+   probe = socket.socket()
+   probe.bind(("127.0.0.1", 0))
+   port = probe.getsockname()[1]
+   probe.close()
+   here = os.path.dirname(os.path.abspath(__file__))
+   with open(os.devnull, "w") as quiet:
+      server = subprocess.Popen([sys.executable, os.path.join(here, "chat.py"), "--port", str(port)], stdout=quiet,
+                                stderr=subprocess.STDOUT)
+   try:
+      for attempt in xrange(100):
+         try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+         except socket.error:
+            time.sleep(0.1)
+      def until(sock, end):
+         data = ""
+         while end not in data:
+            data += sock.recv(1 << 16)
+      for name, mode in (("lockstep", "text"), ("pipelined", "machine")):
+         sock = socket.create_connection(("127.0.0.1", port))
+         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+         until(sock, "Login name?\r\n")
+         start = time.time()
+         if mode == "text":
+            sock.sendall(name + "\r\n")
+            until(sock, "Welcome {0}!\r\n".format(name))
+            for i in xrange(rooms):
+               sock.sendall("/join {0}{1}\r\n".format(name, i))
+               until(sock, "end of list\r\n")
+               sock.sendall("hello\r\n")
+               until(sock, "{0}: hello\r\n".format(name))
+         else:
+            requests = ['/machine', json.dumps({"id": "login", "cmd": "login", "args": [name]})]
+            for i in xrange(rooms):
+               requests.append(json.dumps({"id": 2 * i, "cmd": "join", "args": [name + str(i)]}))
+               requests.append(json.dumps({"id": 2 * i + 1, "cmd": "say", "args": ["hello"]}))
+            sock.sendall("\r\n".join(requests) + "\r\n")
+            until(sock, '"id":{0},'.format(2 * rooms - 1))
+         elapsed = time.time() - start
+         sock.close()
+         report("machine", mode=mode, where="over a socket", rooms=rooms, seconds=round(elapsed, 3))
+   finally:
+      server.terminate()
+      server.wait()
+
+def bench_who(n=100000, repeat=200):
+   #/who with n people online: adding and removing a name from the index, and the time a page of each kind of query
+   #takes, the slow one being a pattern that starts with a wildcard, which has to look at every name
+   from chat import UserIndex
+   users = UserIndex()
+   names = ["User{0}".format(i) for i in xrange(n)]
+   start = time.time()
+   for name in names:
+      users[name] = None
+   added = time.time() - start
+   start = time.time()
+   for name in names[::2]:
+      del users[name]
+   removed = time.time() - start
+   for name in names[::2]:
+      users[name] = None
+   results = {}
+   for query in ("", "user5", "user5*1", "*99", "user12?4"):
+      start = time.time()
+      for i in xrange(repeat):
+         users.page(0, 50, query)
+      results["page_us " + (query or "(everyone)")] = int((time.time() - start) / repeat * 1e6)
+   report("who", users=n, add_us=round(added / n * 1e6, 2), remove_us=round(removed / (n // 2) * 1e6, 2), **results)
+
+def bench_events(n=200000):
+   #bench_commands' lines plus chat, without the event log, with it, and with its writer stalled (as if the disk had
+   #stopped), when the ring fills up and the rest are dropped: the last two should cost the reactor about the same
+   import shutil
+   import tempfile
+   from chat_events import EventLog
+   directory = tempfile.mkdtemp()
+   lines = ["/commands", "/help msg", "/topic benchmarking is fun", "/rooms", "/msg bencher hello there", "hello"]
+   results = {}
+   try:
+      for label in ("off", "on", "stalled"):
+         events = EventLog(os.path.join(directory, label)) if label != "off" else None
+         if label == "on":
+            events.start()
+         factory = ChatFactory(events=events)
+         proto, tr = connect(factory, BufferingTransport)
+         proto.dataReceived("bencher\r\n/join bench\r\n")
+         start = time.time()
+         for i in xrange(n):
+            proto.lineReceived(lines[i % len(lines)])
+            if i & 1023 == 0:
+               tr.clear()
+         elapsed = time.time() - start
+         results["lines_per_sec " + label] = int(n / elapsed)
+         if events is not None:
+            events.stop()
+            results["dropped " + label] = events.dropped
+   finally:
+      shutil.rmtree(directory)
+   report("events", lines=n, **results)
+
+def bench_record(n=200000):
+   #what --record costs the reactor: the same lines as bench_events, one read each, without and with a Recorder
+   import shutil
+   import tempfile
+   from chat_trace import Recorder
+   directory = tempfile.mkdtemp()
+   lines = ["/commands\r\n", "/help msg\r\n", "/topic benchmarking is fun\r\n", "/rooms\r\n",
+            "/msg bencher hello there\r\n", "hello\r\n"]
+   results = {}
+   try:
+      for label in ("off", "on"):
+         recorder = Recorder(os.path.join(directory, "trace")) if label == "on" else None
+         factory = ChatFactory(recorder=recorder)
+         proto, tr = connect(factory, BufferingTransport)
+         proto.dataReceived("bencher\r\n/join bench\r\n")
+         start = time.time()
+         for i in xrange(n):
+            proto.dataReceived(lines[i % len(lines)])
+            if i & 1023 == 0:
+               tr.clear()
+               if recorder is not None:
+                  recorder.flush() #what the reactor would do at the end of the turn
+         elapsed = time.time() - start
+         results["reads_per_sec " + label] = int(n / elapsed)
+         if recorder is not None:
+            recorder.close()
+            results["trace_bytes"] = os.path.getsize(os.path.join(directory, "trace"))
+   finally:
+      shutil.rmtree(directory)
+   report("record", reads=n, **results)
+
+def bench_storm(storm=3000):
+   #A reconnect storm: storm clients (from chat_load.py, in a process of its own) connect at once and log in, against
+   #a server in another process, while two people already in a quiet room ping each other twenty times a second.
+   #Reports how long the pings took before and during the storm, without admission control and with it.
+   from twisted.internet import defer, protocol, reactor, task, utils
+   here = os.path.dirname(os.path.abspath(__file__))
+
+   class Client(protocol.Protocol):
+      def __init__(self, name):
+         self.name, self.buffer, self.latency = name, "", None
+      def connectionMade(self):
+         self.transport.write("{0}\r\n/join quiet\r\n".format(self.name))
+      def dataReceived(self, data):
+         self.buffer += data
+         received, self.buffer = self.buffer.rsplit("\r\n", 1)
+         for line in received.split("\r\n"):
+            if line.startswith("pinger: ") and self.latency is not None:
+               self.latency.add(int((time.time() - float(line[8:])) * 1e6))
+
+   @defer.inlineCallbacks
+   def run():
+      port = 19399
+      for label, limits in (("off", []), ("on", ["--accept-rate", "500", "--login-rate", "300", "--backlog", "1024"])):
+         with open(os.devnull, "w") as quiet:
+            server = subprocess.Popen([sys.executable, os.path.join(here, "chat.py"), "--port", str(port)] + limits,
+                                      stdout=quiet, stderr=subprocess.STDOUT)
+         try:
+            yield task.deferLater(reactor, 1, lambda: None)
+            creator = protocol.ClientCreator(reactor, Client, "pinger")
+            pinger = yield creator.connectTCP("127.0.0.1", port)
+            ponger = yield protocol.ClientCreator(reactor, Client, "ponger").connectTCP("127.0.0.1", port)
+            ping = task.LoopingCall(lambda: pinger.transport.write("{0!r}\r\n".format(time.time())))
+            ping.start(0.05)
+            before = ponger.latency = Histogram()
+            yield task.deferLater(reactor, 2, lambda: None)
+            during = ponger.latency = Histogram()
+            out = yield utils.getProcessOutput(sys.executable, [os.path.join(here, "chat_load.py"), "login", "--port",
+                                               str(port), "--clients", str(storm), "--concurrency", str(storm),
+                                               "--json"], env=os.environ, errortoo=False)
+            ponger.latency = None
+            ping.stop()
+            result = json.loads(out)
+            report("storm", admission_control=label, storm_clients=storm, logged_in=result["clients"] - result["errors"],
+                   failed=result["errors"], login_per_sec=result["login_per_sec"],
+                   ping_us_before=before.summary(), ping_us_during=during.summary())
+            sys.stdout.flush()
+            for client in (pinger, ponger):
+               client.transport.loseConnection()
+         finally:
+            server.terminate()
+            server.wait()
+      reactor.stop()
+
+   reactor.callWhenRunning(run)
+   reactor.run()
+
+def bench_soak(n=1000000, rooms=1000):
+   #Churn n connections through logging in, joining, chatting and leaving, by /quit or by just going away, some before
+   #they ever log in. Memory should level off once the first tenth have been through; exits 1 if it doesn't.
+   factory = ChatFactory()
+   def churn(start, stop):
+      for i in xrange(start, stop):
+         proto, tr = connect(factory, BufferingTransport)
+         if i % 10:
+            proto.dataReceived("user{0}\r\n/join room{1}\r\n/join lobby\r\nhello\r\n".format(i, i % rooms))
+            if i % 3 == 0:
+               proto.dataReceived("/quit\r\n")
+         proto.connectionLost(None)
+   warmup = n // 10
+   start = time.time()
+   churn(0, warmup)
+   gc.collect()
+   before = rss()
+   churn(warmup, n)
+   gc.collect()
+   after = rss()
+   elapsed = time.time() - start
+   leftover = len(factory.users) + len(factory.channels) + len(factory.connected)
+   report("soak", connections=n, seconds=round(elapsed, 3), connections_per_sec=int(n / elapsed),
+          rss_after_warmup=before, rss_at_end=after, growth_bytes_per_connection=round(float(after - before) / (n - warmup), 3),
+          left_behind=leftover)
+   if leftover or after - before > (1 << 20) + before // 20: #a megabyte or 5%
+      print("soak: memory did not stay flat")
+      sys.exit(1)
+
+
+BENCHMARKS = {"logins": bench_logins, "commands": bench_commands, "fanout": bench_fanout,
+              "membership": bench_membership, "rooms": bench_rooms, "coalesce": bench_coalesce,
+              "flood": bench_flood, "limiter": bench_limiter, "memory": bench_memory, "soak": bench_soak,
+              "backends": bench_backends, "loops": bench_loops, "restore": bench_restore,
+              "machine": bench_machine, "who": bench_who, "events": bench_events,
+              "record": bench_record, "storm": bench_storm}
+
+def main(argv):
+   if len(argv) < 2 or argv[1] not in BENCHMARKS:
+      print("usage: {0} <{1}> [count]".format(argv[0], "|".join(sorted(BENCHMARKS))))
+      return 1
+   args = [int(a) for a in argv[2:]]
+   BENCHMARKS[argv[1]](*args)
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv))
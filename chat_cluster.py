@@ -0,0 +1,392 @@
+"""Run the chat server as several worker processes sharing one listening socket, e.g. `python chat.py --workers 4`.
+
+The parent process opens the listening socket, runs a hub on a Unix-domain socket and spawns the workers, each of
+which adopts the listening socket and connects to the hub. Every worker keeps a replica of who is logged in and who
+is in which room; people logged in on other workers show up there as RemoteUsers. Workers tell the hub about every
+change they make and the hub passes it on:
+
+ * a line said in a room goes to the hub once, and from there once to each worker that has members in the room,
+   which fans it out to its own viewers
+ * lines for someone on another worker (private messages, op notices, invitations) go only to that worker
+ * names are claimed from the hub, so it alone decides whether a name is taken
+ * joins, parts, logins, logouts and room settings go to every worker
+
+Room settings are last-writer-wins: two ops changing the same room at the same moment on different workers can see
+different results until the next change to that room.
+
+Because a worker only hears what is said in rooms it has members in, its scrollback and history (with --history-dir,
+kept per worker under DIR/<worker id>) cover just the stretches when it did."""
+import marshal
+import os
+import socket
+import sys
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.endpoints import UNIXClientEndpoint, connectProtocol
+from twisted.internet.protocol import ProcessProtocol, ServerFactory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+
+import chat
+from chat import Channel, ChatFactory, ChatProtocol, CompactChannel, CompactChatProtocol, CompactUser, OrderedSet, User
+
+LISTEN_FD = 3 #where the workers find the listening socket
+
+
+class RemoteUser(object):
+   #someone logged in on another worker. Anything said to them goes through the hub.
+   current = None
+
+   def __init__(self, name, worker, bus):
+      self.name = name
+      self.worker = worker
+      self.bus = bus
+      self.channels = OrderedSet()
+      self.opped = set()
+
+   def write(self, message):
+      self.bus.send(("to", self.name, message))
+
+   def grant(self, channel, token):
+      self.bus.send(("grant", self.name, channel, token))
+
+
+class ClusterChannel(Channel):
+   def __init__(self, name, creator, topic, bus, stats=None, scrollback=0, history=None, directory=None):
+      Channel.__init__(self, name, creator, topic, stats, scrollback, history, directory)
+      self.bus = bus
+
+   def join(self, user):
+      joined = Channel.join(self, user)
+      if joined:
+         self.bus.send(("join", user.name, self.name, self.topic))
+      return joined
+
+   def part(self, user, message):
+      Channel.part(self, user, message)
+      self.bus.send(("part", user.name, self.name))
+
+   def write(self, message):
+      Channel.write(self, message)
+      self.bus.send(("chan", self.name, message))
+
+   def changed(self):
+      Channel.changed(self)
+      self.bus.send(("room", self.name, self.topic, self.private, self.token, [op.name for op in self.ops]))
+
+
+class CompactClusterChannel(ClusterChannel, CompactChannel):
+   __slots__ = ("bus",)
+
+
+class ClusterProtocol(ChatProtocol):
+   claiming = None #lines that arrive while the hub considers our name
+   gone = False
+
+   def lineReceived(self, line):
+      if self.state == "CLAIMING":
+         self.claiming.append(line)
+      else:
+         ChatProtocol.lineReceived(self, line)
+
+   def login(self, name):
+      if self.factory.compact:
+         name = intern(name)
+      self.state = "CLAIMING"
+      self.claiming = []
+      self.factory.bus.claim(name).addCallback(self.claimed, name)
+
+   def claimed(self, ok, name):
+      if self.gone:
+         if ok:
+            self.factory.bus.send(("logout", name))
+         return
+      if self.machine is not None and self.machine.claim is not None:
+         self.machine.claimed(lambda: self.decided(ok, name))
+      else:
+         self.decided(ok, name)
+      claiming, self.claiming = self.claiming, None
+      for line in claiming:
+         self.lineReceived(line)
+
+   def decided(self, ok, name):
+      if ok:
+         ChatProtocol.login(self, name)
+      else:
+         self.state = "LOGIN"
+         self.sendLine("Sorry, name taken.")
+
+   def connectionLost(self, reason):
+      self.gone = True
+      ChatProtocol.connectionLost(self, reason)
+      if self.me is not None:
+         self.factory.bus.send(("logout", self.me.name))
+
+
+class CompactClusterProtocol(ClusterProtocol, CompactChatProtocol):
+   __slots__ = ("claiming", "gone")
+
+   def __init__(self, users, channels, directory):
+      self.claiming, self.gone = None, False
+      CompactChatProtocol.__init__(self, users, channels, directory)
+
+
+class ClusterFactory(ChatFactory):
+   protocol, channel = ClusterProtocol, ClusterChannel
+   compact_classes = CompactClusterProtocol, CompactUser, CompactClusterChannel
+   #names interned here go to the hub and the other workers interned too, as marshal keeps track
+
+   def __init__(self, worker_id, **config):
+      ChatFactory.__init__(self, **config)
+      self.worker_id = worker_id
+      self.bus = None
+
+   def create_channel(self, name, creator, topic):
+      if self.compact:
+         name = intern(name)
+      return self.channel(name, creator, topic, self.bus, self.stats, self.scrollback, self.history, self.directory)
+
+   #what the other workers did, as relayed by the hub
+
+   def on_login(self, name, worker):
+      self.users[name] = RemoteUser(name, worker, self.bus)
+
+   def on_logout(self, name):
+      user = self.users.get(name)
+      if not isinstance(user, RemoteUser):
+         return
+      del self.users[name]
+      for room in user.channels:
+         room.users.discard(user)
+         room.relist()
+      for room in list(user.opped):
+         room.remove_op(user)
+      for room in user.channels:
+         self.vacated(room)
+
+   def on_join(self, name, room, topic):
+      user = self.users.get(name)
+      if not isinstance(user, RemoteUser):
+         return
+      channel = self.channels.get(room)
+      if channel is None:
+         channel = self.channels[room] = self.create_channel(room, user, topic)
+      channel.users.add(user)
+      user.channels.add(channel)
+      channel.relist()
+
+   def on_part(self, name, room):
+      user, channel = self.users.get(name), self.channels.get(room)
+      if isinstance(user, RemoteUser) and channel is not None:
+         channel.users.discard(user)
+         user.channels.discard(channel)
+         channel.relist()
+         self.vacated(channel)
+
+   def on_chan(self, room, message):
+      channel = self.channels.get(room)
+      if channel is not None:
+         Channel.write(channel, message) #just our own viewers, it has been published already
+
+   def on_room(self, room, topic, private, token, ops):
+      channel = self.channels.get(room)
+      if channel is None:
+         return
+      channel.topic, channel.private, channel.token = topic, private, token
+      for op in list(channel.ops):
+         channel.remove_op(op)
+      for name in ops:
+         if name in self.users:
+            channel.add_op(self.users[name])
+      channel.relist()
+
+   def on_to(self, name, message):
+      user = self.users.get(name)
+      if isinstance(user, User):
+         user.write(message)
+
+   def on_grant(self, name, room, token):
+      user = self.users.get(name)
+      if isinstance(user, User):
+         user.grant(room, token)
+
+
+class Bus(Int32StringReceiver):
+   #a worker's connection to the hub
+   MAX_LENGTH = 1 << 24
+
+   def __init__(self, factory):
+      self.factory = factory
+      self.claims = {}
+      self.last_claim = 0
+
+   def connectionMade(self):
+      self.send(("hello", self.factory.worker_id))
+
+   def send(self, event):
+      self.sendString(marshal.dumps(event))
+
+   def claim(self, name):
+      self.last_claim += 1
+      d = self.claims[self.last_claim] = Deferred()
+      self.send(("claim", self.last_claim, name))
+      return d
+
+   def stringReceived(self, data):
+      event = marshal.loads(data)
+      if event[0] == "claimed":
+         self.claims.pop(event[1]).callback(event[2])
+      else:
+         getattr(self.factory, "on_" + event[0])(*event[1:])
+
+   def connectionLost(self, reason):
+      #without the hub this worker's state can only drift from everyone else's
+      log.msg("Lost the hub: {0}".format(reason.getErrorMessage()))
+      if reactor.running:
+         reactor.stop()
+
+
+class HubProtocol(Int32StringReceiver):
+   MAX_LENGTH = 1 << 24
+   worker = None
+
+   def stringReceived(self, data):
+      self.factory.receive(self, data)
+
+   def connectionLost(self, reason):
+      self.factory.detach(self)
+
+
+class Hub(ServerFactory):
+   protocol = HubProtocol
+
+   def __init__(self):
+      self.links = []
+      self.names = {} #name -> the link of the worker they are on
+      self.folded = set() #the names in lowercase, since no two may differ only in case; see ChatProtocol.handle_LOGIN
+      self.joined = {} #name -> rooms they are in
+      self.members = {} #room -> {link: how many of that worker's users are in it}
+
+   def receive(self, link, data):
+      event = marshal.loads(data)
+      kind = event[0]
+      if kind == "hello":
+         link.worker = event[1]
+         self.links.append(link)
+      elif kind == "claim":
+         name = event[2]
+         ok = name.lower() not in self.folded
+         if ok:
+            self.names[name] = link
+            self.folded.add(name.lower())
+            self.joined[name] = set()
+            self.broadcast(link, marshal.dumps(("login", name, link.worker)))
+         link.sendString(marshal.dumps(("claimed", event[1], ok)))
+      elif kind == "chan":
+         for other in self.members.get(event[1], ()):
+            if other is not link:
+               other.sendString(data)
+      elif kind in ("to", "grant"):
+         owner = self.names.get(event[1])
+         if owner is not None:
+            owner.sendString(data)
+      else:
+         if kind == "join":
+            self.track(event[1], event[2], True)
+         elif kind == "part":
+            self.track(event[1], event[2], False)
+         elif kind == "logout":
+            if self.names.get(event[1]) is not link:
+               return
+            self.logout(event[1])
+         self.broadcast(link, data)
+
+   def broadcast(self, sender, data):
+      for link in self.links:
+         if link is not sender:
+            link.sendString(data)
+
+   def track(self, name, room, joining):
+      rooms = self.joined.get(name)
+      if rooms is None or (room in rooms) == joining:
+         return
+      counts = self.members.setdefault(room, {})
+      owner = self.names[name]
+      if joining:
+         rooms.add(room)
+         counts[owner] = counts.get(owner, 0) + 1
+      else:
+         rooms.discard(room)
+         counts[owner] -= 1
+         if counts[owner] == 0:
+            del counts[owner]
+            if not counts:
+               del self.members[room]
+
+   def logout(self, name):
+      for room in list(self.joined[name]):
+         self.track(name, room, False)
+      del self.joined[name]
+      del self.names[name]
+      self.folded.discard(name.lower())
+
+   def detach(self, link):
+      #a worker went away, and everyone on it with it
+      if link in self.links:
+         self.links.remove(link)
+      for name in [n for n, owner in self.names.items() if owner is link]:
+         self.logout(name)
+         self.broadcast(link, marshal.dumps(("logout", name)))
+
+
+class WorkerProcess(ProcessProtocol):
+   def __init__(self, worker_id):
+      self.worker_id = worker_id
+
+   def processEnded(self, reason):
+      log.msg("Worker {0} exited: {1}".format(self.worker_id, reason.getErrorMessage()))
+
+
+def worker(args):
+   factory = ClusterFactory(args.worker_id, **chat.factory_config(args))
+   def attached(bus):
+      factory.bus = bus
+      factory.port = reactor.adoptStreamPort(LISTEN_FD, socket.AF_INET, factory)
+      if args.metrics_port is not None:
+         chat.serve_metrics(args.metrics_port + args.worker_id, factory)
+   def failed(reason):
+      log.err(reason, "Couldn't reach the hub")
+      reactor.stop()
+   d = connectProtocol(UNIXClientEndpoint(reactor, args.hub), Bus(factory))
+   d.addCallbacks(attached, failed)
+   reactor.run()
+
+def supervise(args):
+   listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+   listener.bind(("", args.port))
+   listener.listen(args.backlog)
+   listener.setblocking(False)
+   path = os.path.join(tempfile.mkdtemp(prefix="die-"), "hub")
+   reactor.listenUNIX(path, Hub())
+   here = os.path.dirname(os.path.abspath(chat.__file__))
+   workers = []
+   for i in xrange(args.workers):
+      argv = [sys.executable, "-m", "chat"] + sys.argv[1:] + ["--hub", path, "--worker-id", str(i)]
+      workers.append(reactor.spawnProcess(WorkerProcess(i), sys.executable, argv, env=os.environ, path=here,
+                                          childFDs={0: 0, 1: 1, 2: 2, LISTEN_FD: listener.fileno()}))
+   def stop():
+      for process in workers:
+         if process.pid is not None:
+            process.signalProcess("TERM")
+   reactor.addSystemEventTrigger("before", "shutdown", stop)
+   reactor.addSystemEventTrigger("after", "shutdown", os.rmdir, os.path.dirname(path)) #the hub's port removes the socket
+   reactor.run()
+
+def main(args):
+   if args.hub is not None:
+      worker(args)
+   else:
+      supervise(args)
@@ -0,0 +1,142 @@
+"""Structured event logging that never makes the reactor wait. Run the server with `--event-log FILE` to use it.
+
+What the server does (connections, logins, commands, room writes, disconnects and why, and Twisted's own log
+messages) goes on an in-memory ring as (time, kind, values) tuples; adding one is a length check and an append, and
+nothing is formatted on the reactor thread. A thread of its own takes everything off the ring every `interval`
+seconds, or sooner once the ring is half full, turns it into one JSON object a line and writes it out in one go to
+FILE, which is rotated to FILE.1, FILE.2, ... every `rotate_bytes`, keeping `keep` of them.
+
+Chat lines and room writes come one per message said, so only one in `sample` of them is kept; those carry
+"sampled": N, so counts can be scaled back up. If the writer falls behind and the ring fills up, new events are
+dropped and counted rather than waiting for it, in `dropped`."""
+import threading
+from collections import deque
+from json.encoder import encode_basestring_ascii
+from time import time
+
+from twisted.python import log
+from twisted.python.logfile import LogFile
+
+#what each kind of event's values are called, in the order they're added in
+FIELDS = {"connect": ("conn", "peer"),
+          "login": ("conn", "name"),
+          "command": ("name", "command", "us"),
+          "chat": ("name", "room", "us"),
+          "fanout": ("room", "viewers", "us"),
+          "disconnect": ("conn", "name", "reason"),
+          "log": ("text",)}
+SAMPLED = ("chat", "fanout")
+#Each kind's line, to be filled in with the time and its values as JSON. Much quicker than building a dict for
+#json.dumps, which matters even in the writer thread: it holds the GIL while it works, and the reactor waits for it.
+LINES = dict((kind, '{"time":%.6f,"event":"' + kind + '"' + "".join(',"{0}":%s'.format(name) for name in names))
+             for kind, names in FIELDS.items())
+
+def peer(address):
+   #a twisted IAddress, a (host, port) from chat_loop, or None for a connection brought back from a snapshot
+   if address is None:
+      return None
+   if type(address) is tuple:
+      return "{0}:{1}".format(*address[:2])
+   return "{0}:{1}".format(getattr(address, "host", address), getattr(address, "port", ""))
+
+def literal(value):
+   #a string, int or None as JSON
+   if isinstance(value, basestring):
+      try:
+         return encode_basestring_ascii(value)
+      except UnicodeDecodeError: #a name or room that isn't UTF-8
+         return encode_basestring_ascii(value.decode("utf-8", "replace"))
+   if value is None:
+      return "null"
+   return str(value)
+
+
+class EventLog(object):
+   def __init__(self, path, size=1 << 16, sample=100, interval=0.5, rotate_bytes=64 << 20, keep=10):
+      self.path = path
+      self.size = size #most events waiting to be written
+      self.sample = max(1, sample)
+      self.interval = interval
+      self.rotate_bytes = rotate_bytes
+      self.keep = keep
+      self.ring = deque() #appended to by whichever thread logs, and emptied by the writer; both are atomic
+      self.counts = dict.fromkeys(SAMPLED, 0)
+      self.dropped = 0
+      self.written = 0
+      self.wake = threading.Event()
+      self.stopping = False
+      self.thread = None
+
+   def start(self):
+      self.file = LogFile.fromFullPath(self.path, rotateLength=self.rotate_bytes, maxRotatedFiles=self.keep)
+      self.thread = threading.Thread(target=self._run, name="events")
+      self.thread.daemon = True
+      self.thread.start()
+
+   def stop(self):
+      #write out what's left and close the file
+      if self.thread is None:
+         return
+      self.stopping = True
+      self.wake.set()
+      self.thread.join()
+      self.thread = None
+
+   def add(self, kind, *values):
+      ring = self.ring
+      n = len(ring)
+      if n >= self.size:
+         self.dropped += 1
+         return
+      ring.append((time(), kind, values))
+      if n == self.size >> 1:
+         self.wake.set()
+
+   def sampled(self, kind, *values):
+      #add one in every self.sample of these
+      n = self.counts[kind] = self.counts[kind] + 1
+      if n % self.sample == 0:
+         self.add(kind, *values)
+
+   def observe(self, event):
+      #a twisted.python.log observer, so the server's log messages come here instead of going to stdout
+      self.add("log", event)
+
+   #the rest runs in the writer thread
+
+   def _run(self):
+      while True:
+         self.wake.wait(self.interval)
+         self.wake.clear()
+         stopping = self.stopping #checked first, so nothing added before stop is left behind
+         self._write()
+         if stopping:
+            break
+      self.file.close()
+
+   def _write(self):
+      ring, lines = self.ring, []
+      for i in xrange(len(ring)): #what's there now; anything added meanwhile waits for the next batch
+         line = self._format(*ring.popleft())
+         if line is not None:
+            lines.append(line)
+      if lines:
+         self.file.write("\n".join(lines) + "\n")
+         self.file.flush()
+         self.written += len(lines)
+
+   def _format(self, when, kind, values):
+      if kind == "log":
+         event, = values
+         text = log.textFromEventDict(event)
+         if text is None: #nothing to say, e.g. a bare log.msg()
+            return None
+         return LINES[kind] % (when, literal(text)) + (',"error":true}' if event.get("isError") else "}")
+      if kind == "connect":
+         values = (values[0], peer(values[1]))
+      elif kind == "disconnect" and isinstance(values[2], BaseException):
+         values = values[:2] + ("{0}: {1}".format(type(values[2]).__name__, values[2]),)
+      line = LINES[kind] % ((when,) + tuple(map(literal, values)))
+      if kind in SAMPLED and self.sample > 1:
+         return line + ',"sampled":{0}}}'.format(self.sample)
+      return line + "}"
@@ -0,0 +1,272 @@
+"""Room history on disk, for /history. Run the server with `--history-dir DIR` to keep it.
+
+Each room gets a directory of segments. A segment is a pair of preallocated, memory-mapped files named after the
+sequence number of its first line: NNN.log holds the lines themselves, each as (time, length, text), and NNN.idx holds a
+count followed by (time, offset) for every line in the .log. Finding a line by number is a bisect over the segments and
+one index lookup; finding the first line after a time is a bisect over the segments' first times and then a binary
+search of one index. Only the pages that are actually read get loaded. Once a segment is full the next one is started,
+and the oldest are deleted beyond `keep` segments per room. Only the segment being written to stays mapped, and only
+for the `open_logs` rooms used most recently; the files themselves are closed as soon as they're mapped, so a room
+costs two file descriptors (the maps') while it's open and none after.
+
+Everything that touches the files happens in one thread of its own, so the reactor only ever queues work for it:
+lines said in the same reactor turn go over in one batch, and a query is queued behind every line said before it."""
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from collections import OrderedDict
+from urllib import quote
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+RECORD = struct.Struct("<dI") #in the .log: when, how many bytes of text follow
+ENTRY = struct.Struct("<dI") #in the .idx: when, offset of the record in the .log
+COUNT = struct.Struct("<Q") #at the start of the .idx: how many entries are valid
+
+
+class Segment(object):
+   def __init__(self, path, first, size, writable=True):
+      self.path = path
+      self.first = first
+      self.size = size
+      self.capacity = max(1, size // 32) #index entries, assuming lines average at least 32 bytes
+      self.data = self._map(path + ".log", size, writable)
+      self.index = self._map(path + ".idx", COUNT.size + self.capacity * ENTRY.size, writable)
+      if not writable: #as it was written, which may have been with another size
+         self.capacity = (len(self.index) - COUNT.size) // ENTRY.size
+      self.count = min(COUNT.unpack_from(self.index, 0)[0], self.capacity)
+      self.end = 0
+      if self.count:
+         offset = self.offset(self.count - 1)
+         self.end = offset + RECORD.size + RECORD.unpack_from(self.data, offset)[1]
+
+   def _map(self, path, size, writable):
+      #the map keeps a descriptor of its own, so the file can be closed straight away
+      if writable:
+         with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            if os.fstat(f.fileno()).st_size < size:
+               f.truncate(size)
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+      with open(path, "rb") as f:
+         return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+   def fits(self, length):
+      return self.count < self.capacity and self.end + RECORD.size + length <= self.size
+
+   def append(self, when, message):
+      offset = self.end
+      RECORD.pack_into(self.data, offset, when, len(message))
+      start = offset + RECORD.size
+      self.data[start:start + len(message)] = message
+      ENTRY.pack_into(self.index, COUNT.size + self.count * ENTRY.size, when, offset)
+      self.count += 1
+      COUNT.pack_into(self.index, 0, self.count) #last, so a crash mid-append leaves the line out rather than half in
+      self.end = start + len(message)
+
+   def when(self, i):
+      return ENTRY.unpack_from(self.index, COUNT.size + i * ENTRY.size)[0]
+
+   def offset(self, i):
+      return ENTRY.unpack_from(self.index, COUNT.size + i * ENTRY.size)[1]
+
+   def read(self, i):
+      offset = self.offset(i)
+      when, length = RECORD.unpack_from(self.data, offset)
+      start = offset + RECORD.size
+      return when, self.data[start:start + length]
+
+   def find(self, when):
+      #the first line at or after when
+      lo, hi = 0, self.count
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self.when(mid) < when:
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def close(self):
+      self.data.close()
+      self.index.close()
+
+
+class RoomLog(object):
+   #one room's segments. Only ever used from the history thread.
+   def __init__(self, directory, size, keep):
+      self.directory = directory
+      self.size = size
+      self.keep = keep
+      if not os.path.isdir(directory):
+         os.makedirs(directory)
+      self.firsts = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+      self.times = [] #the time of the first line in each full segment, filled in as they are needed
+      if self.firsts:
+         self.current = Segment(self._path(self.firsts[-1]), self.firsts[-1], size)
+      else:
+         self.current = self._start(0)
+
+   def _path(self, first):
+      return os.path.join(self.directory, "%020d" % first)
+
+   def _start(self, first):
+      self.firsts.append(first)
+      return Segment(self._path(first), first, self.size)
+
+   def append(self, when, message):
+      if not self.current.fits(len(message)):
+         self.current.close()
+         self.current = self._start(self.current.first + self.current.count)
+         while len(self.firsts) > self.keep:
+            path = self._path(self.firsts.pop(0))
+            os.remove(path + ".log")
+            os.remove(path + ".idx")
+            self.times = []
+      self.current.append(when, message)
+
+   def next(self):
+      return self.current.first + self.current.count
+
+   def _segment(self, first):
+      if first == self.current.first:
+         return self.current
+      return Segment(self._path(first), first, self.size, writable=False)
+
+   def read(self, start, stop):
+      #lines start up to stop, as (number, when, text)
+      start = max(start, self.firsts[0])
+      lines = []
+      while start < stop:
+         first = self.firsts[bisect_right(self.firsts, start) - 1]
+         segment = self._segment(first)
+         end = min(stop, first + segment.count)
+         for seq in xrange(start, end):
+            when, message = segment.read(seq - first)
+            lines.append((seq, when, message))
+         if segment is not self.current:
+            segment.close()
+         if end <= start: #a segment left short by a crash, so skip to the next one
+            later = bisect_right(self.firsts, start)
+            if later == len(self.firsts):
+               break
+            end = self.firsts[later]
+         start = end
+      return lines
+
+   def find(self, when):
+      for first in self.firsts[len(self.times):-1]: #the first time in each full segment never changes, so keep it
+         segment = self._segment(first)
+         self.times.append(segment.when(0) if segment.count else 0)
+         segment.close()
+      times = self.times + [self.current.when(0) if self.current.count else float("inf")]
+      i = max(0, bisect_right(times, when) - 1)
+      segment = self._segment(self.firsts[i])
+      seq = segment.first + segment.find(when)
+      if segment is not self.current:
+         segment.close()
+      return seq
+
+   def last(self, n, before=None):
+      stop = self.next() if before is None else min(before, self.next())
+      return self.read(max(0, stop - n), stop)
+
+   def since(self, when, n, after=None):
+      start = self.find(when) if after is None else after + 1
+      return self.read(start, min(start + n, self.next()))
+
+   def close(self):
+      self.current.close()
+
+
+class History(object):
+   def __init__(self, directory, segment_size=4 << 20, keep=64, clock=reactor, open_logs=128):
+      self.directory = directory
+      self.segment_size = max(segment_size, 1 << 16) #always room for the longest line
+      self.keep = keep
+      self.clock = clock
+      self.open_logs = max(1, open_logs) #most RoomLogs kept open; the rest are closed, least recently used first
+      self.logs = OrderedDict() #room name -> RoomLog, least recently used first, for the history thread only
+      self.pending = []
+      self.flushing = None
+      self.pool = ThreadPool(1, 1, "history")
+      self.pool.start()
+
+   def open(self, name):
+      return RoomHistory(self, name)
+
+   def append(self, name, when, message):
+      self.pending.append((name, when, message))
+      if self.flushing is None:
+         self.flushing = self.clock.callLater(0, self.flush)
+
+   def flush(self):
+      if self.flushing is not None:
+         if self.flushing.active():
+            self.flushing.cancel()
+         self.flushing = None
+      if self.pending:
+         self.pool.callInThread(self._write, self.pending)
+         self.pending = []
+
+   def query(self, name, method, *args):
+      self.flush()
+      return deferToThreadPool(reactor, self.pool, self._query, name, method, args)
+
+   def close(self):
+      self.flush()
+      self.pool.stop()
+      for room in self.logs.values():
+         room.close()
+      self.logs = OrderedDict()
+
+   #the rest runs in the history thread
+
+   def _log(self, name):
+      room = self.logs.pop(name, None)
+      if room is None:
+         if len(self.logs) >= self.open_logs:
+            self.logs.popitem(last=False)[1].close()
+         room = RoomLog(os.path.join(self.directory, directory_name(name)), self.segment_size, self.keep)
+      self.logs[name] = room #to the most recently used end
+      return room
+
+   def _close(self, name):
+      room = self.logs.pop(name, None)
+      if room is not None:
+         room.close()
+
+   def _write(self, batch):
+      for name, when, message in batch:
+         self._log(name).append(when, message)
+
+   def _query(self, name, method, args):
+      return getattr(self._log(name), method)(*args)
+
+
+def directory_name(name):
+   #a room's directory under the history directory: quoted, dots too, so that rooms called . and .. stay inside it
+   return quote(name, "").replace(".", "%2E")
+
+
+class RoomHistory(object):
+   #a room's log, from the reactor's side: the same last/since as chat.Scrollback, but answered from disk
+   def __init__(self, history, name):
+      self.history = history
+      self.name = name
+
+   def append(self, when, message):
+      self.history.append(self.name, when, message)
+
+   def last(self, n, before=None):
+      return self.history.query(self.name, "last", n, before)
+
+   def since(self, when, n, after=None):
+      return self.history.query(self.name, "since", when, n, after)
+
+   def close(self):
+      #the room is gone; its files stay for when it comes back
+      self.history.flush()
+      self.history.pool.callInThread(self.history._close, self.name)
@@ -0,0 +1,348 @@
+"""Load generator for the chat server. It opens real TCP connections, logs them all in and drives them through a
+scenario, then reports connection and login rates, lines delivered per second, delivery latency and the server's
+memory. For example:
+
+   python chat_load.py --spawn --clients 2000 bigroom
+   python chat_load.py --spawn --workers 4 --processes 4 --clients 8000 smallrooms --json
+
+Scenarios:
+   login       just connect and log everyone in
+   join        log everyone in, then have them all join one room at once
+   bigroom     everyone in one room, --talkers of them talking
+   smallrooms  rooms of --room-size, random people talking
+   msg         private messages between random pairs
+   churn       smallrooms, while --churn people a second /quit, reconnect and rejoin
+
+Every line sent carries the time it was sent, so each client that receives one records how long it took to arrive.
+Latencies go into the server's own log-spaced histogram, in microseconds, which is what lets --processes split the
+clients over several processes and still add the results up. With --json the report is a single JSON object, for
+keeping track of releases."""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore, inlineCallbacks
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from twisted.protocols.basic import LineOnlyReceiver
+
+from chat import Histogram
+
+STAMP = "@@" #marks the send time in a line
+SCENARIOS = ("login", "join", "bigroom", "smallrooms", "msg", "churn")
+
+
+class LoadClient(LineOnlyReceiver):
+   MAX_LENGTH = 1 << 20
+
+   def __init__(self, run, name):
+      self.run = run
+      self.name = name
+      self.waiting = None #(prefixes, Deferred) for the reply we're waiting on
+      self.joined = 0 #when we last sent /join
+      self.closed = Deferred()
+
+   def lineReceived(self, line):
+      if self.waiting is not None and line.startswith(self.waiting[0]):
+         d, self.waiting = self.waiting[1], None
+         d.callback(line)
+      i = line.find(STAMP)
+      if i >= 0:
+         sent = float(line[i + len(STAMP):].rstrip('"'))
+         if sent >= self.joined: #older ones are the room's scrollback, replayed when we joined, not deliveries
+            self.run.delivered(sent)
+
+   def connectionLost(self, reason):
+      if self.waiting is not None: #e.g. refused by the server's admission control
+         d, self.waiting = self.waiting[1], None
+         d.errback(reason)
+      self.closed.callback(None)
+
+   def expect(self, *prefixes):
+      d = Deferred()
+      self.waiting = (prefixes, d)
+      return d
+
+   def login(self):
+      d = self.expect("Welcome", "Sorry")
+      self.sendLine(self.name)
+      return d
+
+   def join(self, room):
+      d = self.expect("end of list", "Failed")
+      self.joined = time.time()
+      self.sendLine("/join " + room)
+      return d
+
+   def say(self):
+      self.sendLine("{0}{1:.6f}".format(STAMP, time.time()))
+
+   def msg(self, other):
+      self.sendLine("/msg {0} {1}{2:.6f}".format(other, STAMP, time.time()))
+
+
+class Run(object):
+   def __init__(self, args, indices):
+      self.args = args
+      self.indices = indices #which of the --clients this process drives
+      self.endpoint = TCP4ClientEndpoint(reactor, args.host, args.port, timeout=30)
+      self.clients = {}
+      self.latency = Histogram()
+      self.errors = 0
+      self.sent = 0
+      self.received = 0
+      self.window = None #(start, end) of the measurement
+
+   def name(self, i):
+      return "load{0}".format(i)
+
+   def room(self, i):
+      if self.args.scenario in ("smallrooms", "churn"):
+         return "room{0}".format(i // self.args.room_size)
+      return "big"
+
+   def connect(self, i):
+      client = LoadClient(self, self.name(i))
+      return connectProtocol(self.endpoint, client).addCallback(lambda _: self.clients.__setitem__(i, client))
+
+   def login(self, i):
+      #a name can still be taken for a moment after a churned client's /quit
+      def done(line):
+         if line.startswith("Sorry"):
+            return task.deferLater(reactor, 0.05, self.clients[i].login).addCallback(done)
+      return self.clients[i].login().addCallback(done)
+
+   def storm(self, action):
+      #do action for every index, with at most --concurrency in flight
+      sem = DeferredSemaphore(self.args.concurrency)
+      def failed(reason):
+         self.errors += 1
+      start = time.time()
+      d = DeferredList([sem.run(action, i).addErrback(failed) for i in self.indices])
+      return d.addCallback(lambda _: time.time() - start)
+
+   def delivered(self, sent):
+      now = time.time()
+      if self.window is not None and self.window[0] <= sent and now <= self.window[1] + self.args.grace:
+         self.received += 1
+         self.latency.add(int((now - sent) * 1e6))
+
+   def talk(self, rate, act):
+      #call act() rate times a second in total, checking every 10ms, until the window closes
+      owed, last = [0.0], [time.time()]
+      def tick():
+         now = time.time()
+         if now > self.window[1]:
+            loop.stop()
+            return
+         owed[0] += rate * (now - last[0])
+         last[0] = now
+         while owed[0] >= 1:
+            owed[0] -= 1
+            act()
+      loop = task.LoopingCall(tick)
+      return loop.start(0.01)
+
+   def anyone(self):
+      #a random client that is connected right now, or None if they have all gone
+      for attempt in xrange(10):
+         client = self.clients.get(random.choice(self.indices))
+         if client is not None:
+            return client
+      if self.clients: #most of them are between a /quit and coming back
+         return random.choice(self.clients.values())
+      return None
+
+   def say_anywhere(self):
+      client = self.anyone()
+      if client is None:
+         return False
+      client.say()
+
+   def churn(self, i):
+      client = self.clients.pop(i, None)
+      if client is None:
+         return
+      client.sendLine("/quit churn")
+      def back(_):
+         return self.connect(i).addCallback(lambda _: self.login(i)).addCallback(lambda _: self.clients[i].join(self.room(i)))
+      def failed(reason):
+         self.errors += 1
+      client.closed.addCallback(back).addErrback(failed)
+
+   def churn_anyone(self):
+      if self.clients: #every one of them can be between a /quit and coming back
+         self.churn(random.choice(list(self.clients)))
+
+   @inlineCallbacks
+   def go(self):
+      args, report = self.args, {}
+      connecting = yield self.storm(self.connect)
+      report["connect_per_sec"] = len(self.clients) / connecting
+      logging_in = yield self.storm(self.login)
+      report["login_per_sec"] = len(self.clients) / logging_in
+      if args.scenario != "login":
+         joining = yield self.storm(lambda i: self.clients[i].join(self.room(i)))
+         report["join_per_sec"] = len(self.clients) / joining
+      if args.scenario in ("bigroom", "smallrooms", "msg", "churn"):
+         self.window = (time.time(), time.time() + args.duration)
+         talkers = sorted(self.clients)[:args.talkers] if args.scenario == "bigroom" else sorted(self.clients)
+         if args.scenario == "msg":
+            names = [self.name(i) for i in xrange(args.clients)]
+            act = lambda: self.clients[random.choice(talkers)].msg(random.choice(names))
+         elif args.scenario == "bigroom":
+            act = lambda: self.clients[random.choice(talkers)].say()
+         else:
+            act = self.say_anywhere
+         sending = [self.talk(args.rate, self.count(act))]
+         if args.scenario == "churn":
+            sending.append(self.talk(args.churn, self.churn_anyone))
+         yield DeferredList(sending)
+         yield task.deferLater(reactor, args.grace, lambda: None)
+         report["sent_per_sec"] = self.sent / float(args.duration)
+         report["delivered_per_sec"] = self.received / float(args.duration)
+      report["clients"] = len(self.clients)
+      report["errors"] = self.errors
+      report["latency"] = {"counts": self.latency.counts, "max": self.latency.max}
+      for c in self.clients.values():
+         c.transport.loseConnection()
+      self.report = report
+
+   def count(self, act):
+      def counted():
+         if act() is not False:
+            self.sent += 1
+      return counted
+
+
+def server_rss(pid):
+   #resident memory of pid and every process under it, in bytes
+   parents = {}
+   for entry in os.listdir("/proc"):
+      if entry.isdigit():
+         try:
+            with open("/proc/{0}/stat".format(entry)) as f:
+               parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+         except (IOError, IndexError):
+            pass
+   family, total = set([pid]), 0
+   for p in sorted(parents):
+      if parents[p] in family:
+         family.add(p)
+   for p in family:
+      try:
+         with open("/proc/{0}/statm".format(p)) as f:
+            total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+      except IOError:
+         pass
+   return total
+
+def spawn_server(args):
+   here = os.path.dirname(os.path.abspath(__file__))
+   with open(os.devnull, "w") as quiet:
+      server = subprocess.Popen([sys.executable, os.path.join(here, "chat.py"), "--port", str(args.port),
+                                 "--workers", str(args.workers), "--backend", args.backend], stdout=quiet,
+                                stderr=subprocess.STDOUT)
+   import socket
+   for attempt in xrange(100):
+      try:
+         socket.create_connection((args.host, args.port)).close()
+         return server
+      except socket.error:
+         time.sleep(0.1)
+   server.kill()
+   raise SystemExit("The server didn't come up.")
+
+def run_clients(args, indices):
+   run = Run(args, indices)
+   d = run.go()
+   def done(result):
+      reactor.stop()
+      return result
+   failures = []
+   d.addErrback(failures.append).addBoth(done)
+   reactor.run()
+   if failures:
+      failures[0].raiseException()
+   return run.report
+
+def combine(reports):
+   #add up what several client processes measured
+   total = {"latency": Histogram()}
+   for report in reports:
+      for key, value in report.items():
+         if key == "latency":
+            latency = Histogram()
+            latency.counts = dict((int(bucket), n) for bucket, n in value["counts"].items()) #JSON made the keys strings
+            latency.max = value["max"]
+            total["latency"].merge(latency)
+         elif key.endswith("_per_sec") or key in ("clients", "errors"):
+            total[key] = total.get(key, 0) + value
+   return total
+
+def options():
+   parser = ArgumentParser(description="Generate load against a chat server.")
+   parser.add_argument("scenario", choices=SCENARIOS)
+   parser.add_argument("--host", default="127.0.0.1")
+   parser.add_argument("--port", type=int, default=9399)
+   parser.add_argument("--spawn", action="store_true", help="start a server (chat.py) for the run and stop it after")
+   parser.add_argument("--workers", type=int, default=1, help="worker processes for a --spawn'ed server")
+   parser.add_argument("--backend", choices=("twisted", "loop"), default="twisted", help="the event loop for a --spawn'ed server")
+   parser.add_argument("--server-pid", type=int, help="report the memory of this already running server")
+   parser.add_argument("--clients", type=int, default=1000)
+   parser.add_argument("--processes", type=int, default=1, help="split the clients over this many processes")
+   parser.add_argument("--concurrency", type=int, default=200, help="most connects, logins or joins in flight at once")
+   parser.add_argument("--duration", type=float, default=10.0, help="seconds of talking to measure")
+   parser.add_argument("--grace", type=float, default=1.0, help="seconds to wait for lines still in flight")
+   parser.add_argument("--rate", type=float, default=100.0, help="lines sent per second, in total")
+   parser.add_argument("--talkers", type=int, default=10, help="how many people talk in bigroom")
+   parser.add_argument("--room-size", type=int, default=10)
+   parser.add_argument("--churn", type=float, default=10.0, help="quits and rejoins per second in churn")
+   parser.add_argument("--json", action="store_true", help="print the report as JSON")
+   parser.add_argument("--slice", type=int, help="internal: run every --processes'th client starting here")
+   return parser
+
+def main(argv):
+   args = options().parse_args(argv[1:])
+   soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+   resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+   if args.slice is not None:
+      print(json.dumps(run_clients(args, range(args.slice, args.clients, args.processes))))
+      return 0
+   server = spawn_server(args) if args.spawn else None
+   pid = server.pid if server is not None else args.server_pid
+   try:
+      if args.processes == 1:
+         report = combine([run_clients(args, range(args.clients))])
+      else:
+         children = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv[1:] + ["--slice", str(i)],
+                                      stdout=subprocess.PIPE) for i in xrange(args.processes)]
+         report = combine([json.loads(child.communicate()[0]) for child in children])
+      if pid is not None:
+         report["server_rss_bytes"] = server_rss(pid)
+   finally:
+      if server is not None:
+         server.terminate()
+         server.wait()
+   latency = report.pop("latency")
+   for key in report:
+      if key.endswith("_per_sec"):
+         report[key] = round(report[key], 1)
+   report.update(scenario=args.scenario, processes=args.processes, workers=args.workers if args.spawn else None,
+                 latency_ms=dict(("p" + str(p).replace(".", ""), round(latency.percentile(p) / 1000.0, 3))
+                                 for p in (50, 99, 99.9)) if latency.n else None)
+   if args.json:
+      print(json.dumps(report, sort_keys=True))
+   else:
+      print(args.scenario)
+      for key in sorted(report):
+         print("   {0}: {1}".format(key, report[key]))
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv))
@@ -0,0 +1,438 @@
+"""Run the chat server on an asyncio-style event loop instead of Twisted's reactor, e.g. `python chat.py --backend loop`.
+
+Rooms, users, commands and the line handling in chat.ChatProtocol don't depend on what carries the bytes: a
+ChatProtocol only calls write, writeSequence, loseConnection, abortConnection and pause/resumeProducing on its
+transport, and callLater and seconds on the factory's clock. This module provides those over asyncio's interfaces:
+
+ * StreamProtocol is an asyncio Protocol that drives a ChatProtocol. asyncio's write flow control
+   (pause_writing/resume_writing) takes the place of Twisted's push producer.
+ * LoopClock makes a loop's call_later look like a reactor's callLater, for the factory's timers
+
+Python 2 has no asyncio, so SelectLoop provides the part of an asyncio event loop that the server needs: call_soon,
+call_later, create_server and run_forever, over select.poll, with transports to match. StreamProtocol and LoopClock
+use nothing else of it, so an asyncio loop could take its place.
+
+Cluster workers, --history-dir and --metrics-port still need the reactor."""
+import errno
+import heapq
+import select
+import signal
+import socket
+from collections import deque
+from itertools import count
+from time import time
+
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled, ConnectionDone
+from twisted.python import failure, log
+
+import chat
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class TransportAdapter(object):
+   #the Twisted transport a ChatProtocol expects, over an asyncio one
+   disconnecting = False
+
+   def __init__(self, transport):
+      self.transport = transport
+
+   def write(self, data):
+      self.transport.write(data)
+
+   def writeSequence(self, seq):
+      self.transport.writelines(seq)
+
+   def loseConnection(self):
+      self.disconnecting = True
+      self.transport.close()
+
+   def abortConnection(self):
+      self.disconnecting = True
+      self.transport.abort()
+
+   def pauseProducing(self):
+      self.transport.pause_reading()
+
+   def resumeProducing(self):
+      self.transport.resume_reading()
+
+   def registerProducer(self, producer, streaming):
+      pass #the asyncio transport tells StreamProtocol when to pause, and it tells the ChatProtocol
+
+   def unregisterProducer(self):
+      pass
+
+
+class StreamProtocol(object):
+   #an asyncio Protocol for one connection, which hands everything to a ChatProtocol from the factory
+   def __init__(self, factory):
+      self.factory = factory
+      self.chat = None
+
+   def connection_made(self, transport):
+      self.transport = TransportAdapter(transport)
+      self.chat = self.factory.buildProtocol(transport.get_extra_info("peername"))
+      if self.chat is None: #refused, see ChatFactory.refuse
+         return transport.abort()
+      self.chat.makeConnection(self.transport)
+
+   def data_received(self, data):
+      self.chat.dataReceived(data)
+
+   def eof_received(self):
+      return False #close
+
+   def pause_writing(self):
+      self.chat.pauseProducing()
+
+   def resume_writing(self):
+      self.chat.resumeProducing()
+
+   def connection_lost(self, exc):
+      if self.chat is not None:
+         self.chat.connectionLost(failure.Failure(exc if exc is not None else ConnectionDone()))
+
+
+class LoopCall(object):
+   #IDelayedCall over a loop's call_later
+   def __init__(self, loop, delay, f, args, kw):
+      self.loop = loop
+      self.f, self.args, self.kw = f, args, kw
+      self.called = self.cancelled = False
+      self.schedule(delay)
+
+   def schedule(self, delay):
+      self.time = self.loop.time() + delay
+      self.handle = self.loop.call_later(delay, self.run)
+
+   def run(self):
+      self.called = True
+      self.f(*self.args, **self.kw)
+
+   def getTime(self):
+      return self.time
+
+   def active(self):
+      return not (self.called or self.cancelled)
+
+   def cancel(self):
+      if self.cancelled:
+         raise AlreadyCancelled()
+      if self.called:
+         raise AlreadyCalled()
+      self.cancelled = True
+      self.handle.cancel()
+
+   def reset(self, delay):
+      if not self.active():
+         raise AlreadyCalled()
+      self.handle.cancel()
+      self.schedule(delay)
+
+   def delay(self, seconds):
+      self.reset(self.time + seconds - self.loop.time())
+
+
+class LoopClock(object):
+   #IReactorTime over an asyncio loop, for ChatFactory(clock=...) and the LoopingCalls it makes
+   def __init__(self, loop):
+      self.loop = loop
+
+   def seconds(self):
+      return self.loop.time()
+
+   def callLater(self, delay, f, *args, **kw):
+      return LoopCall(self.loop, delay, f, args, kw)
+
+
+class Handle(object):
+   def __init__(self, callback, args):
+      self.callback = callback
+      self.args = args
+      self.cancelled = False
+
+   def cancel(self):
+      self.cancelled = True
+
+   def run(self):
+      try:
+         self.callback(*self.args)
+      except Exception:
+         log.err(None, "Unhandled error in {0!r}".format(self.callback))
+
+
+class SelectLoop(object):
+   #As much of an asyncio event loop as the server uses. Each turn polls the sockets, for no longer than until the
+   #next timer is due, handles whatever is ready on them and then runs the callbacks that are due. Last, it sends what
+   #was written in the turn, one send a socket, as the reactor does; asyncio's own send on every write would cost a
+   #system call for every line to every member of a room.
+   def __init__(self):
+      self.ready = deque()
+      self.unflushed = [] #the SocketTransports written to this turn
+      self.scheduled = [] #a heap of (when, tiebreak, Handle)
+      self.order = count()
+      self.poller = select.poll()
+      self.readers = {}
+      self.writers = {}
+      self.running = False
+
+   def time(self):
+      return time()
+
+   def call_soon(self, callback, *args):
+      handle = Handle(callback, args)
+      self.ready.append(handle)
+      return handle
+
+   def call_later(self, delay, callback, *args):
+      handle = Handle(callback, args)
+      heapq.heappush(self.scheduled, (self.time() + delay, next(self.order), handle))
+      return handle
+
+   def add_reader(self, fd, callback):
+      self.readers[fd] = callback
+      self._update(fd)
+
+   def remove_reader(self, fd):
+      self.readers.pop(fd, None)
+      self._update(fd)
+
+   def add_writer(self, fd, callback):
+      self.writers[fd] = callback
+      self._update(fd)
+
+   def remove_writer(self, fd):
+      self.writers.pop(fd, None)
+      self._update(fd)
+
+   def _update(self, fd):
+      events = (select.POLLIN if fd in self.readers else 0) | (select.POLLOUT if fd in self.writers else 0)
+      if events:
+         self.poller.register(fd, events)
+      else:
+         try:
+            self.poller.unregister(fd)
+         except KeyError:
+            pass
+
+   def create_server(self, protocol_factory, host, port, backlog=100):
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((host, port))
+      sock.listen(backlog)
+      sock.setblocking(0)
+      return Server(self, sock, protocol_factory)
+
+   def run_forever(self):
+      self.running = True
+      while self.running:
+         self.run_once()
+
+   def stop(self):
+      self.running = False
+
+   def run_once(self, timeout=None):
+      if self.ready:
+         timeout = 0
+      elif self.scheduled:
+         wait = max(0, self.scheduled[0][0] - self.time())
+         timeout = wait if timeout is None else min(timeout, wait)
+      try:
+         events = self.poller.poll(None if timeout is None else int(timeout * 1000 + 0.999))
+      except select.error as e:
+         if e.args[0] != errno.EINTR:
+            raise
+         events = []
+      for fd, event in events:
+         #a callback can close other sockets, so look each one up again
+         if event & (select.POLLIN | select.POLLHUP | select.POLLERR) and fd in self.readers:
+            Handle(self.readers[fd], ()).run()
+         if event & (select.POLLOUT | select.POLLHUP | select.POLLERR) and fd in self.writers:
+            Handle(self.writers[fd], ()).run()
+      now = self.time()
+      while self.scheduled and self.scheduled[0][0] <= now:
+         self.ready.append(heapq.heappop(self.scheduled)[2])
+      for i in xrange(len(self.ready)): #not what these schedule with call_soon, which waits for the next turn
+         handle = self.ready.popleft()
+         if not handle.cancelled:
+            handle.run()
+      unflushed, self.unflushed = self.unflushed, []
+      for transport in unflushed:
+         transport.flush()
+
+
+class Server(object):
+   def __init__(self, loop, sock, protocol_factory):
+      self.loop = loop
+      self.sockets = [sock]
+      self.protocol_factory = protocol_factory
+      loop.add_reader(sock.fileno(), self.accept)
+
+   def accept(self):
+      sock = self.sockets[0]
+      for i in xrange(100): #at most this many at a time, so a storm of connections can't starve everyone else
+         try:
+            conn, addr = sock.accept()
+         except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+               log.msg("Could not accept a connection: {0}".format(e))
+            return
+         conn.setblocking(0)
+         SocketTransport(self.loop, conn, self.protocol_factory())
+
+   def close(self):
+      for sock in self.sockets:
+         self.loop.remove_reader(sock.fileno())
+         sock.close()
+      self.sockets = []
+
+
+class SocketTransport(object):
+   #The server's end of one connection, as an asyncio Transport. Writes are buffered until the end of the loop's turn,
+   #and then for as long as the socket won't take them; past high bytes buffered the protocol is told to
+   #pause_writing, and to resume_writing once the buffer is back down to low.
+   def __init__(self, loop, sock, protocol, high=64 << 10, low=16 << 10):
+      self.loop = loop
+      self.sock = sock
+      self.fd = sock.fileno()
+      self.protocol = protocol
+      self.high, self.low = high, low
+      self.buffer = deque()
+      self.buffered = 0
+      self.reading = True
+      self.closing = False
+      self.paused = False
+      loop.add_reader(self.fd, self.read_ready)
+      loop.call_soon(protocol.connection_made, self)
+
+   def get_extra_info(self, name, default=None):
+      if name == "socket":
+         return self.sock
+      if name == "peername" and self.sock is not None:
+         try:
+            return self.sock.getpeername()
+         except socket.error:
+            pass
+      return default
+
+   def is_closing(self):
+      return self.closing
+
+   def get_write_buffer_size(self):
+      return self.buffered
+
+   def read_ready(self):
+      try:
+         data = self.sock.recv(65536)
+      except socket.error as e:
+         if e.args[0] not in WOULD_BLOCK:
+            self.fail(e)
+         return
+      if data:
+         try:
+            self.protocol.data_received(data)
+         except Exception:
+            log.err(None, "Unhandled error from a connection")
+            self.abort()
+      elif not self.protocol.eof_received():
+         self.close()
+
+   def write(self, data):
+      if self.closing or not data:
+         return
+      if not self.buffer: #otherwise it's already waiting for the end of the turn, or for the socket
+         self.loop.unflushed.append(self)
+      self.buffer.append(data)
+      self.buffered += len(data)
+      if not self.paused and self.buffered > self.high:
+         self.paused = True
+         self.protocol.pause_writing()
+
+   def writelines(self, lines):
+      self.write("".join(lines))
+
+   def flush(self):
+      #the end of the turn they were written in
+      if self.sock is not None and self.buffer:
+         self.write_ready()
+         if self.buffered and self.fd not in self.loop.writers:
+            self.loop.add_writer(self.fd, self.write_ready)
+
+   def write_ready(self):
+      data = "".join(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+      try:
+         sent = self.sock.send(data)
+      except socket.error as e:
+         if e.args[0] not in WOULD_BLOCK:
+            self.fail(e)
+         return
+      self.buffer.clear()
+      self.buffered = len(data) - sent
+      if self.buffered:
+         self.buffer.append(data[sent:])
+      else:
+         if self.fd in self.loop.writers:
+            self.loop.remove_writer(self.fd)
+         if self.closing:
+            return self.finish(None)
+      if self.paused and self.buffered <= self.low:
+         self.paused = False
+         self.protocol.resume_writing()
+
+   def pause_reading(self):
+      if self.reading and not self.closing:
+         self.reading = False
+         self.loop.remove_reader(self.fd)
+
+   def resume_reading(self):
+      if not self.reading and not self.closing:
+         self.reading = True
+         self.loop.add_reader(self.fd, self.read_ready)
+
+   def close(self):
+      #once what is buffered has been sent
+      if self.closing:
+         return
+      self.closing = True
+      self.loop.remove_reader(self.fd)
+      if not self.buffer:
+         self.loop.call_soon(self.finish, None)
+
+   def abort(self):
+      self.fail(None)
+
+   def fail(self, exc):
+      self.closing = True
+      self.buffer.clear()
+      self.buffered = 0
+      self.loop.remove_reader(self.fd)
+      self.loop.remove_writer(self.fd)
+      self.loop.call_soon(self.finish, exc)
+
+   def finish(self, exc):
+      if self.sock is None:
+         return
+      self.loop.remove_reader(self.fd)
+      self.loop.remove_writer(self.fd)
+      self.sock.close()
+      self.sock = None
+      self.protocol.connection_lost(exc)
+
+
+def main(args):
+   if (args.workers > 1 or args.history_dir is not None or args.metrics_port is not None or args.snapshot is not None or
+       args.handover is not None or args.record is not None):
+      raise SystemExit("--backend loop doesn't do --workers, --history-dir, --metrics-port, --snapshot, --handover or "
+                       "--record yet.")
+   loop = SelectLoop()
+   factory = chat.ChatFactory(clock=LoopClock(loop), **chat.factory_config(args))
+   server = loop.create_server(lambda: StreamProtocol(factory), "", args.port, args.backlog)
+   signal.signal(signal.SIGTERM, lambda signum, frame: loop.stop())
+   factory.doStart()
+   try:
+      loop.run_forever()
+   except KeyboardInterrupt:
+      pass
+   server.close()
+   factory.doStop()
@@ -0,0 +1,158 @@
+"""Machine mode, for bots and bridges: JSON in both directions instead of prose, and replies tied to requests.
+
+A client asks for it with /machine, in place of its login name or any time after. The server answers
+{"event":"machine","version":1}, and from then on every line either way is one JSON object.
+
+A request is {"id": ..., "cmd": ..., "args": [...]}. cmd is any of the text commands ("join", "msg", "rooms", ...)
+and args are its words, so {"cmd":"msg","args":["Bob","hi there"]} is /msg Bob hi there; "login" takes the name, and
+"say" the line to chat, in the current room or, with "room": name, in any room they are in without switching to it.
+The id can be anything and comes back in the reply, {"id": ..., "ok": true, "out": [...]}, with every line the
+command wrote to them, or {"id": ..., "ok": false, "error": "..."}. Requests are handled in order, so a client can
+send as many as it likes without waiting and match the replies up by id. With --workers, the reply to a login waits
+until the hub has said whether the name is theirs.
+
+Everything else they are sent is an event: {"event":"chat","room": name,"line": ...} for what is said in their
+current room, and {"event":"line","line": ...} for the rest, e.g. private messages."""
+import json
+
+from chat import DELIMITER, DISPATCH
+
+VERSION = 1
+ENCODER = json.JSONEncoder(separators=(",", ":")) #json.dumps would make one of these every time, given separators
+
+def dumps(message):
+   try:
+      return ENCODER.encode(message) + DELIMITER
+   except UnicodeDecodeError: #someone sent something that isn't UTF-8
+      return dumps(dict((key, readable(value)) for key, value in message.items()))
+
+def readable(value):
+   if type(value) is str:
+      return value.decode("utf-8", "replace")
+   if type(value) is list:
+      return [readable(item) for item in value]
+   return value
+
+def text(value):
+   if type(value) is unicode:
+      return value.encode("utf-8")
+   if type(value) is not str:
+      raise ValueError("expected a string")
+   return value
+
+def decode(line):
+   #(id, cmd, args, room) from a request
+   request = json.loads(line)
+   if type(request) is not dict:
+      raise ValueError("expected an object")
+   args = request.get("args", [])
+   if type(args) is not list:
+      raise ValueError("args should be a list")
+   room = request.get("room")
+   return (request.get("id"), text(request.get("cmd")), [text(arg) for arg in args],
+           text(room) if room is not None else None)
+
+
+class MachineMode(object):
+   shared = (None, None, None) #the last chat frame encoded, its room and the event: a room's line goes to each viewer
+
+   def __init__(self, con):
+      self.con = con
+      self.out = None #what the request being handled has written to them, for its reply
+      self.claim = None #(id, what it wrote so far) for a login waiting on chat_cluster's hub
+
+   def encode(self, data, chatter):
+      #data, as sent to ChatProtocol.sendFrame, as events; or None, if it's for the reply to the request being handled
+      if chatter is None: #already encoded, see reply
+         return data
+      lines = data.split(DELIMITER)
+      lines.pop() #data ends with the delimiter
+      if not chatter and self.out is not None:
+         self.out.extend(lines)
+         return None
+      if not chatter:
+         return "".join([dumps({"event": "line", "line": line}) for line in lines])
+      room = self.con.me.current.name
+      frame, name, events = MachineMode.shared
+      if frame is not data or name is not room:
+         events = "".join([dumps({"event": "chat", "room": room, "line": line}) for line in lines])
+         MachineMode.shared = (data, room, events)
+      return events
+
+   def kind(self, line):
+      #what the request counts as, for flood control
+      try:
+         cmd = decode(line)[1]
+      except ValueError:
+         return "line"
+      return "chat" if cmd == "say" else cmd
+
+   def handle(self, line):
+      #carry out a request and answer it; returns what kind of line it was, for the stats
+      try:
+         id, cmd, args, room = decode(line)
+      except ValueError as e:
+         self.reply(None, error="bad request: {0}".format(e))
+         return "INVALID"
+      self.out = []
+      try:
+         kind, error = self.dispatch(cmd, args, room)
+      finally:
+         out, self.out = self.out, None
+      if self.con.state == "CLAIMING": #answered in claimed, once the hub has decided
+         self.claim = (id, out)
+      else:
+         self.reply(id, out, error)
+      return kind
+
+   def claimed(self, decide):
+      #the hub has decided on the name a login asked for: decide() says what that means, and the login gets its reply
+      id, self.out = self.claim
+      self.claim = None
+      try:
+         decide()
+      finally:
+         out, self.out = self.out, None
+      self.reply(id, out, self.login_error(out))
+
+   def dispatch(self, cmd, args, room):
+      con = self.con
+      if con.state == "LOGIN":
+         if cmd != "login":
+            return "INVALID", "log in first"
+         con.handle_LOGIN(" ".join(args))
+         return "LOGIN", self.login_error(self.out)
+      me = con.me
+      if cmd == "say":
+         if room is None:
+            room = me.current
+            if room is None:
+               return "CHAT", "not in a room"
+         else:
+            room = con.channels.get(room)
+            if room is None or room not in me.channels:
+               return "CHAT", "not in that room"
+         room.chat(me, " ".join(args))
+         return "CHAT", None
+      if cmd not in DISPATCH:
+         return "INVALID", "no such command" if cmd != "login" else "already logged in"
+      return con.handle_COMMAND(" ".join([cmd] + args)), None
+
+   def login_error(self, out):
+      #what the login said, if it didn't log them in
+      return out[-1] if self.con.state == "LOGIN" else None
+
+   def reply(self, id, out=(), error=None):
+      if error is None:
+         message = {"id": id, "ok": True, "out": out}
+      else:
+         message = {"id": id, "ok": False, "error": error}
+      self.con.sendFrame(dumps(message), None)
+
+   def refuse(self, line, error):
+      #answer a request that won't be carried out
+      try:
+         id = decode(line)[0]
+      except ValueError:
+         id = None
+      self.reply(id, error=error)
@@ -0,0 +1,484 @@
+"""Snapshots of the chat server's state, and handing a running server over to a new process without dropping anyone.
+
+A snapshot is a run of chunks, each a 4-byte length and a marshalled list of records, ended by an empty one. There is
+a record for each connection handed over (who it is, their rooms and tokens, whether they're in machine mode, input not
+yet handled and output not yet sent), then one for each room (topic, privacy, protection token, ops, members and
+scrollback).
+
+ * With --snapshot FILE the server writes one to FILE every --snapshot-interval seconds. It's built a few records at
+   a time, as the reactor has time for them, and written out in a thread, so no turn stalls on it; a room that
+   changes while it's being built goes in as it is when its turn comes. A last one is written as the server stops. On startup, an existing FILE brings the
+   rooms back with their topics, privacy, tokens and scrollback, empty, for --reap-grace seconds, for people to come
+   back to. Members aren't restored, because their connections are gone; ops are ops again when they log back in.
+ * With --handover PATH the server listens on the Unix socket PATH. A new process started with the same options
+   and --take-over connects there. The old process stops reading and sends over the listening
+   socket, every client's socket and a snapshot. It exits once the new process has restored them all, and carries on
+   as before if the new process fails first. Connections waiting to be accepted wait in the listening socket, and
+   lines not yet read wait in the clients' sockets, so clients notice nothing but a pause. With the same
+   --event-log FILE, the new process keeps its events in memory until the old one has written out the last of its
+   own and closed FILE.
+
+Neither works with --workers."""
+import gc
+import marshal
+import os
+import socket
+import struct
+import threading
+
+from contextlib import contextmanager
+
+from twisted.internet import reactor, task, tcp
+from twisted.internet.defer import Deferred
+from twisted.internet.endpoints import UNIXClientEndpoint, connectProtocol
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from zope.interface import implementer
+
+from chat import DELIMITER
+
+CHUNK = 1000 #records a chunk
+
+
+def records(factory, connections):
+   for p in connections:
+      yield connection_record(p)
+   for room in list(factory.channels.values()):
+      yield room_record(room)
+
+def connection_record(p):
+   me, transport = p.me, p.transport
+   #input: lines held back by flood control, then whatever partial line they had sent
+   unread = "".join(line + DELIMITER for line in p.waiting or ()) + p._buffer
+   #output: what the transport hasn't sent yet, then what was held back by coalescing or backpressure
+   unsent = (str(getattr(transport, "dataBuffer", "")[getattr(transport, "offset", 0):]) +
+             "".join(getattr(transport, "_tempDataBuffer", ())) + "".join(p.pending or ()) +
+             "".join(data for data, chatter in p.backlog or ()))
+   if me is None:
+      return ("connection", None, False, {}, [], None, unread, unsent, p.machine is not None)
+   return ("connection", me.name, me.operator, dict(me.tokens), [room.name for room in me.channels],
+           me.current.name if me.current is not None else None, unread, unsent, p.machine is not None)
+
+def room_record(room):
+   scrollback = room.scrollback
+   ops = [op.name for op in room.ops] + list(room.absent_ops or ()) #including ops from the last restore not yet back
+   return ("room", room.name, room.topic, room.private, room.token, ops,
+           [user.name for user in room.users], list(scrollback.lines) if scrollback is not None else [],
+           scrollback.next if scrollback is not None else 0)
+
+def chunks(records):
+   batch = []
+   for record in records:
+      batch.append(record)
+      if len(batch) == CHUNK:
+         yield encode(batch)
+         batch = []
+   if batch:
+      yield encode(batch)
+   yield encode(None)
+
+def encode(batch):
+   data = marshal.dumps(batch) if batch is not None else ""
+   return struct.pack("!I", len(data)) + data
+
+def dump(factory, connections=()):
+   return "".join(chunks(records(factory, connections)))
+
+def load(data):
+   #the records in data, and whether it was all there
+   found, offset = [], 0
+   while offset + 4 <= len(data):
+      size, = struct.unpack_from("!I", data, offset)
+      if size == 0:
+         return found, True
+      if offset + 4 + size > len(data):
+         break
+      found.extend(marshal.loads(data[offset + 4:offset + 4 + size]))
+      offset += 4 + size
+   return found, False
+
+
+@contextmanager
+def no_gc():
+   #Everything made while restoring lives on, so the collector only wastes its time looking; this halves the time
+   #100000 connections take to come back.
+   enabled = gc.isenabled()
+   gc.disable()
+   try:
+      yield
+   finally:
+      if enabled:
+         gc.enable()
+
+def restore(factory, records, transports=()):
+   #Bring back what records describe into factory. transports go with the connection records in turn: each is called
+   #with the ChatProtocol restored for it and returns its transport. Returns the ChatProtocols.
+   with no_gc():
+      return _restore(factory, records, transports)
+
+def _restore(factory, records, transports):
+   users, protocols, connections, rooms = factory.users, [], [], []
+   for record in records:
+      if record[0] == "connection":
+         connections.append(record)
+      elif record[0] == "room":
+         rooms.append(record)
+   for make_transport, (kind, name, operator, tokens, joined, current, unread, unsent, machine) in zip(transports, connections):
+      p = factory.buildProtocol(None)
+      if machine:
+         from chat_machine import MachineMode
+         p.machine = MachineMode(p)
+      if name is not None:
+         p.me = users[name] = factory.user(name, p)
+         p.state = "NEW TEXACO"
+         if operator:
+            p.me.operator = True
+         for room, token in tokens.items():
+            p.me.grant(room, token)
+      protocols.append((p, make_transport, joined, current, unread, unsent))
+   for kind, name, topic, private, token, ops, members, lines, next in rooms:
+      room = factory.channels[name] = factory.create_channel(name, None, topic)
+      room.private, room.token = private, token
+      for op in ops:
+         if op in users:
+            room.add_op(users[op])
+         else: #op again when they log back in
+            if room.absent_ops is None:
+               room.absent_ops = set()
+            room.absent_ops.add(op)
+            factory.absent_ops.setdefault(op, set()).add(room)
+      for member in members:
+         if member in users:
+            room.users.add(users[member])
+      if room.scrollback is not None:
+         room.scrollback.lines.extend(lines)
+         room.scrollback.next = next
+      room.relist()
+      if not room.users:
+         room.reaping = factory.clock.callLater(factory.reap_grace, factory.reap, room)
+   for p, make_transport, joined, current, unread, unsent in protocols:
+      if p.me is not None:
+         for name in joined:
+            p.me.entered(factory.channels[name])
+         p.me.current = factory.channels.get(current)
+      #makeConnection, but without connectionMade's greeting, which they had from the process before
+      p.connected, p.transport = 1, make_transport(p)
+      p.attached()
+      if unsent:
+         p.sendFrame(unsent, None) #as it was, for machine mode too
+   for p, make_transport, joined, current, unread, unsent in protocols:
+      if unread:
+         p.dataReceived(unread)
+   return [p for p, make_transport, joined, current, unread, unsent in protocols]
+
+
+def write_file(path, data):
+   with open(path + ".tmp", "wb") as f:
+      for chunk in data:
+         f.write(chunk)
+      f.flush()
+      os.fsync(f.fileno())
+   os.rename(path + ".tmp", path)
+
+def restore_file(factory, path):
+   #the rooms from the snapshot at path, if there is one
+   if not os.path.exists(path):
+      return
+   with open(path, "rb") as f:
+      found, complete = load(f.read())
+   if not complete:
+      log.msg("The snapshot in {0} is cut short; restoring what there is of it.".format(path))
+   restore(factory, found)
+   log.msg("Restored {0} rooms from {1}.".format(len(factory.channels), path))
+
+
+class Snapshots(object):
+   #Writes a snapshot of factory's rooms to path every interval seconds, a few records per reactor turn, then to disk
+   #in a thread. Once started, the factory's stopFactory writes the last one, see last.
+   def __init__(self, factory, path, interval=60, clock=reactor):
+      self.factory = factory
+      self.path = path
+      self.interval = interval
+      self.clock = clock
+      self.taking = None
+      self.looping = None
+      self.taken = 0
+      self.writing = threading.Lock()
+      self.stopped = False #the last one is written, and nothing older may land on top of it
+      self.cooperator = task.Cooperator(scheduler=lambda f: clock.callLater(0, f))
+
+   def start(self):
+      self.looping = task.LoopingCall(self.take)
+      self.looping.clock = self.clock
+      self.looping.start(self.interval, now=False)
+      self.factory.snapshots = self
+
+   def stop(self):
+      if self.looping is not None and self.looping.running:
+         self.looping.stop()
+      self.cooperator.stop()
+
+   def last(self):
+      #all at once, as the server stops, so that nothing since the last interval is lost
+      self.stop()
+      data = dump(self.factory)
+      with self.writing:
+         write_file(self.path, [data])
+         self.stopped = True
+      self.taken += 1
+
+   def take(self):
+      if self.taking is not None:
+         return self.taking #still at the last one
+      data = []
+      self.taking = self.cooperator.coiterate(data.append(chunk) for chunk in chunks(records(self.factory, ())))
+      self.taking.addCallback(lambda _: deferToThread(self.write, data))
+      self.taking.addErrback(lambda reason: reason.trap(task.SchedulerStopped)) #by stop, part way through
+      self.taking.addCallbacks(self.done, log.err)
+      self.taking.addBoth(self.finished)
+      return self.taking
+
+   def write(self, data):
+      with self.writing:
+         if self.stopped:
+            return False
+         write_file(self.path, data)
+         return True
+
+   def done(self, written):
+      if written:
+         self.taken += 1
+
+   def finished(self, result):
+      self.taking = None
+
+
+class Detached(object):
+   #in place of the transports handed over, so that nothing the old process still does reaches them
+   disconnecting = False
+
+   def write(self, data):
+      pass
+
+   def writeSequence(self, seq):
+      pass
+
+   def loseConnection(self):
+      pass
+
+   abortConnection = stopProducing = pauseProducing = resumeProducing = loseConnection
+
+DETACHED = Detached()
+
+
+class Handover(Protocol):
+   #the old process's end of the Unix socket, once a new process has connected to take over
+   def connectionMade(self):
+      self.done = False
+      self.factory.hand_over(self)
+
+   def dataReceived(self, data):
+      if "done" in data:
+         self.done = True
+         self.factory.finish(self)
+
+   def connectionLost(self, reason):
+      if not self.done:
+         self.factory.roll_back(self, reason)
+
+
+class HandoverFactory(Factory):
+   protocol = Handover
+
+   def __init__(self, chat, port, path, exit=os._exit):
+      self.chat = chat
+      self.port = port #the chat server's listening port
+      self.path = path
+      self.exit = exit
+      self.link = None #the Handover in progress
+      self.handed = None
+      self.history = None
+      self.listening = None
+
+   def hand_over(self, link):
+      chat = self.chat
+      if self.link is not None: #someone else is already taking over
+         return link.transport.loseConnection()
+      self.link = link
+      log.msg("Handing over {0} connections.".format(len(chat.connected)))
+      self.port.stopReading()
+      chat.handing_over = True
+      chat.stop_admitting()
+      handed = [p for p in chat.connected if not p.transport.disconnecting]
+      for p in handed:
+         p.transport.stopReading()
+      if chat.history is not None:
+         #the new process opens the same files, so let go of them first
+         self.history, chat.history = chat.history, None
+         self.history.close()
+      with no_gc():
+         data = dump(chat, handed)
+      link.transport.sendFileDescriptor(self.port.fileno())
+      for p in handed:
+         link.transport.sendFileDescriptor(p.transport.fileno())
+      link.transport.write(data)
+      #Everything about them is on its way, so from here on nothing may be written to them or their rooms; what
+      #they had in hand stays put in case the new process fails and this one has to carry on.
+      self.handed = [(p, p.transport) for p in handed]
+      for p, transport in self.handed:
+         p.transport = DETACHED
+         reactor.removeReader(transport)
+         reactor.removeWriter(transport)
+         if p.catching_up is not None and p.catching_up.active():
+            p.catching_up.cancel()
+      if chat.lag_check is not None and chat.lag_check.running:
+         chat.lag_check.stop()
+      chat.wheel.stop()
+      if chat.flushing is not None:
+         chat.flushing.cancel()
+         chat.flushing = None
+      for room in chat.channels.values():
+         if room.reaping is not None and room.reaping.active():
+            room.reaping.cancel()
+         room.reaping = None
+
+   def finish(self, link):
+      log.msg("Handed over.")
+      link.transport.loseConnection()
+      if self.listening is not None:
+         self.listening.stopListening()
+      #close, and not shutdown, which would end the connections for the new process too
+      for p, transport in self.handed:
+         transport.socket.close()
+      self.port.socket.close()
+      #exit skips the usual shutdown, so the last batches would be lost
+      if self.chat.recorder is not None:
+         self.chat.recorder.close()
+      if self.chat.events is not None: #and the new process waits for this before it opens the file itself
+         self.chat.events.stop()
+      self.exit(0)
+
+   def roll_back(self, link, reason):
+      if link is not self.link:
+         return
+      log.msg("The new process went away before it took over, so this one carries on: " + reason.getErrorMessage())
+      chat = self.chat
+      if self.history is not None:
+         from chat_history import History
+         old = self.history
+         chat.history = History(old.directory, old.segment_size, old.keep, old.clock, old.open_logs)
+         for room in chat.channels.values():
+            if room.log is not None:
+               room.log = chat.history.open(room.name)
+      chat.startFactory()
+      staged = set(chat.login_queue) #these wait for let_in, see start_admitting
+      for p, transport in self.handed:
+         p.transport = transport
+         if p.waiting is None: #the others were paused already, until catch_up
+            transport.startReading()
+         if transport.dataBuffer or transport._tempDataBuffer:
+            transport.startWriting()
+         if p.waiting and p not in staged:
+            p.catching_up = chat.clock.callLater(0, p.catch_up)
+         if p.pending:
+            chat.flush_soon(p)
+      for room in chat.channels.values():
+         chat.vacated(room)
+      chat.handing_over = False
+      chat.start_admitting()
+      self.link = self.handed = self.history = None
+
+def listen(chat, port, path, exit=os._exit):
+   #wait on the Unix socket at path for a new process to take over from this one
+   chat.port = port #as main has it, for start_admitting when a handover falls through
+   factory = HandoverFactory(chat, port, path, exit)
+   if os.path.exists(path):
+      os.unlink(path)
+   factory.listening = reactor.listenUNIX(path, factory, mode=0600)
+   return factory
+
+
+@implementer(IFileDescriptorReceiver)
+class TakeOver(Protocol):
+   #the new process's end of the Unix socket
+   def __init__(self, chat):
+      self.chat = chat
+      self.fds = []
+      self.data, self.have, self.want = [], 0, 4 #a chunk's length comes first, then the chunk
+      self.size = None
+      self.found = []
+      self.port = None
+      self.finished = Deferred()
+
+   def fileDescriptorReceived(self, fd):
+      self.fds.append(fd)
+
+   def dataReceived(self, data):
+      self.data.append(data)
+      self.have += len(data)
+      while self.have >= self.want:
+         data = "".join(self.data)
+         chunk, rest = data[:self.want], data[self.want:]
+         self.data, self.have = [rest], len(rest)
+         if self.size is not None:
+            self.found.extend(marshal.loads(chunk))
+            self.size, self.want = None, 4
+            continue
+         self.size, = struct.unpack("!I", chunk)
+         if self.size == 0:
+            return self.restore()
+         self.want = self.size
+
+   def restore(self):
+      fds, self.fds = self.fds, []
+      sockets = [adopt(fd) for fd in fds[1:]]
+      port = reactor.adoptStreamPort(fds[0], socket.AF_INET, self.chat)
+      os.close(fds[0])
+      made = []
+      def make_transport(skt):
+         def make(protocol):
+            addr = skt.getpeername()
+            made.append(tcp.Server(skt, protocol, addr, None, addr[1], reactor))
+            return made[-1]
+         return make
+      try:
+         protocols = restore(self.chat, self.found, [make_transport(skt) for skt in sockets])
+      except Exception:
+         #let go of it all, without shutting anything down, and the old process carries on with it
+         log.err(None, "Couldn't take over")
+         for transport in made:
+            reactor.removeReader(transport)
+            reactor.removeWriter(transport)
+         for skt in sockets:
+            skt.close()
+         port.stopListening()
+         return self.transport.loseConnection()
+      self.found = None
+      self.port = port
+      self.transport.write("done")
+      log.msg("Took over {0} connections and {1} rooms.".format(len(protocols), len(self.chat.channels)))
+
+   def connectionLost(self, reason):
+      #the old process has gone, or failed
+      if self.port is not None:
+         self.finished.callback(self.port)
+      else:
+         for fd in self.fds:
+            os.close(fd)
+         self.finished.errback(reason)
+
+def adopt(fd):
+   #the socket for fd, set up the way tcp.Server._fromConnectedSocket does it; restore makes its transport, without
+   #the makeConnection that would greet them again
+   skt = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+   os.close(fd)
+   skt.setblocking(0)
+   return skt
+
+def take_over(chat, path):
+   #Take over from the server waiting on the Unix socket at path. Fires with the listening port once the old process
+   #has let go of everything.
+   link = TakeOver(chat)
+   return connectProtocol(UNIXClientEndpoint(reactor, path), link).addCallback(lambda _: link.finished)
@@ -0,0 +1,84 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+import gc
+
+class LifecycleTestCase(unittest.TestCase):
+   def setUp(self):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(clock=self.clock, reap_grace=60)
+
+   def _connect(self, name=None):
+      proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      if name is not None:
+         proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def test_lost_before_login(self):
+      proto, tr = self._connect()
+      proto.connectionLost(None)
+      self.assertEqual(0, self.factory.stats.connections)
+      return self.assertEqual(set(), self.factory.connected)
+
+   def test_lost(self):
+      a, atr = self._connect("Ann")
+      b, btr = self._connect("Bob")
+      a.dataReceived('/join games\r\n/join lobby\r\n')
+      b.dataReceived('/join lobby\r\n/toggleop Bob games\r\n')
+      ann, bob = a.me, b.me
+      a.dataReceived('/toggleop Bob\r\n')
+      btr.clear()
+      b.connectionLost(None)
+      self.assertTrue('User Bob has left ("Connection lost")' in atr.value())
+      self.assertEqual('', btr.value())
+      self.assertFalse("Bob" in self.factory.users)
+      self.assertEqual([ann], list(self.factory.channels["lobby"].users))
+      self.assertEqual([ann], list(self.factory.channels["lobby"].ops))
+      self.assertEqual([ann], list(self.factory.channels["games"].ops)) #an op there without ever joining
+      return self.assertEqual(set(), bob.opped)
+
+   def test_quit_then_lost(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\n/quit bye\r\n')
+      a.connectionLost(None)
+      self.assertEqual({}, self.factory.users)
+      return self.assertEqual({}, self.factory.channels)
+
+   def test_reap(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\n/join games\r\n/part\r\n')
+      self.assertEqual(["lobby"], list(self.factory.channels))
+      self.assertEqual(["lobby"], self.factory.directory.names)
+      return self.assertEqual(set([self.factory.channels["lobby"]]), a.me.opped)
+
+   def test_grace(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join vault\r\n/protect\r\n/part\r\n')
+      self.clock.advance(59)
+      a.dataReceived('/join vault\r\n/part\r\n')
+      self.clock.advance(59)
+      self.assertTrue("vault" in self.factory.channels)
+      self.clock.advance(1)
+      self.assertFalse("vault" in self.factory.channels)
+      return self.assertEqual(set(), a.me.opped)
+
+   def test_churn(self):
+      #whatever way people come and go, nothing of them should be left behind
+      def churn(n):
+         for i in xrange(n):
+            proto, tr = self._connect("user{0}".format(i) if i % 5 else None)
+            if i % 5:
+               proto.dataReceived('/join room{0}\r\n/join lobby\r\nhello\r\n'.format(i % 7))
+            if i % 3 == 0:
+               proto.dataReceived('/quit\r\n')
+            proto.connectionLost(None)
+      churn(500)
+      gc.collect()
+      before = len(gc.get_objects())
+      churn(2000)
+      gc.collect()
+      self.assertEqual(({}, {}, set(), 0), (self.factory.users, self.factory.channels, self.factory.connected, len(self.factory.directory)))
+      return self.assertTrue(len(gc.get_objects()) - before < 100)
@@ -0,0 +1,95 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+class TimeoutTestCase(unittest.TestCase):
+   def _setUp(self, **config):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(clock=self.clock, **config)
+      self.factory.startFactory()
+      self.addCleanup(self.factory.stopFactory)
+
+   def _connect(self, name=None):
+      proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      if name is not None:
+         proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def _tick(self, seconds):
+      for i in xrange(seconds):
+         self.clock.advance(1)
+
+   def test_login_timeout(self):
+      self._setUp(login_timeout=60)
+      proto, tr = self._connect()
+      self._tick(59)
+      self.assertFalse(tr.disconnecting)
+      self._tick(1)
+      self.assertTrue(tr.value().endswith("You took too long to log in.\r\n"))
+      self.assertTrue(tr.disconnecting)
+      return self.assertEqual(1, self.factory.login_timeouts)
+
+   def test_logged_in(self):
+      self._setUp(login_timeout=60)
+      proto, tr = self._connect()
+      self._tick(30)
+      proto.dataReceived("Ann\r\n")
+      self._tick(1000)
+      return self.assertFalse(tr.disconnecting)
+
+   def test_idle(self):
+      self._setUp(idle_timeout=100)
+      proto, tr = self._connect("Ann")
+      self._tick(50)
+      proto.dataReceived("/rooms\r\n")
+      self._tick(99)
+      self.assertFalse(tr.disconnecting)
+      self._tick(1)
+      self.assertTrue(tr.value().endswith("You have been idle too long.\r\n"))
+      return self.assertTrue(tr.disconnecting)
+
+   def test_ping(self):
+      self._setUp(idle_timeout=100, ping_timeout=10)
+      proto, tr = self._connect("Ann")
+      self._tick(100)
+      self.assertTrue(tr.value().endswith("to stay connected)\r\n"))
+      self._tick(5)
+      proto.dataReceived("/pong\r\n")
+      self._tick(100)
+      self.assertFalse(tr.disconnecting)
+      self.assertEqual(2, tr.value().count("PING"))
+      self._tick(10)
+      self.assertTrue(tr.value().endswith("No answer to PING.\r\n"))
+      return self.assertEqual(1, self.factory.idle_timeouts)
+
+   def test_longer_than_a_turn(self):
+      self._setUp(login_timeout=1000) #the wheel has 512 slots of a second
+      proto, tr = self._connect()
+      self._tick(999)
+      self.assertFalse(tr.disconnecting)
+      self._tick(1)
+      return self.assertTrue(tr.disconnecting)
+
+   def test_missed_ticks(self):
+      self._setUp(login_timeout=60)
+      proto, tr = self._connect()
+      self.clock.advance(90) #the reactor was stuck; the wheel catches up all at once
+      return self.assertTrue(tr.disconnecting)
+
+   def test_many(self):
+      #10000 connections, one scheduled call: about half log in along the way, the rest go at 30 seconds and not before
+      self._setUp(login_timeout=30, idle_timeout=3600)
+      connections = [self._connect() for i in xrange(10000)]
+      self.assertEqual(2, len(self.clock.getDelayedCalls())) #the wheel and the lag check
+      for second in xrange(29):
+         for i in xrange(second, 10000, 58):
+            connections[i][0].dataReceived("user{0}\r\n".format(i))
+         self.clock.advance(1)
+      self.assertEqual(0, sum(tr.disconnecting for proto, tr in connections))
+      self.clock.advance(1)
+      timed_out = [i for i, (proto, tr) in enumerate(connections) if tr.disconnecting]
+      self.assertEqual([i for i in xrange(10000) if i % 58 >= 29], timed_out)
+      return self.assertEqual(len(timed_out), self.factory.login_timeouts)
@@ -0,0 +1,74 @@
+from chat import ChatFactory, RoomList
+from chat_cluster import Bus, ClusterFactory
+from twisted.trial import unittest
+from twisted.test import iosim, proto_helpers
+import gc
+import chat_test_2
+import chat_test_4
+
+class CompactTestCase(unittest.TestCase):
+   def setUp(self):
+      self.factory = ChatFactory(compact=True)
+
+   def _connect(self, name):
+      proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def _dicts(self, obj):
+      #a __dict__ shows up among what the object refers to; looking at obj.__dict__ would make one
+      return [r for r in gc.get_referents(obj) if type(r) is dict and r is not self.factory.users and r is not self.factory.channels]
+
+   def test_no_dicts(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\nhello\r\n/rooms\r\n')
+      self.assertEqual([], self._dicts(a))
+      self.assertEqual([], self._dicts(a.me))
+      return self.assertEqual([], self._dicts(self.factory.channels["lobby"]))
+
+   def test_lazy(self):
+      a, atr = self._connect("Ann")
+      self.assertEqual(((), (), ()), (a.me.channels, a.me.opped, a.me.tokens))
+      a.dataReceived('/join lobby\r\n/join games\r\n')
+      self.assertEqual(RoomList, type(a.me.channels))
+      self.assertEqual(["lobby", "games"], [room.name for room in a.me.channels])
+      a.dataReceived('/part\r\n/part\r\n')
+      return self.assertEqual((), a.me.channels)
+
+   def test_interned(self):
+      a, atr = self._connect("".join(["A", "nn"]))
+      a.dataReceived('/join lobby\r\n')
+      self.assertTrue(a.me.name is intern("Ann"))
+      room = self.factory.channels["lobby"]
+      self.assertTrue(room.name is intern("lobby"))
+      return self.assertTrue([name for name in self.factory.channels][0] is room.name)
+
+   def test_lazy_attributes(self):
+      #the ones that aren't slots still work, in a __dict__ of their own
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\n')
+      a.pauseProducing()
+      a.me.operator = True
+      self.assertTrue(a.paused)
+      self.assertTrue(a.me.operator)
+      return self.assertEqual(1, len(self._dicts(a)))
+
+class CompactTestCase2(chat_test_2.ChatTestCast2):
+   #everything in chat_test_2, in compact mode
+   def setUp(self):
+      self.factory = ChatFactory(compact=True)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(20)]
+      self.trs = [proto_helpers.StringTransport() for a in self.connections]
+      for i in xrange(len(self.connections)):
+         self.connections[i].makeConnection(self.trs[i])
+
+class CompactClusterTestCase(chat_test_4.ClusterTestCase):
+   #and everything in chat_test_4
+   def _worker(self, i, **config):
+      factory = ClusterFactory(i, compact=True, **config)
+      factory.bus = Bus(factory)
+      link = self.hub.buildProtocol(None)
+      self.pumps.append(iosim.connect(link, iosim.makeFakeServer(link), factory.bus, iosim.makeFakeClient(factory.bus)))
+      return factory
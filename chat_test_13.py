@@ -0,0 +1,169 @@
+from chat import ChatFactory
+from chat_loop import LoopClock, SelectLoop, SocketTransport, StreamProtocol
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+import socket
+import time
+import chat_test_1
+import chat_test_2
+
+class FakeTransport(object):
+   #an asyncio transport that keeps what is written to it, like StringTransport
+   def __init__(self):
+      self.data = []
+      self.closed = False
+      self.reading = True
+
+   def get_extra_info(self, name, default=None):
+      return ('127.0.0.1', 0) if name == "peername" else default
+
+   def write(self, data):
+      self.data.append(data)
+
+   def writelines(self, lines):
+      self.data.extend(lines)
+
+   def close(self):
+      self.closed = True
+
+   abort = close
+
+   def pause_reading(self):
+      self.reading = False
+
+   def resume_reading(self):
+      self.reading = True
+
+   def value(self):
+      return "".join(self.data)
+
+   def clear(self):
+      self.data = []
+
+def connect(factory):
+   stream, tr = StreamProtocol(factory), FakeTransport()
+   stream.connection_made(tr)
+   return stream, tr
+
+class LoopBackendTestCase1(chat_test_1.ChatTestCase):
+   #everything in chat_test_1, through StreamProtocol
+   def setUp(self):
+      self.factory = ChatFactory()
+      self.stream, self.tr = connect(self.factory)
+      self.proto = self.stream.chat
+      self.commands = [a.upper() for a in self.proto.commands.keys()]
+
+class LoopBackendTestCase2(chat_test_2.ChatTestCast2):
+   #everything in chat_test_2, through StreamProtocol
+   def setUp(self):
+      self.factory = ChatFactory()
+      self.streams, self.trs = zip(*[connect(self.factory) for i in xrange(20)])
+      self.connections = [stream.chat for stream in self.streams]
+
+class LoopBackendTestCase(unittest.TestCase):
+   SESSION = ["Ann", "/join lobby", "hello", "/topic loops", "/rooms", "/msg Ann hi me", "/part bye", "/quit"]
+
+   def test_same_output(self):
+      factory = ChatFactory()
+      proto = factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      stream, fake = connect(ChatFactory())
+      for line in self.SESSION:
+         proto.dataReceived(line + "\r\n")
+         stream.data_received(line + "\r\n")
+      self.assertEqual(tr.value(), fake.value())
+      return self.assertTrue(fake.closed)
+
+   def test_flow_control(self):
+      factory = ChatFactory()
+      a, atr = connect(factory)
+      b, btr = connect(factory)
+      a.data_received("Ann\r\n/join lobby\r\n")
+      b.data_received("Bob\r\n/join lobby\r\n")
+      b.pause_writing()
+      a.data_received("one\r\n")
+      self.assertFalse("one" in btr.value())
+      b.resume_writing()
+      return self.assertTrue(btr.value().endswith("Ann: one\r\n"))
+
+   def test_lost(self):
+      factory = ChatFactory()
+      a, atr = connect(factory)
+      a.data_received("Ann\r\n/join lobby\r\n")
+      a.connection_lost(None)
+      return self.assertEqual(({}, {}, set()), (factory.users, factory.channels, factory.connected))
+
+class SelectLoopTestCase(unittest.TestCase):
+   def setUp(self):
+      self.loop = SelectLoop()
+      self.clock = LoopClock(self.loop)
+
+   def _spin(self, until, timeout=5):
+      deadline = time.time() + timeout
+      while not until() and time.time() < deadline:
+         self.loop.run_once(0.01)
+      return until()
+
+   def test_timers(self):
+      calls = []
+      first = self.clock.callLater(0.05, calls.append, "first")
+      later = self.clock.callLater(0.01, calls.append, "later")
+      cancelled = self.clock.callLater(0.01, calls.append, "cancelled")
+      cancelled.cancel()
+      later.reset(0.1)
+      self.assertTrue(self._spin(lambda: len(calls) == 2))
+      self.assertEqual(["first", "later"], calls)
+      return self.assertFalse(first.active())
+
+   def test_one_send_a_turn(self):
+      #what is written in a turn goes out at the end of it, together
+      ours, theirs = socket.socketpair()
+      self.addCleanup(theirs.close)
+      ours.setblocking(0)
+      theirs.setblocking(0)
+      stream = StreamProtocol(ChatFactory(clock=self.clock))
+      transport = SocketTransport(self.loop, ours, stream)
+      self.addCleanup(transport.abort)
+      self.loop.run_once(0)
+      theirs.recv(1 << 16) #the greeting
+      for line in ("one\r\n", "two\r\n"):
+         transport.write(line)
+      self.assertRaises(socket.error, theirs.recv, 1 << 16)
+      self.loop.run_once(0)
+      return self.assertEqual("one\r\ntwo\r\n", theirs.recv(1 << 16))
+
+   def test_sockets(self):
+      #two real clients talking through the loop, one of them slow to read
+      factory = ChatFactory(clock=self.clock, queue_bytes=1 << 30, queue_messages=1 << 30)
+      factory.doStart()
+      self.addCleanup(factory.doStop)
+      server = self.loop.create_server(lambda: StreamProtocol(factory), "127.0.0.1", 0)
+      self.addCleanup(server.close)
+      port = server.sockets[0].getsockname()[1]
+      clients = [socket.create_connection(("127.0.0.1", port)) for i in xrange(2)]
+      for client, name in zip(clients, ("Ann", "Bob")):
+         self.addCleanup(client.close)
+         client.sendall("{0}\r\n/join lobby\r\n".format(name))
+      self.assertTrue(self._spin(lambda: len(factory.channels.get("lobby", {}) and factory.channels["lobby"].users) == 2))
+      bob = [p for p in factory.connected if p.me.name == "Bob"][0]
+      line, sent = "x" * 1000 + "\r\n", 0
+      clients[0].setblocking(0)
+      while not bob.paused and sent < 100000: #until the loop tells it to pause_writing
+         try:
+            clients[0].send(line)
+            sent += 1
+         except socket.error:
+            pass
+         self.loop.run_once(0)
+      self.assertTrue(bob.paused)
+      received = []
+      clients[1].setblocking(0)
+      def read():
+         try:
+            received.append(clients[1].recv(1 << 20))
+         except socket.error:
+            pass
+         return "".join(received).count("Ann: " + line) == sent
+      self.assertTrue(self._spin(read))
+      return self.assertFalse(bob.paused)
@@ -0,0 +1,292 @@
+from chat import ChatFactory, TokenBucket
+from chat_events import EventLog
+from chat_snapshot import Snapshots, dump, listen, load, restore, restore_file, take_over
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, UNIXClientEndpoint, connectProtocol
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.internet.protocol import Protocol
+from zope.interface import implementer
+import os
+
+class SnapshotTestCase(unittest.TestCase):
+   def setUp(self):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(clock=self.clock, scrollback=5, reap_grace=300)
+
+   def _connect(self, factory, name):
+      proto = factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def _again(self, connections):
+      #what a new process makes of a snapshot of self.factory with these connections
+      found, complete = load(dump(self.factory, [p for p, tr in connections]))
+      self.assertTrue(complete)
+      factory = ChatFactory(clock=self.clock, scrollback=5, reap_grace=300)
+      trs = [proto_helpers.StringTransport() for c in connections]
+      protocols = restore(factory, found, [lambda p, tr=tr: tr for tr in trs])
+      return factory, zip(protocols, trs)
+
+   def test_round_trip(self):
+      a, atr = self._connect(self.factory, "Ann")
+      b, btr = self._connect(self.factory, "Bob")
+      a.dataReceived('/join lobby\r\n/topic lobbying\r\none\r\n')
+      b.dataReceived('/join lobby\r\ntwo\r\n')
+      a.dataReceived('/toggleprivate\r\n/protect\r\n/join games\r\n')
+      token = self.factory.channels["lobby"].token
+      factory, ((a, atr), (b, btr)) = self._again([(a, atr), (b, btr)])
+      lobby = factory.channels["lobby"]
+      self.assertEqual(("lobbying", True, token), (lobby.topic, lobby.private, lobby.token))
+      self.assertEqual([a.me, b.me], list(lobby.users))
+      self.assertEqual([a.me], list(lobby.ops))
+      self.assertEqual(["Ann: one", "Bob: two"], [line for seq, when, line in lobby.scrollback.lines])
+      self.assertEqual(["lobby", "games"], [room.name for room in a.me.channels])
+      self.assertEqual((factory.channels["games"], lobby), (a.me.current, b.me.current))
+      self.assertEqual({"lobby": token}, a.me.tokens)
+      self.assertEqual("", atr.value()) #no second greeting
+      b.dataReceived('three\r\n')
+      self.assertEqual("Bob: three\r\n", btr.value())
+      self.assertEqual(["Ann: one", "Bob: two", "Bob: three"], [line for seq, when, line in lobby.scrollback.lines])
+      a.dataReceived('/switch lobby\r\n/quit\r\n')
+      return self.assertEqual(["Bob"], factory.users.keys())
+
+   def test_unsent_and_unread(self):
+      #output the old process hadn't written yet goes out first, and half a line is finished in the new one
+      a, atr = self._connect(self.factory, "Ann")
+      b, btr = self._connect(self.factory, "Bob")
+      a.dataReceived('/join lobby\r\n')
+      b.dataReceived('/join lobby\r\n')
+      b.pauseProducing()
+      a.dataReceived('held back\r\n')
+      b.dataReceived('hel')
+      self.assertFalse("held back" in btr.value())
+      factory, ((a, atr), (b, btr)) = self._again([(a, atr), (b, btr)])
+      self.assertEqual("Ann: held back\r\n", btr.value())
+      b.dataReceived('lo\r\n')
+      return self.assertEqual("Bob: hello\r\n", atr.value())
+
+   def test_not_logged_in(self):
+      a, atr = self._connect(self.factory, "Ann")
+      c = self.factory.buildProtocol(('127.0.0.1', 0))
+      c.makeConnection(proto_helpers.StringTransport())
+      factory, ((a, atr), (c, ctr)) = self._again([(a, atr), (c, c.transport)])
+      self.assertEqual(None, c.me)
+      c.dataReceived("Cat\r\n")
+      return self.assertEqual(["Ann", "Cat"], sorted(factory.users))
+
+   def test_file(self):
+      #from a file the rooms come back empty, for --reap-grace seconds
+      a, atr = self._connect(self.factory, "Ann")
+      a.dataReceived('/join games\r\n/join lobby\r\n/topic lobbying\r\none\r\n')
+      path = self.mktemp()
+      with open(path, "wb") as f:
+         f.write(dump(self.factory))
+      factory = ChatFactory(clock=self.clock, scrollback=5, reap_grace=300)
+      restore_file(factory, path)
+      lobby = factory.channels["lobby"]
+      self.assertEqual(("lobbying", 0), (lobby.topic, len(lobby.users)))
+      self.clock.advance(299)
+      b, btr = self._connect(factory, "Bob")
+      b.dataReceived('/join lobby\r\n')
+      self.assertTrue("Ann: one\r\n" in btr.value())
+      self.clock.advance(1)
+      return self.assertEqual(["lobby"], factory.channels.keys())
+
+   def test_ops_come_back(self):
+      #ops restored from a file are ops again once they log back in, through another restart if need be
+      a, atr = self._connect(self.factory, "Ann")
+      a.dataReceived('/join lobby\r\n/join games\r\n')
+      path = self.mktemp()
+      for i in xrange(2):
+         with open(path, "wb") as f:
+            f.write(dump(self.factory))
+         self.factory = ChatFactory(clock=self.clock, scrollback=5, reap_grace=300)
+         restore_file(self.factory, path)
+      b, btr = self._connect(self.factory, "Bob")
+      b.dataReceived('/join lobby\r\n')
+      lobby = self.factory.channels["lobby"]
+      self.assertEqual([], list(lobby.ops))
+      self.factory.reap(self.factory.channels["games"])
+      self.clock.advance(300)
+      a, atr = self._connect(self.factory, "Ann")
+      self.assertEqual([a.me], list(lobby.ops))
+      self.assertEqual(set([lobby]), a.me.opped)
+      return self.assertEqual({}, self.factory.absent_ops)
+
+   def test_cut_short(self):
+      for i in xrange(2500):
+         self._connect(self.factory, "user{0}".format(i))[0].dataReceived('/join room{0}\r\n'.format(i))
+      data = dump(self.factory)
+      found, complete = load(data[:len(data) // 2])
+      self.assertFalse(complete)
+      self.assertEqual(1000, len(found)) #the first whole chunk
+      return self.assertEqual((2500, True), (len(load(data)[0]), load(data)[1]))
+
+   def test_snapshots(self):
+      self.factory.startFactory()
+      self.addCleanup(self.factory.stopFactory)
+      a, atr = self._connect(self.factory, "Ann")
+      a.dataReceived('/join lobby\r\n/protect\r\n')
+      path = self.mktemp()
+      snapshots = Snapshots(self.factory, path, 60, self.clock)
+      snapshots.start()
+      self.addCleanup(snapshots.stop)
+      self.clock.advance(60)
+      self.assertFalse(os.path.exists(path))
+      self.assertTrue(snapshots.take() is snapshots.taking) #still at it
+      self.clock.advance(0)
+      d = snapshots.taking
+      def written(_):
+         self.assertEqual(1, snapshots.taken)
+         with open(path, "rb") as f:
+            return self.assertEqual(["lobby"], [record[1] for record in load(f.read())[0]])
+      return d.addCallback(written)
+
+   def test_last(self):
+      #stopping writes what changed since the last interval, and an older one still being written doesn't undo it
+      self.factory.startFactory()
+      a, atr = self._connect(self.factory, "Ann")
+      a.dataReceived('/join lobby\r\n')
+      path = self.mktemp()
+      snapshots = Snapshots(self.factory, path, 60, self.clock)
+      snapshots.start()
+      self.clock.advance(60)
+      self.clock.advance(0)
+      older = snapshots.taking
+      a.dataReceived('/topic lobbying\r\n')
+      self.factory.stopFactory()
+      self.assertFalse(snapshots.looping.running)
+      def restored(_):
+         factory = ChatFactory(clock=self.clock, scrollback=5, reap_grace=300)
+         restore_file(factory, path)
+         return self.assertEqual("lobbying", factory.channels["lobby"].topic)
+      return older.addCallback(restored)
+
+
+class Client(Protocol):
+   def __init__(self):
+      self.data = ""
+      self.waiting = []
+
+   def dataReceived(self, data):
+      self.data += data
+      for text, d in self.waiting[:]:
+         if text in self.data:
+            self.waiting.remove((text, d))
+            d.callback(self.data)
+
+   def expect(self, text):
+      d = defer.Deferred()
+      self.waiting.append((text, d))
+      self.dataReceived("")
+      return d
+
+@implementer(IFileDescriptorReceiver)
+class Quitter(Protocol):
+   #a new process that gives up halfway, after a look at the old one with check
+   def __init__(self, check=lambda: None):
+      self.lost = defer.Deferred()
+      self.check = check
+
+   def connectionLost(self, reason):
+      self.lost.callback(None)
+
+   def fileDescriptorReceived(self, fd):
+      os.close(fd)
+
+   def dataReceived(self, data):
+      self.check()
+      self.transport.loseConnection()
+
+
+class HandoverTestCase(unittest.TestCase):
+   #two factories in one process, standing in for the old server and the new
+   def setUp(self):
+      self.old = ChatFactory()
+      self.port = reactor.listenTCP(0, self.old, interface="127.0.0.1")
+      self.path = os.path.abspath(self.mktemp())
+      self.exited = []
+      self.handover = listen(self.old, self.port, self.path, self.exited.append)
+      self.clients = []
+      self.factories = [self.old]
+
+   def tearDown(self):
+      for client in self.clients:
+         client.transport.abortConnection()
+      for factory in self.factories:
+         for p in list(factory.connected):
+            p.transport.abortConnection()
+      if not self.exited: #otherwise the handover let go of them
+         self.handover.listening.stopListening()
+         return self.port.stopListening()
+
+   @defer.inlineCallbacks
+   def _client(self, port, name):
+      client = yield connectProtocol(TCP4ClientEndpoint(reactor, "127.0.0.1", port), Client())
+      self.clients.append(client)
+      client.transport.write(name + "\r\n/join lobby\r\n")
+      yield client.expect("lobby")
+      defer.returnValue(client)
+
+   @defer.inlineCallbacks
+   def test_handover(self):
+      number = self.port.getHost().port
+      ann = yield self._client(number, "Ann")
+      new = ChatFactory()
+      self.factories = [new]
+      ann.transport.write("hello\r\n")
+      events = self.old.events = self.old.stats.events = EventLog(self.mktemp())
+      events.start()
+      self.addCleanup(events.stop)
+      events.add("log", {"message": ("Still here",), "isError": 0})
+      port = yield take_over(new, self.path)
+      self.addCleanup(port.stopListening)
+      self.assertEqual([0], self.exited)
+      self.assertEqual(None, events.thread) #stopped, with what it had written out, before exiting
+      with open(events.path) as f:
+         self.assertTrue('"text":"Still here"' in f.read())
+      self.assertEqual(number, port.getHost().port)
+      self.assertEqual(["Ann"], new.users.keys())
+      yield ann.expect("Ann: hello\r\n")
+      bob = yield self._client(port.getHost().port, "Bob")
+      bob.transport.write("hi\r\n")
+      yield ann.expect("Bob: hi\r\n")
+      self.assertEqual(2, len(new.connected))
+
+   @defer.inlineCallbacks
+   def test_roll_back(self):
+      ann = yield self._client(self.port.getHost().port, "Ann")
+      link = yield connectProtocol(UNIXClientEndpoint(reactor, self.path), Quitter())
+      yield link.lost
+      self.assertEqual([], self.exited)
+      ann.transport.write("still here\r\n")
+      yield ann.expect("Ann: still here\r\n")
+      bob = yield self._client(self.port.getHost().port, "Bob")
+      self.assertEqual(["Ann", "Bob"], sorted(self.old.users))
+
+   @defer.inlineCallbacks
+   def test_roll_back_admission(self):
+      #a paused port and a login queue stay still while the new process takes over, and carry on if it fails
+      self.old.login_bucket = TokenBucket(4, 1, reactor)
+      self.old.login_bucket.take()
+      ann = yield connectProtocol(TCP4ClientEndpoint(reactor, "127.0.0.1", self.port.getHost().port), Client())
+      self.clients.append(ann)
+      ann.transport.write("Ann\r\n")
+      while not self.old.staged():
+         yield task.deferLater(reactor, 0.01, lambda: None)
+      self.old.accept_bucket = TokenBucket(4, 1, reactor)
+      self.old.accept_bucket.take()
+      self.old.pause_accepting()
+      seen = []
+      link = yield connectProtocol(UNIXClientEndpoint(reactor, self.path), Quitter(
+         lambda: seen.append((self.old.handing_over, self.old.staging, self.old.resuming))))
+      yield link.lost
+      self.assertEqual([(True, None, None)], seen)
+      yield ann.expect("Welcome Ann!")
+      self.assertFalse(self.old.handing_over)
+      bob = yield self._client(self.port.getHost().port, "Bob")
+      self.assertEqual(["Ann", "Bob"], sorted(self.old.users))
@@ -0,0 +1,163 @@
+from chat import ChatFactory
+from chat_cluster import Bus, ClusterFactory, Hub
+from chat_machine import MachineMode
+from chat_snapshot import dump, load, restore
+from twisted.trial import unittest
+from twisted.test import iosim, proto_helpers
+from twisted.internet import task
+import json
+
+class MachineTestCase(unittest.TestCase):
+   def setUp(self):
+      self.factory = ChatFactory()
+
+   def _connect(self, name=None):
+      proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      if name is not None:
+         proto.dataReceived(name + '\r\n')
+      tr.clear()
+      return proto, tr
+
+   def _machine(self, name):
+      proto, tr = self._connect()
+      proto.dataReceived('/machine\r\n{"id":0,"cmd":"login","args":["' + name + '"]}\r\n')
+      self.assertEqual([{"event": "machine", "version": 1}, {"id": 0, "ok": True, "out": ["Welcome " + name + "!"]}],
+                       self._frames(tr))
+      return proto, tr
+
+   def _send(self, proto, *requests):
+      proto.dataReceived("".join(json.dumps(request) + '\r\n' for request in requests))
+
+   def _frames(self, tr):
+      frames = [json.loads(line) for line in tr.value().split('\r\n')[:-1]]
+      tr.clear()
+      return frames
+
+   def test_join(self):
+      a, atr = self._machine("Ann")
+      self._send(a, {"id": "j", "cmd": "join", "args": ["lobby", "a", "topic"]})
+      self.assertEqual([{"id": "j", "ok": True, "out": ["entering room: lobby", "Welcome to lobby. Today's topic: a topic",
+                                                        "* Ann (** this is you)", "end of list"]}], self._frames(atr))
+
+   def test_pipelined(self):
+      #500 rooms joined and spoken in, in one go, without waiting for anything
+      a, atr = self._machine("Ann")
+      requests = []
+      for i in xrange(500):
+         requests.append({"id": 2 * i, "cmd": "join", "args": ["room{0}".format(i)]})
+         requests.append({"id": 2 * i + 1, "cmd": "say", "room": "room{0}".format(i), "args": ["hi", "there"]})
+      self._send(a, *requests)
+      frames = self._frames(atr)
+      self.assertEqual(range(1000), [frame["id"] for frame in frames if "id" in frame])
+      self.assertTrue(all(frame["ok"] for frame in frames if "id" in frame))
+      chat = [frame for frame in frames if "event" in frame]
+      self.assertEqual(500, len(chat))
+      self.assertEqual({"event": "chat", "room": "room499", "line": "Ann: hi there"}, chat[-1])
+      return self.assertEqual(500, len(self.factory.channels))
+
+   def test_say_elsewhere(self):
+      #saying something in a room they're in, but not looking at, doesn't switch them to it
+      a, atr = self._machine("Ann")
+      b, btr = self._connect("Bob")
+      b.dataReceived('/join lobby\r\n')
+      self._send(a, {"id": 1, "cmd": "join", "args": ["lobby"]}, {"id": 2, "cmd": "join", "args": ["games"]})
+      atr.clear()
+      btr.clear()
+      self._send(a, {"id": 3, "cmd": "say", "room": "lobby", "args": ["psst"]})
+      self.assertEqual([{"id": 3, "ok": True, "out": []}], self._frames(atr))
+      self.assertEqual("Ann: psst\r\n", btr.value())
+      return self.assertEqual("games", a.me.current.name)
+
+   def test_events(self):
+      a, atr = self._machine("Ann")
+      self._send(a, {"id": 1, "cmd": "join", "args": ["lobby"]})
+      b, btr = self._connect("Bob")
+      b.dataReceived('/join lobby\r\n')
+      atr.clear()
+      btr.clear()
+      b.dataReceived('hello\r\n/msg Ann a secret\r\n')
+      self.assertEqual([{"event": "chat", "room": "lobby", "line": "Bob: hello"},
+                        {"event": "line", "line": 'Bob says, "a secret"'}], self._frames(atr))
+      #and the text clients see no difference
+      self._send(a, {"id": 2, "cmd": "say", "args": ["hi Bob"]}, {"id": 3, "cmd": "msg", "args": ["Bob", "hi", "again"]})
+      return self.assertEqual('Bob: hello\r\nAnn: hi Bob\r\nAnn says, "hi again"\r\n', btr.value())
+
+   def test_errors(self):
+      a, atr = self._connect()
+      a.dataReceived('/machine\r\n')
+      atr.clear()
+      self._send(a, {"id": 1, "cmd": "join", "args": ["lobby"]})
+      a.dataReceived('not json\r\n[1]\r\n')
+      self._send(a, {"id": 2, "cmd": "login", "args": ["A n n"]}, {"id": 3, "cmd": "login", "args": ["Ann"]},
+                 {"id": 4, "cmd": "login", "args": ["Ann"]}, {"id": 5, "cmd": "fly"}, {"id": 6, "cmd": "say"})
+      self.assertEqual([(1, "log in first"), (None, "bad request: No JSON object could be decoded"),
+                        (None, "bad request: expected an object"), (2, "Please use alphanumeric characters only."),
+                        (3, None), (4, "already logged in"), (5, "no such command"), (6, "not in a room")],
+                       [(frame["id"], frame.get("error")) for frame in self._frames(atr)])
+
+   def test_after_login(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\n')
+      atr.clear()
+      a.dataReceived('/machine\r\n')
+      self.assertEqual([{"event": "machine", "version": 1}], self._frames(atr))
+      self._send(a, {"id": 1, "cmd": "rooms"})
+      return self.assertEqual([{"id": 1, "ok": True, "out": ["Active rooms are:", "* lobby (1)", "end of list."]}],
+                              self._frames(atr))
+
+   def test_shared(self):
+      #one line to a room full of machines is encoded once
+      machines = [self._machine("bot{0}".format(i)) for i in xrange(3)]
+      for proto, tr in machines:
+         self._send(proto, {"id": 1, "cmd": "join", "args": ["lobby"]})
+         tr.clear()
+      self._send(machines[0][0], {"id": 2, "cmd": "say", "args": ["hi"]})
+      values = [tr.value() for proto, tr in machines]
+      self.assertEqual(values[1], values[2])
+      return self.assertEqual([{"event": "chat", "room": "lobby", "line": "bot0: hi"}], self._frames(machines[1][1]))
+
+   def test_flood(self):
+      clock = task.Clock()
+      self.factory = ChatFactory(clock=clock, limits={"line": (1, 1)}, flood_queue=2)
+      a, atr = self._machine("Ann")
+      self._send(a, *[{"id": i, "cmd": "rooms"} for i in xrange(5)])
+      self.assertEqual([(0, True), (3, False), (4, False)], [(frame["id"], frame["ok"]) for frame in self._frames(atr)])
+      clock.advance(1)
+      clock.advance(1)
+      return self.assertEqual([1, 2], [frame["id"] for frame in self._frames(atr)])
+
+   def test_handed_over(self):
+      a, atr = self._machine("Ann")
+      self._send(a, {"id": 1, "cmd": "join", "args": ["lobby"]})
+      a.pauseProducing()
+      self._send(a, {"id": 2, "cmd": "say", "args": ["hi"]})
+      factory = ChatFactory()
+      tr = proto_helpers.StringTransport()
+      a, = restore(factory, load(dump(self.factory, [a]))[0], [lambda p: tr])
+      self.assertTrue(isinstance(a.machine, MachineMode))
+      self.assertEqual([{"event": "chat", "room": "lobby", "line": "Ann: hi"}, {"id": 2, "ok": True, "out": []}],
+                       self._frames(tr))
+      self._send(a, {"id": 3, "cmd": "say", "args": ["again"]})
+      return self.assertEqual(2, len(self._frames(tr)))
+
+   def test_cluster(self):
+      #with --workers the hub decides whose a name is, and the login's reply waits for it
+      hub, pumps, trs = Hub(), [], []
+      for i in xrange(2):
+         self.factory = ClusterFactory(i)
+         self.factory.bus = Bus(self.factory)
+         link = hub.buildProtocol(None)
+         pumps.append(iosim.connect(link, iosim.makeFakeServer(link), self.factory.bus,
+                                    iosim.makeFakeClient(self.factory.bus)))
+         proto, tr = self._connect()
+         proto.dataReceived('/machine\r\n{"id":0,"cmd":"login","args":["Ann"]}\r\n{"id":1,"cmd":"rooms"}\r\n')
+         trs.append(tr)
+      self.assertEqual([{"event": "machine", "version": 1}], self._frames(trs[0]))
+      while any([p.pump() for p in pumps]):
+         pass
+      self.assertEqual([{"id": 0, "ok": True, "out": ["Welcome Ann!"]}, {"id": 1, "ok": True, "out": ["No active rooms."]}],
+                       self._frames(trs[0]))
+      return self.assertEqual([{"event": "machine", "version": 1}, {"id": 0, "ok": False, "error": "Sorry, name taken."},
+                               {"id": 1, "ok": False, "error": "log in first"}], self._frames(trs[1]))
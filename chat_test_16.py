@@ -0,0 +1,151 @@
+from chat import ChatFactory, SortedNames, UserIndex
+from chat_cluster import Bus, ClusterFactory, Hub
+from twisted.trial import unittest
+from twisted.test import iosim, proto_helpers
+import random
+
+class UserIndexTestCase(unittest.TestCase):
+   def test_sorted_names(self):
+      #small chunks, so they split and empty out along the way
+      names, kept = SortedNames(), set()
+      names.CHUNK = 4
+      rand = random.Random(16)
+      for i in xrange(2000):
+         name = "user{0}".format(rand.randrange(300))
+         if name in kept:
+            names.remove(name)
+            kept.remove(name)
+         else:
+            names.add(name)
+            kept.add(name)
+         self.assertTrue(all(len(chunk) <= 8 for chunk in names.chunks))
+      self.assertEqual(sorted(kept), list(names.since("")))
+      self.assertEqual([n for n in sorted(kept) if n >= "user2"], list(names.since("user2")))
+      return self.assertEqual([chunk[0] for chunk in names.chunks], names.firsts)
+
+   def test_index(self):
+      users = UserIndex()
+      bob = "".join(["b", "ob"])
+      users["Ann"], users[bob] = 1, 2
+      self.assertEqual((1, 2, None), (users.find("aNN"), users.find("BOB"), users.find("Cat")))
+      self.assertEqual(["ann", "bob"], list(users.names.since("")))
+      self.assertTrue(list(users.names.since("b"))[0] is bob) #already lowercase, so not copied
+      del users["Ann"]
+      self.assertEqual((None, ["bob"]), (users.find("ann"), list(users.names.since(""))))
+      return self.assertEqual({"bob": 2}, users)
+
+   def test_page(self):
+      users = UserIndex()
+      for name in ("Ann", "anna", "Annabel", "bob", "Bobby", "Cat", "dan", "xanax"):
+         users[name] = name
+      page = lambda *args: users.page(*args)[0]
+      self.assertEqual(["Ann", "anna", "Annabel"], page(0, 10, "ann"))
+      self.assertEqual(["Ann", "anna", "Annabel"], page(0, 10, "AN*"))
+      self.assertEqual(["anna", "Annabel"], page(1, 10, "ann"))
+      self.assertEqual((["Ann", "anna"], True), users.page(0, 2, "ann"))
+      self.assertEqual((["Annabel"], False), users.page(2, 2, "ann"))
+      self.assertEqual(["Ann", "anna", "Annabel", "dan", "xanax"], page(0, 10, "*an*"))
+      self.assertEqual(["anna"], page(0, 10, "an?a"))
+      self.assertEqual(["bob", "Bobby"], page(0, 10, "b*b*"))
+      return self.assertEqual([], page(0, 10, "zed"))
+
+class WhoTestCase(unittest.TestCase):
+   def setUp(self):
+      self.factory = ChatFactory(who_page=3)
+
+   def _connect(self, name):
+      proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      proto.dataReceived(name + '\r\n')
+      tr.clear()
+      return proto, tr
+
+   def test_taken(self):
+      a, atr = self._connect("Ann")
+      b, btr = self._connect("aNN!")
+      b.dataReceived('aNN\r\n')
+      self.assertEqual("Sorry, name taken.\r\n", btr.value())
+      a.dataReceived('/quit\r\n')
+      btr.clear()
+      b.dataReceived('aNN\r\n')
+      return self.assertEqual("Welcome aNN!\r\n", btr.value())
+
+   def test_any_case(self):
+      a, atr = self._connect("Ann")
+      b, btr = self._connect("Bob")
+      b.dataReceived('/msg ann hi\r\n/join lobby\r\n/invite ANN\r\n/toggleop aNn\r\n')
+      self.assertTrue('Bob says, "hi"' in atr.value())
+      self.assertTrue("Bob has invited you to join lobby" in atr.value())
+      return self.assertTrue(a.me in self.factory.channels["lobby"].ops)
+
+   def test_who(self):
+      a, atr = self._connect("Ann")
+      for name in ("anna", "Annabel", "Bob", "bot1", "bot2", "Cat"):
+         self._connect(name)
+      a.dataReceived('/who ann\r\n')
+      self.assertEqual("Online are:\r\n* Ann\r\n* anna\r\n* Annabel\r\nend of list.\r\n", atr.value())
+      atr.clear()
+      a.dataReceived('/who\r\n')
+      self.assertTrue(atr.value().endswith("* Annabel\r\nType /who 2 for more.\r\nend of list.\r\n"))
+      atr.clear()
+      a.dataReceived('/who 2\r\n')
+      self.assertEqual("Online are:\r\n* Bob\r\n* bot1\r\n* bot2\r\nType /who 3 for more.\r\nend of list.\r\n", atr.value())
+      atr.clear()
+      a.dataReceived('/who *o?\r\n')
+      self.assertEqual("Online are:\r\n* Bob\r\nend of list.\r\n", atr.value())
+      atr.clear()
+      a.dataReceived('/who xyz\r\n')
+      return self.assertEqual("Nobody matches.\r\n", atr.value())
+
+   def test_in_room(self):
+      a, atr = self._connect("Ann")
+      a.dataReceived('/join lobby\r\n')
+      for i in xrange(5):
+         self._connect("bot{0}".format(i))[0].dataReceived('/join lobby\r\n')
+      self._connect("bot9")
+      c, ctr = self._connect("Cat")
+      c.dataReceived('/join den\r\n/toggleprivate\r\n')
+      atr.clear()
+      a.dataReceived('/who bot in lobby 2\r\n')
+      self.assertEqual("In lobby are:\r\n* bot3\r\n* bot4\r\nend of list.\r\n", atr.value())
+      atr.clear()
+      a.dataReceived('/who in lobby\r\n')
+      self.assertTrue(atr.value().endswith("Type /who in lobby 2 for more.\r\nend of list.\r\n"))
+      atr.clear()
+      a.dataReceived('/who in den\r\n/who in nowhere\r\n')
+      return self.assertEqual("No such room.\r\nNo such room.\r\n", atr.value())
+
+   def test_many(self):
+      #a big room, looked through by way of everyone's names, and a small one, by way of its own
+      for i in xrange(2000):
+         proto = self._connect("user{0}".format(i))[0]
+         if i % 2:
+            proto.dataReceived('/join lobby\r\n')
+         if i % 20 == 0:
+            proto.dataReceived('/join small\r\n')
+      a, atr = self._connect("Ann")
+      a.dataReceived('/who USER19* in lobby\r\n/who user19* in small\r\n/who user19?\r\n')
+      return self.assertEqual("In lobby are:\r\n* user19\r\n* user1901\r\n* user1903\r\nType /who USER19* in lobby 2 "
+                              "for more.\r\nend of list.\r\nIn small are:\r\n* user1900\r\n* user1920\r\n* user1940\r\n"
+                              "Type /who user19* in small 2 for more.\r\nend of list.\r\nOnline are:\r\n* user190\r\n"
+                              "* user191\r\n* user192\r\nType /who user19? 2 for more.\r\nend of list.\r\n", atr.value())
+
+   def test_cluster(self):
+      #two workers asked for Ann and ann at once; the hub lets only one have it
+      hub, pumps, factories = Hub(), [], []
+      for i in xrange(2):
+         factory = ClusterFactory(i)
+         factory.bus = Bus(factory)
+         link = hub.buildProtocol(None)
+         pumps.append(iosim.connect(link, iosim.makeFakeServer(link), factory.bus, iosim.makeFakeClient(factory.bus)))
+         factories.append(factory)
+      protos = [factory.buildProtocol(('127.0.0.1', 0)) for factory in factories]
+      trs = [proto_helpers.StringTransport() for proto in protos]
+      for proto, tr, name in zip(protos, trs, ("Ann", "ann")):
+         proto.makeConnection(tr)
+         proto.dataReceived(name + '\r\n')
+      while any([p.pump() for p in pumps]):
+         pass
+      self.assertTrue("Welcome Ann!" in trs[0].value())
+      return self.assertTrue("Sorry, name taken." in trs[1].value())
@@ -0,0 +1,93 @@
+from chat import ChatFactory
+from chat_events import EventLog
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import error, task
+from twisted.python import failure
+import json
+import os
+
+class EventLogTestCase(unittest.TestCase):
+   def setUp(self):
+      self.path = self.mktemp()
+      self.events = EventLog(self.path, sample=2)
+      self.clock = task.Clock()
+      self.factory = ChatFactory(clock=self.clock, events=self.events)
+
+   def _connect(self, name=None):
+      proto = self.factory.buildProtocol(('127.0.0.1', 4000))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      if name is not None:
+         proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def _lost(self, proto):
+      proto.connectionLost(failure.Failure(error.ConnectionDone()))
+
+   def _read(self, path=None):
+      self.events.start()
+      self.events.stop()
+      with open(path or self.path) as f:
+         return [json.loads(line) for line in f]
+
+   def _fields(self, record, *names):
+      return tuple(record.get(name) for name in names)
+
+   def test_events(self):
+      a, atr = self._connect("Ann")
+      b, btr = self._connect("Bob")
+      a.dataReceived('/join lobby\r\n')
+      b.dataReceived('/join lobby\r\n')
+      for i in xrange(4):
+         a.dataReceived('hi\r\n')
+      a.dataReceived('/quit bye\r\n')
+      self._lost(a)
+      self._lost(b)
+      records = self._read()
+      kinds = [record["event"] for record in records]
+      self.assertEqual(["connect", "login", "command", "connect", "login", "command"], kinds[:6])
+      self.assertEqual(("127.0.0.1:4000", records[1]["conn"]), self._fields(records[0], "peer", "conn"))
+      self.assertEqual([("Ann", "join"), ("Bob", "join"), ("Ann", "quit")],
+                       [self._fields(record, "name", "command") for record in records if record["event"] == "command"
+                        and record["command"] != "LOGIN"])
+      chat = [record for record in records if record["event"] == "chat"]
+      self.assertEqual([("Ann", "lobby", 2)] * 2, [self._fields(record, "name", "room", "sampled") for record in chat])
+      self.assertEqual(3, kinds.count("fanout")) #one in two of the four lines and the parts
+      self.assertEqual([("Ann", "quit: bye"), ("Bob", "ConnectionDone: Connection was closed cleanly.")],
+                       [self._fields(record, "name", "reason") for record in records if record["event"] == "disconnect"])
+      return self.assertEqual((len(records), 0), (self.events.written, self.events.dropped))
+
+   def test_timed_out(self):
+      self.factory.startFactory()
+      self.addCleanup(self.factory.stopFactory)
+      c, ctr = self._connect()
+      self.clock.advance(61)
+      self._lost(c)
+      return self.assertEqual((None, "You took too long to log in."), self._fields(self._read()[-1], "name", "reason"))
+
+   def test_full(self):
+      #nothing is taking them off the ring yet, so the ones that don't fit are dropped
+      self.events.size = 4
+      for i in xrange(6):
+         self.events.add("command", "Ann", "rooms", i)
+      self.assertEqual(2, self.events.dropped)
+      return self.assertEqual(range(4), [record["us"] for record in self._read()])
+
+   def test_log(self):
+      self.events.observe({"message": ("Restored 3 rooms",), "isError": 0, "system": "-", "time": 0})
+      self.events.observe({"message": (), "isError": 0, "system": "-", "time": 0}) #says nothing, so isn't written
+      return self.assertEqual([("log", "Restored 3 rooms")], [self._fields(record, "event", "text") for record in self._read()])
+
+   def test_rotate(self):
+      self.events = EventLog(self.path, rotate_bytes=1000, keep=2)
+      self.events.start()
+      for i in xrange(20):
+         for j in xrange(10):
+            self.events.add("command", "Ann", "rooms", j)
+         self.events.wake.set()
+         while self.events.ring:
+            self.events.wake.wait(0.01)
+      self.events.stop()
+      self.assertTrue(os.path.exists(self.path + ".2"))
+      return self.assertFalse(os.path.exists(self.path + ".3"))
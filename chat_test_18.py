@@ -0,0 +1,97 @@
+from chat import ChatFactory
+from chat_trace import CLOSE, DATA, MAGIC, OPEN, RECORD, START, Recorder, Replay, Sampler, read
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import error, task
+from twisted.python import failure
+from StringIO import StringIO
+
+class TraceTestCase(unittest.TestCase):
+   def setUp(self):
+      self.path = self.mktemp()
+
+   def _write(self, records):
+      with open(self.path, "wb") as f:
+         f.write(MAGIC + START.pack(0) + "".join(RECORD.pack(when, con, kind, len(data)) + data for when, con, kind, data in records))
+
+   def test_record(self):
+      clock = task.Clock()
+      recorder = Recorder(self.path, clock)
+      factory = ChatFactory(clock=clock, recorder=recorder)
+      connections = []
+      for name in ("Ann", "Bob"):
+         proto = factory.buildProtocol(('127.0.0.1', 0))
+         proto.makeConnection(proto_helpers.StringTransport())
+         proto.dataReceived(name + '\r\n/join lobby\r\n')
+         connections.append(proto)
+      connections[0].dataReceived('hi\r\n/qu')
+      connections[0].dataReceived('it\r\n')
+      clock.advance(0)
+      connections[1].connectionLost(failure.Failure(error.ConnectionDone()))
+      factory.stopFactory()
+      records = list(read(self.path))
+      ann, bob = id(connections[0]), id(connections[1])
+      self.assertEqual([(ann, OPEN, ""), (ann, DATA, "Ann\r\n/join lobby\r\n"), (bob, OPEN, ""),
+                        (bob, DATA, "Bob\r\n/join lobby\r\n"), (ann, DATA, "hi\r\n/qu"), (ann, DATA, "it\r\n"),
+                        (bob, CLOSE, "")], [record[1:] for record in records])
+      return self.assertEqual(sorted(record[0] for record in records), [record[0] for record in records])
+
+   def test_append(self):
+      #a server started again with the same file carries on from where the last one left off
+      for data in ("Ann\r\n", "Bob\r\n"):
+         recorder = Recorder(self.path, task.Clock())
+         recorder.received(1, data)
+         recorder.close()
+      records = list(read(self.path))
+      self.assertEqual(["Ann\r\n", "Bob\r\n"], [record[3] for record in records])
+      return self.assertTrue(records[0][0] <= records[1][0])
+
+   def test_replay(self):
+      self._write([(0, 1, OPEN, ""), (0, 1, DATA, "Ann\r\n/join lobby\r\n"), (1, 2, OPEN, ""),
+                   (1, 2, DATA, "Bob\r\n/join lobby\r\nhello\r\n"), (2, 1, DATA, "hi\r\n/join games\r\nso"),
+                   (2, 1, DATA, "lo\r\n"), (3, 2, CLOSE, "")])
+      replay = Replay()
+      replay.run(read(self.path))
+      factory = replay.factory
+      self.assertEqual((["Ann"], ["games", "lobby"]), (factory.users.keys(), sorted(factory.channels)))
+      self.assertEqual((4, 3), (replay.reads, replay.clock.seconds()))
+      self.assertEqual(set(["LOGIN", "join", "CHAT"]), set(factory.stats.totals))
+      self.assertEqual([3, 4], factory.stats.rooms["lobby"][1:]) #Bob's hello and Ann's hi to both, then Bob leaving
+      out = StringIO()
+      replay.report(1.0, out)
+      self.assertTrue("By room, most time first:\n   lobby: 3 writes, 4 lines delivered" in out.getvalue())
+      return self.assertTrue("   CHAT: 3 lines" in out.getvalue())
+
+   def test_timeouts(self):
+      #the clock follows the trace, so someone who didn't log in for a minute is timed out in the replay too
+      self._write([(0, 1, OPEN, ""), (30, 2, OPEN, ""), (30, 2, DATA, "Bob\r\n"), (61, 3, OPEN, ""),
+                   (62, 1, DATA, "Ann\r\n")])
+      replay = Replay(login_timeout=60)
+      replay.run(read(self.path))
+      self.assertEqual(1, replay.factory.login_timeouts)
+      return self.assertEqual(["Bob"], replay.factory.users.keys())
+
+   def test_speed(self):
+      self._write([(0, 1, OPEN, ""), (10, 1, DATA, "Ann\r\n"), (20, 1, CLOSE, "")])
+      slept = []
+      Replay().run(read(self.path), speed=10, sleep=slept.append)
+      return self.assertEqual([1, 2], [round(s) for s in slept]) #sleeping here takes no time, so it has it all to catch up
+
+   def test_cut_short(self):
+      self._write([(0, 1, OPEN, ""), (1, 1, DATA, "Ann\r\n"), (2, 1, DATA, "hello\r\n")])
+      with open(self.path, "r+b") as f:
+         f.truncate(len(MAGIC) + START.size + 2 * RECORD.size + 5 + 3)
+      return self.assertEqual([(0, 1, OPEN, ""), (1, 1, DATA, "Ann\r\n")], list(read(self.path)))
+
+   def test_sampler(self):
+      sampler = Sampler()
+      sampler.start()
+      try:
+         replay = Replay()
+         self._write([(0, i, OPEN, "") for i in xrange(200)] +
+                     [(0, i, DATA, "user{0}\r\n/join lobby\r\nhi\r\n".format(i)) for i in xrange(200)])
+         replay.run(read(self.path))
+      finally:
+         sampler.stop()
+      self.assertTrue(sampler.samples > 0)
+      return self.assertTrue(any("(run)" in where for where in sampler.inclusive))
@@ -0,0 +1,189 @@
+from chat import ChatFactory
+from chat_cluster import ClusterFactory
+from chat_loop import StreamProtocol
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import address, defer, error, task
+from twisted.python import failure
+
+class Port(object):
+   def __init__(self):
+      self.reading = True
+
+   def stopReading(self):
+      self.reading = False
+
+   def startReading(self):
+      self.reading = True
+
+
+class Bus(object):
+   #a hub that's still making up its mind about each name, until told
+   def __init__(self):
+      self.claims = {}
+      self.sent = []
+
+   def claim(self, name):
+      self.claims[name] = defer.Deferred()
+      return self.claims[name]
+
+   def send(self, message):
+      self.sent.append(message)
+
+
+class AdmissionTestCase(unittest.TestCase):
+   def setUp(self):
+      self.clock = task.Clock()
+
+   def _factory(self, **kw):
+      self.factory = ChatFactory(clock=self.clock, **kw)
+      return self.factory
+
+   def _connect(self, host="127.0.0.1", name=None):
+      proto = self.factory.buildProtocol(address.IPv4Address("TCP", host, 4000))
+      if proto is None:
+         return None, None
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      if name is not None:
+         proto.dataReceived(name + '\r\n')
+      return proto, tr
+
+   def _lost(self, proto):
+      proto.connectionLost(failure.Failure(error.ConnectionDone()))
+
+   def test_max_connections(self):
+      self._factory(max_connections=2)
+      a, atr = self._connect()
+      self._connect()
+      self.assertEqual(None, self._connect()[0])
+      self._lost(a)
+      self.assertNotEqual(None, self._connect()[0])
+      return self.assertEqual({"full": 1, "per-ip": 0, "rate": 0}, self.factory.refused)
+
+   def test_per_ip(self):
+      self._factory(max_per_ip=2)
+      a, atr = self._connect("10.0.0.1")
+      b, btr = self._connect("10.0.0.1")
+      self.assertEqual(None, self._connect("10.0.0.1")[0])
+      c, ctr = self._connect("10.0.0.2")
+      self.assertNotEqual(None, c)
+      self._lost(a)
+      d, dtr = self._connect("10.0.0.1")
+      self.assertNotEqual(None, d)
+      for proto in (b, c, d):
+         self._lost(proto)
+      self.assertEqual({}, self.factory.per_ip)
+      return self.assertEqual(1, self.factory.refused["per-ip"])
+
+   def test_loop_addresses(self):
+      #chat_loop hands over (host, port) tuples, and closes what the factory refuses
+      self._factory(max_per_ip=1)
+      trs = [proto_helpers.StringTransport() for i in xrange(2)]
+      for tr in trs:
+         tr.get_extra_info = lambda name: ("10.0.0.1", 4000)
+         tr.abort = tr.loseConnection
+         StreamProtocol(self.factory).connection_made(tr)
+      self.assertEqual((False, True), (trs[0].disconnecting, trs[1].disconnecting))
+      return self.assertEqual({"10.0.0.1": 1}, self.factory.per_ip)
+
+   def test_accept_rate(self):
+      self._factory(accept_rate=2)
+      self.factory.port = port = Port()
+      self._connect()
+      self.assertTrue(port.reading)
+      self._connect()
+      self.assertFalse(port.reading) #the rest wait in the backlog
+      #what the port accepted before it stopped comes in on credit, up to another two
+      self.assertEqual([True, True, False], [self._connect()[0] is not None for i in xrange(3)])
+      self.assertEqual(1, self.factory.refused["rate"])
+      self.clock.advance(1)
+      self.assertFalse(port.reading) #still paying them off
+      self.clock.advance(0.5)
+      self.assertTrue(port.reading)
+      self.assertNotEqual(None, self._connect()[0])
+      return self.assertFalse(port.reading)
+
+   def test_login_queue(self):
+      self._factory(login_rate=1)
+      a, atr = self._connect(name="Ann")
+      b, btr = self._connect(name="Bob")
+      c, ctr = self._connect(name="Cat")
+      b.dataReceived('/join lobby\r\n')
+      self.assertTrue("Welcome Ann!" in atr.value())
+      self.assertEqual(("paused", "paused"), (btr.producerState, ctr.producerState))
+      self.assertEqual(2, self.factory.staged())
+      self.clock.advance(1)
+      self.assertTrue("Welcome Bob!\r\nentering room: lobby" in btr.value())
+      self.assertEqual(("producing", "paused"), (btr.producerState, ctr.producerState))
+      self.assertFalse("Welcome Cat!" in ctr.value())
+      self.clock.advance(1)
+      self.assertTrue("Welcome Cat!" in ctr.value())
+      return self.assertEqual(0, self.factory.staged())
+
+   def test_gone(self):
+      #someone who hangs up while waiting doesn't use up a slot
+      self._factory(login_rate=1)
+      self._connect(name="Ann")
+      b, btr = self._connect(name="Bob")
+      c, ctr = self._connect(name="Cat")
+      self._lost(b)
+      self.clock.advance(1)
+      self.assertTrue("Welcome Cat!" in ctr.value())
+      return self.assertEqual(["Ann", "Cat"], sorted(self.factory.users))
+
+   def test_taken(self):
+      #a login that doesn't work out sends the next try to the back of the queue
+      self._factory(login_rate=1)
+      self._connect(name="Ann")
+      b, btr = self._connect(name="Ann")
+      b.dataReceived('Bob\r\n')
+      c, ctr = self._connect(name="Cat")
+      self.clock.advance(1)
+      self.assertTrue("Sorry, name taken." in btr.value())
+      self.clock.advance(1)
+      self.assertTrue("Welcome Cat!" in ctr.value())
+      self.assertFalse("Welcome Bob!" in btr.value())
+      self.clock.advance(1)
+      return self.assertTrue("Welcome Bob!" in btr.value())
+
+   def test_waiting_isnt_idle(self):
+      #the login timeout doesn't count the time spent waiting for a slot
+      self._factory(login_rate=0.1, login_timeout=2)
+      self.factory.startFactory()
+      self.addCleanup(self.factory.stopFactory)
+      self._connect(name="Ann")
+      b, btr = self._connect(name="Bob")
+      c, ctr = self._connect()
+      self.clock.pump([1] * 9)
+      self.assertTrue(ctr.disconnecting)
+      self.assertFalse(btr.disconnecting)
+      self.clock.pump([1] * 2)
+      self.assertTrue("Welcome Bob!" in btr.value())
+      return self.assertEqual(1, self.factory.login_timeouts)
+
+   def test_stats(self):
+      self._factory(max_connections=1, login_rate=1)
+      self._connect(name="Ann")
+      self._connect()
+      lines = self.factory.stats.report(self.factory)
+      self.assertTrue("Refused connections: 1 when full, 0 over the limit per IP, 0 over the accept rate" in lines)
+      return self.assertTrue('die_refused_connections_total{reason="full"} 1' in
+                             self.factory.stats.exposition(self.factory).split("\n"))
+
+   def test_claiming(self):
+      #in a cluster, the lines after a staged login wait for the hub to hand out the name, as they would unstaged
+      self.factory = ClusterFactory(0, clock=self.clock, login_rate=1)
+      self.factory.bus = bus = Bus()
+      self._connect(name="Ann")
+      b, btr = self._connect()
+      b.dataReceived('Bob\r\n/join lobby\r\nhello\r\n')
+      c, ctr = self._connect(name="Cat")
+      self.clock.advance(1)
+      self.assertEqual(("CLAIMING", ['/join lobby', 'hello']), (b.state, b.claiming))
+      self.assertEqual("producing", btr.producerState)
+      bus.claims["Bob"].callback(True)
+      self.assertTrue("Welcome Bob!\r\nentering room: lobby" in btr.value())
+      self.assertTrue(("chan", "lobby", "Bob: hello") in bus.sent)
+      self.clock.advance(1)
+      return self.assertEqual(["Ann", "Bob", "Cat"], sorted(bus.claims))
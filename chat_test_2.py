@@ -84,3 +84,41 @@ class ChatTestCast2(unittest.TestCase):
       return self.assertTrue(all(['user11: Hi everybody!' in self.trs[u].value() for u in [0, 1, 2, 3, 4, 5, 7, 8, 9, 11]]))
       
    
+      
+   def test_switch(self):
+      self.test_join1()
+      self.connections[0].dataReceived('/join elsewhere\r\n')
+      [u.clear() for u in self.trs]
+      self.connections[1].dataReceived('Where did user0 go?\r\n')
+      self.assertTrue('user1: Where did user0 go?' in self.trs[2].value())
+      self.assertEqual('', self.trs[0].value())
+      self.connections[0].dataReceived('/switch partymansion\r\n')
+      self.assertEqual('', self.trs[0].value())
+      self.connections[1].dataReceived('There you are.\r\n')
+      return self.assertEqual('user1: There you are.\r\n', self.trs[0].value())
+      
+   def test_viewers(self):
+      self.test_join1()
+      room = self.factory.channels['partymansion']
+      self.assertEqual(set(c.me for c in self.connections[:10]), room.viewers)
+      self.connections[0].dataReceived('/join elsewhere\r\n')
+      self.connections[1].dataReceived('/quit\r\n')
+      self.assertEqual(set(c.me for c in self.connections[2:10]), room.viewers)
+      return self.assertEqual(set([self.connections[0].me]), self.factory.channels['elsewhere'].viewers)
+      
+   def test_member_order(self):
+      for i in xrange(3):
+         self._join('user'+str(i), 'partymansion', self.connections[i])
+      self.connections[1].dataReceived('/part\r\n')
+      self.connections[1].dataReceived('/join partymansion\r\n')
+      self.trs[3].clear()
+      self._join('user3', 'partymansion', self.connections[3])
+      return self.assertTrue('* user0\r\n* user2\r\n* user1\r\n* user3 (** this is you)\r\n' in self.trs[3].value())
+      
+   def test_quit_all(self):
+      self._join('A', 'one', self.connections[0])
+      self.connections[0].dataReceived('/join two\r\n/join three\r\n')
+      self.trs[0].clear()
+      self.connections[0].dataReceived('/quit bye\r\n')
+      self.assertEqual(0, len(self.connections[0].me.channels))
+      return self.assertFalse(any(c in self.factory.channels for c in ('one', 'two', 'three'))) #emptied, so gone
@@ -0,0 +1,57 @@
+import json
+import time
+from argparse import Namespace
+
+from chat import Histogram
+from chat_load import LoadClient, Run, STAMP, combine
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+class LoadTestCase(unittest.TestCase):
+   def setUp(self):
+      self.run = Run(Namespace(host="127.0.0.1", port=9399, scenario="churn", room_size=10, grace=1.0), range(4))
+      self.client = LoadClient(self.run, "load0")
+      self.client.makeConnection(proto_helpers.StringTransport())
+
+   def test_combine(self):
+      reports = []
+      for latencies in ([10, 20], [30000]):
+         latency = Histogram()
+         for us in latencies:
+            latency.add(us)
+         #as it comes back from a client process
+         reports.append(json.loads(json.dumps({"latency": {"counts": latency.counts, "max": latency.max}, "clients": 2, "errors": 1, "join_per_sec": 5.0, "p50_us": 7})))
+      total = combine(reports)
+      self.assertEqual(total["clients"], 4)
+      self.assertEqual(total["errors"], 2)
+      self.assertEqual(total["join_per_sec"], 10.0)
+      self.assertNotIn("p50_us", total)
+      self.assertEqual(total["latency"].n, 3)
+      self.assertEqual(total["latency"].max, 30000)
+
+   def test_stamps(self):
+      now = time.time()
+      self.run.window = (now - 1, now + 10)
+      self.client.lineReceived("<load1> {0}{1:.6f}".format(STAMP, now - 0.5))
+      self.client.lineReceived('load1 says "{0}{1:.6f}"'.format(STAMP, now - 0.25))
+      self.client.lineReceived("<load1> no stamp here")
+      self.assertEqual(self.run.received, 2)
+      self.assertEqual(self.run.latency.n, 2)
+      self.assertTrue(self.run.latency.max >= 500000)
+
+   def test_scrollback(self):
+      now = time.time()
+      self.run.window = (now - 10, now + 10)
+      self.client.join("room0")
+      self.client.lineReceived("<load1> {0}{1:.6f}".format(STAMP, now - 5)) #said before we joined
+      self.assertEqual(self.run.received, 0)
+      self.client.lineReceived("<load1> {0}{1:.6f}".format(STAMP, time.time()))
+      self.assertEqual(self.run.received, 1)
+
+   def test_churn_nobody(self):
+      self.run.churn_anyone()
+      self.run.clients[2] = self.client
+      self.run.connect = lambda i: self.fail("reconnected before the quit")
+      self.run.churn_anyone()
+      self.assertEqual(self.run.clients, {})
+      self.assertIn("/quit churn", self.client.transport.value())
@@ -0,0 +1,72 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+class SlowConsumerTestCase(unittest.TestCase):
+   def _setUp(self, **config):
+      self.factory = ChatFactory(**config)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(3)]
+      self.trs = [proto_helpers.StringTransport() for a in self.connections]
+      for i in xrange(len(self.connections)):
+         self.connections[i].makeConnection(self.trs[i])
+         self.connections[i].dataReceived('user{0}\r\n/join slowpoke\r\n'.format(i))
+      [u.clear() for u in self.trs]
+      self.slow = self.connections[0]
+      self.slow.pauseProducing()
+
+   def _chat(self, n):
+      for i in xrange(n):
+         self.connections[1].dataReceived('line {0}\r\n'.format(i))
+
+   def test_registered(self):
+      self._setUp()
+      return self.assertTrue(self.trs[0].producer is self.slow and self.trs[0].streaming)
+
+   def test_paused(self):
+      self._setUp()
+      self._chat(3)
+      self.assertEqual('', self.trs[0].value())
+      self.assertTrue('user1: line 2' in self.trs[2].value())
+      self.slow.resumeProducing()
+      return self.assertEqual('user1: line 0\r\nuser1: line 1\r\nuser1: line 2\r\n', self.trs[0].value())
+
+   def test_drop_oldest(self):
+      self._setUp(queue_messages=3)
+      self._chat(5)
+      self.assertEqual((2, 2), (self.slow.dropped, self.factory.dropped))
+      self.slow.resumeProducing()
+      return self.assertEqual('user1: line 2\r\nuser1: line 3\r\nuser1: line 4\r\n', self.trs[0].value())
+
+   def test_drop_oldest_bytes(self):
+      self._setUp(queue_bytes=len('user1: line 0\r\n') * 2)
+      self._chat(3)
+      self.assertEqual(1, self.slow.dropped)
+      return self.assertEqual(len(self.slow.backlog), 2)
+
+   def test_drop_chatter(self):
+      self._setUp(queue_messages=3, slow_policy="drop-chatter")
+      self._chat(2)
+      self.connections[2].dataReceived('/msg user0 psst\r\n')
+      self._chat(3)
+      self.connections[2].dataReceived('/msg user0 still there?\r\n')
+      self.assertEqual(4, self.slow.dropped)
+      self.slow.resumeProducing()
+      return self.assertEqual('user2 says, "psst"\r\nuser1: line 2\r\nuser2 says, "still there?"\r\n', self.trs[0].value())
+
+   def test_drop_chatter_private_overflow(self):
+      self._setUp(queue_messages=2, slow_policy="drop-chatter")
+      for i in xrange(3):
+         self.connections[2].dataReceived('/msg user0 {0}\r\n'.format(i))
+      return self.assertTrue(self.trs[0].disconnected)
+
+   def test_disconnect(self):
+      self._setUp(queue_messages=2, slow_policy="disconnect")
+      self._chat(2)
+      self.assertFalse(self.trs[0].disconnected)
+      self._chat(5)
+      self.assertTrue(self.trs[0].disconnected)
+      self.assertEqual(1, self.factory.slow_disconnects)
+      return self.assertEqual(3, self.slow.dropped)
+
+   def test_bad_policy(self):
+      return self.assertRaises(ValueError, ChatFactory, slow_policy="ignore")
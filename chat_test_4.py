@@ -0,0 +1,146 @@
+from chat_cluster import Bus, ClusterFactory, Hub
+from twisted.trial import unittest
+from twisted.test import iosim, proto_helpers
+from twisted.internet import task
+
+class ClusterTestCase(unittest.TestCase):
+   #two workers wired to a hub in memory; _pump moves everything that is waiting between them
+   def setUp(self):
+      self.hub = Hub()
+      self.pumps = []
+      self.factories = [self._worker(i) for i in xrange(2)]
+
+   def _worker(self, i, **config):
+      factory = ClusterFactory(i, **config)
+      factory.bus = Bus(factory)
+      link = self.hub.buildProtocol(None)
+      self.pumps.append(iosim.connect(link, iosim.makeFakeServer(link), factory.bus, iosim.makeFakeClient(factory.bus)))
+      return factory
+
+   def _pump(self):
+      while any([p.pump() for p in self.pumps]):
+         pass
+
+   def _connect(self, worker, name):
+      proto = self.factories[worker].buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      proto.dataReceived(name + '\r\n')
+      self._pump()
+      return proto, tr
+
+   def _send(self, proto, line):
+      proto.dataReceived(line + '\r\n')
+      self._pump()
+
+   def test_login(self):
+      a, atr = self._connect(0, "Ann")
+      self.assertTrue("Welcome Ann!" in atr.value())
+      return self.assertTrue("Ann" in self.factories[1].users)
+
+   def test_name_taken(self):
+      self._connect(0, "Ann")
+      b, btr = self._connect(1, "Ann")
+      self.assertTrue("Sorry, name taken." in btr.value())
+      return self.assertEqual("LOGIN", b.state)
+
+   def test_coalesced_login(self):
+      #the greeting waiting to be coalesced isn't mistaken for a line they sent while the hub considered their name
+      clock = task.Clock()
+      self.factories[0] = self._worker(0, coalesce=True, clock=clock)
+      a, atr = self._connect(0, "Ann")
+      clock.advance(1)
+      self.assertTrue("Welcome Ann!" in atr.value())
+      self.assertFalse("Try joining a room" in atr.value())
+      return self.assertEqual("NEW TEXACO", a.state)
+
+   def test_lines_while_claiming(self):
+      proto = self.factories[0].buildProtocol(('127.0.0.1', 0))
+      tr = proto_helpers.StringTransport()
+      proto.makeConnection(tr)
+      proto.dataReceived('Ann\r\n/join lobby\r\n')
+      self._pump()
+      return self.assertTrue("Welcome Ann!\r\nentering room: lobby" in tr.value())
+
+   def test_chat(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      btr.clear()
+      self._send(b, "/join lobby")
+      self.assertTrue("* Ann\r\n* Bob (** this is you)" in btr.value())
+      btr.clear()
+      self._send(a, "Hi Bob")
+      self.assertEqual("Ann: Hi Bob\r\n", btr.value())
+      atr.clear()
+      self._send(b, "/part later")
+      self.assertTrue('User Bob has left ("later")' in atr.value())
+      return self.assertEqual(1, len(self.factories[0].channels["lobby"].users))
+
+   def test_chan_routing(self):
+      a, atr = self._connect(0, "Ann")
+      self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      return self.assertEqual([self.factories[0].worker_id], [l.worker for l in self.hub.members["lobby"]])
+
+   def test_msg(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      btr.clear()
+      self._send(a, "/msg Bob psst")
+      return self.assertEqual('Ann says, "psst"\r\n', btr.value())
+
+   def test_ops(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      self._send(b, "/join lobby")
+      btr.clear()
+      self._send(a, "/toggleop Bob")
+      self.assertTrue("You have been given op status for lobby" in btr.value())
+      self._send(b, "/topic remote control")
+      self.assertEqual("remote control", self.factories[0].channels["lobby"].topic)
+      self._send(b, "/toggleprivate")
+      self.assertEqual(0, len(self.factories[0].directory))
+      return self.assertTrue(self.factories[0].channels["lobby"].private)
+
+   def test_protect_invite(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      self._send(a, "/protect")
+      self._send(b, "/join lobby")
+      self.assertTrue("This room is protected" in btr.value())
+      self._send(a, "/invite Bob")
+      btr.clear()
+      self._send(b, "/join lobby")
+      return self.assertTrue("* Bob (** this is you)" in btr.value())
+
+   def test_logout(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      self._send(b, "/join lobby")
+      b.connectionLost(None)
+      self._pump()
+      self.assertFalse("Bob" in self.factories[0].users)
+      self.assertEqual(["Ann"], [u.name for u in self.factories[0].channels["lobby"].users])
+      return self.assertFalse("Bob" in self.hub.names)
+
+   def test_worker_lost(self):
+      self._connect(1, "Bob")
+      self.hub.detach(self.pumps[1].server)
+      self._pump()
+      self.assertFalse("Bob" in self.factories[0].users)
+      return self.assertFalse("Bob" in self.hub.names)
+
+   def test_reap(self):
+      a, atr = self._connect(0, "Ann")
+      b, btr = self._connect(1, "Bob")
+      self._send(a, "/join lobby")
+      self._send(b, "/join lobby")
+      self._send(a, "/part")
+      self.assertTrue("lobby" in self.factories[1].channels)
+      b.connectionLost(None)
+      self._pump()
+      return self.assertEqual([{}, {}], [f.channels for f in self.factories])
@@ -0,0 +1,72 @@
+from chat import ChatFactory, Histogram
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+class StatsTestCase(unittest.TestCase):
+   def setUp(self):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(operator_password="sekrit", clock=self.clock)
+      self.proto = self.factory.buildProtocol(('127.0.0.1', 0))
+      self.tr = proto_helpers.StringTransport()
+      self.proto.makeConnection(self.tr)
+      self.proto.dataReceived("Boss\r\n")
+      self.tr.clear()
+
+   def test_histogram(self):
+      h = Histogram()
+      for i in xrange(1, 1001):
+         h.add(i)
+      self.assertEqual(1000, h.n)
+      self.assertEqual(1000, h.max)
+      self.assertTrue(500 <= h.percentile(50) < 500 * 1.25)
+      self.assertTrue(990 <= h.percentile(99) <= 1000)
+      return self.assertEqual(1, h.percentile(0.1))
+
+   def test_stats_denied(self):
+      self.proto.dataReceived("/stats\r\n")
+      return self.assertEqual("You aren't qualified to do that. Operators only.\r\n", self.tr.value())
+
+   def test_oper_wrong(self):
+      self.proto.dataReceived("/oper guess\r\n")
+      self.assertEqual("Wrong password.\r\n", self.tr.value())
+      return self.assertFalse(self.proto.me.operator)
+
+   def test_oper_nobody(self):
+      self.factory.operator_password = None
+      self.proto.dataReceived("/oper\r\n")
+      return self.assertFalse(self.proto.me.operator)
+
+   def test_stats(self):
+      self.proto.dataReceived("/oper sekrit\r\n/join counting\r\nhello\r\n")
+      self.tr.clear()
+      self.proto.dataReceived("/stats\r\n")
+      report = self.tr.value()
+      self.assertTrue("Connections: 1, logged in: 1, rooms: 1\r\n" in report)
+      self.assertTrue("Room writes: 1," in report)
+      self.assertTrue("/join: 1 (" in report)
+      return self.assertTrue("Busiest connection: Boss" in report)
+
+   def test_counters(self):
+      before = self.proto.bytes_out
+      self.proto.dataReceived("/join counting\r\nhello\r\n")
+      stats = self.factory.stats
+      self.assertEqual(3, stats.all_lines().n)
+      self.assertEqual(1, stats.lines["CHAT"].n)
+      self.assertEqual(1, stats.fanout_size.max)
+      self.assertEqual(self.proto.bytes_out, stats.bytes_out(self.factory))
+      return self.assertEqual(len(self.tr.value()), self.proto.bytes_out - before)
+
+   def test_lag(self):
+      self.factory.startFactory()
+      self.clock.advance(0.1)
+      self.clock.advance(0.35) #the reactor was busy for a quarter of a second
+      self.factory.stopFactory()
+      self.assertEqual(2, self.factory.stats.lag.n)
+      return self.assertTrue(249000 <= self.factory.stats.lag.max)
+
+   def test_exposition(self):
+      self.proto.dataReceived("/join counting\r\n")
+      text = self.factory.stats.exposition(self.factory)
+      self.assertTrue("die_users 1\n" in text)
+      return self.assertTrue('die_line_microseconds_count{kind="join"} 1\n' in text)
@@ -0,0 +1,134 @@
+from chat import ChatFactory, parse_since
+from chat_history import History, RoomLog
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from time import mktime
+import os
+
+class HistoryTestCase(unittest.TestCase):
+   def _setUp(self, **config):
+      self.factory = ChatFactory(**config)
+      self.addCleanup(self.factory.stopFactory)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(2)]
+      self.trs = [proto_helpers.StringTransport() for a in self.connections]
+      for i in xrange(2):
+         self.connections[i].makeConnection(self.trs[i])
+         self.connections[i].dataReceived('user{0}\r\n'.format(i))
+      self.connections[0].dataReceived('/join lobby\r\n')
+      for i in xrange(5):
+         self.connections[0].dataReceived('line {0}\r\n'.format(i))
+      [t.clear() for t in self.trs]
+
+   def test_replay(self):
+      self._setUp(scrollback=3)
+      self.connections[1].dataReceived('/join lobby\r\n')
+      return self.assertTrue(self.trs[1].value().endswith("end of list\r\nuser0: line 2\r\nuser0: line 3\r\nuser0: line 4\r\n"))
+
+   def test_no_scrollback(self):
+      self._setUp(scrollback=0)
+      self.connections[0].dataReceived('/history\r\n')
+      self.assertEqual("No history is kept for lobby.\r\n", self.trs[0].value())
+      self.connections[1].dataReceived('/join lobby\r\n')
+      return self.assertTrue(self.trs[1].value().endswith("end of list\r\n"))
+
+   def test_history_pages(self):
+      self._setUp()
+      self.connections[0].dataReceived('/history 2\r\n')
+      page = self.trs[0].value()
+      self.assertTrue("] user0: line 3\r\n[" in page)
+      self.assertTrue(page.endswith("] user0: line 4\r\nType /history more for more.\r\n"))
+      self.trs[0].clear()
+      self.connections[0].dataReceived('/history more\r\n/history more\r\n/history more\r\n')
+      pages = self.trs[0].value()
+      self.assertTrue("user0: line 1\r\n" in pages and "user0: line 0\r\n" in pages)
+      return self.assertTrue(pages.endswith("] user0: line 0\r\nNo more history.\r\n"))
+
+   def test_history_since(self):
+      self._setUp(history_page=3)
+      self.connections[0].dataReceived('/history since 1h\r\n')
+      self.assertTrue("user0: line 0" in self.trs[0].value() and "user0: line 3" not in self.trs[0].value())
+      self.trs[0].clear()
+      self.connections[0].dataReceived('/history more\r\n')
+      self.assertTrue(self.trs[0].value().endswith("] user0: line 4\r\n"))
+      self.trs[0].clear()
+      self.connections[0].dataReceived('/history since whenever\r\n')
+      return self.assertTrue(self.trs[0].value().startswith("Since when?"))
+
+   def test_parse_since(self):
+      now = mktime((2014, 6, 1, 15, 0, 0, 0, 0, -1))
+      self.assertEqual(now - 600, parse_since("10m", now))
+      self.assertEqual(now - 1800, parse_since("14:30", now))
+      self.assertEqual(now - 1800, parse_since("2014-06-01T14:30", now))
+      return self.assertEqual(None, parse_since("yesterday", now))
+
+   def test_on_disk(self):
+      self._setUp(history=History(self.mktemp()))
+      self.connections[0].dataReceived('/history 3\r\n')
+      def check(ignored):
+         self.assertTrue("] user0: line 2\r\n" in self.trs[0].value())
+         self.assertTrue("] user0: line 4\r\nType /history more" in self.trs[0].value())
+      #the reply comes from the history thread, behind the lines it was written after
+      d = self.factory.channels["lobby"].log.last(1)
+      return d.addCallback(check)
+
+   def test_open_logs(self):
+      #only the most recently used rooms keep their files mapped; the others are opened again when they're wanted
+      history = History(self.mktemp(), segment_size=1 << 16, open_logs=2)
+      self.addCleanup(history.close)
+      history._write([(room, 1000.0, "hello " + room) for room in ("a", "b", "c")])
+      self.assertEqual(["b", "c"], history.logs.keys())
+      self.assertEqual([(0, 1000.0, "hello a")], history._query("a", "last", (5,)))
+      return self.assertEqual(["c", "a"], history.logs.keys())
+
+   def test_dots(self):
+      #rooms called . and .. get directories of their own, not the history directory or the one above it
+      parent = self.mktemp()
+      os.makedirs(parent)
+      history = History(os.path.join(parent, "history"))
+      self._setUp(history=history)
+      self.connections[1].dataReceived('/join ..\r\nup\r\n/join .\r\nhere\r\n')
+      def check(lines):
+         self.assertEqual("user1: here", lines[0][2])
+         self.assertEqual(["history"], os.listdir(parent))
+         self.assertEqual(["%2E", "%2E%2E", "lobby"], sorted(os.listdir(history.directory)))
+      return self.factory.channels["."].log.last(1).addCallback(check)
+
+class RoomLogTestCase(unittest.TestCase):
+   def setUp(self):
+      self.path = self.mktemp()
+      self.log = RoomLog(self.path, 1 << 16, keep=3)
+
+   def _fill(self, n, start=0):
+      for i in xrange(start, start + n):
+         self.log.append(1000.0 + i, "line {0}".format(i))
+
+   def test_segments(self):
+      self._fill(5000) #2048 lines to a segment of this size
+      self.assertEqual([0, 2048, 4096], self.log.firsts)
+      self.assertEqual(5000, self.log.next())
+      lines = self.log.last(3000, before=4100)
+      self.assertEqual((1100, 2100.0, "line 1100"), lines[0])
+      return self.assertEqual((4099, 5099.0, "line 4099"), lines[-1])
+
+   def test_since(self):
+      self._fill(5000)
+      self.assertEqual([(3000, 4000.0, "line 3000"), (3001, 4001.0, "line 3001")], self.log.since(4000.0, 2))
+      self.assertEqual([(4096, 5096.0, "line 4096")], self.log.since(None, 1, after=4095))
+      return self.assertEqual([], self.log.since(9000.0, 5))
+
+   def test_keep(self):
+      self._fill(9000)
+      self.assertEqual([4096, 6144, 8192], self.log.firsts)
+      self.assertEqual(4096, self.log.last(10000)[0][0])
+      return self.assertEqual(4096, self.log.since(0, 1)[0][0])
+
+   def test_reopen(self):
+      self._fill(3000)
+      self.log.close()
+      self.log = RoomLog(self.path, 1 << 16, keep=3)
+      self._fill(10, 3000)
+      self.assertEqual(3010, self.log.next())
+      return self.assertEqual([(2999, 3999.0, "line 2999"), (3000, 4000.0, "line 3000")], self.log.last(2, before=3001))
+
+   def tearDown(self):
+      self.log.close()
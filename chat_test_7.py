@@ -0,0 +1,48 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+class DirectoryTestCase(unittest.TestCase):
+   def setUp(self):
+      self.factory = ChatFactory(rooms_page=3)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(4)]
+      self.trs = [proto_helpers.StringTransport() for a in self.connections]
+      for i in xrange(4):
+         self.connections[i].makeConnection(self.trs[i])
+         self.connections[i].dataReceived('user{0}\r\n'.format(i))
+      #lobby has 4 members, games 3, chat 2, chatter, music and news 1 each
+      for room, members in (("lobby", 4), ("games", 3), ("chat", 2), ("chatter", 1), ("music", 1), ("news", 1)):
+         for i in xrange(members):
+            self.connections[i].dataReceived('/join {0}\r\n'.format(room))
+      [t.clear() for t in self.trs]
+
+   def _rooms(self, query=""):
+      self.trs[0].clear()
+      self.connections[0].dataReceived('/rooms {0}\r\n'.format(query))
+      return self.trs[0].value()
+
+   def test_pages(self):
+      self.assertEqual("Active rooms are:\r\n* chat (2)\r\n* chatter (1)\r\n* games (3)\r\nType /rooms 2 for more.\r\nend of list.\r\n", self._rooms())
+      self.assertEqual("Active rooms are:\r\n* lobby (4)\r\n* music (1)\r\n* news (1)\r\nend of list.\r\n", self._rooms("2"))
+      return self.assertEqual("No rooms match.\r\n", self._rooms("3"))
+
+   def test_by_size(self):
+      self.assertEqual("Active rooms are:\r\n* lobby (4)\r\n* games (3)\r\n* chat (2)\r\nType /rooms size 2 for more.\r\nend of list.\r\n", self._rooms("size"))
+      return self.assertTrue(self._rooms("size 2").startswith("Active rooms are:\r\n* chatter (1)\r\n* music (1)\r\n* news (1)\r\n"))
+
+   def test_search(self):
+      self.assertEqual("Active rooms are:\r\n* chat (2)\r\n* chatter (1)\r\nend of list.\r\n", self._rooms("chat*"))
+      self.assertEqual("Active rooms are:\r\n* chatter (1)\r\n* games (3)\r\n* news (1)\r\nend of list.\r\n", self._rooms("e"))
+      return self.assertEqual("Active rooms are:\r\n* games (3)\r\n* chatter (1)\r\n* news (1)\r\nend of list.\r\n", self._rooms("size e"))
+
+   def test_counts(self):
+      self.connections[3].dataReceived('/quit\r\n')
+      self.connections[2].dataReceived('/part\r\n') #from games, the last room user2 joined
+      self.assertTrue("* lobby (3)\r\n* chat (2)\r\n* games (2)\r\n" in self._rooms("size"))
+      return self.assertEqual([(1, 3), (2, 2), (3, 1)], sorted((size, len(names)) for size, names in self.factory.directory.by_size.items()))
+
+   def test_private(self):
+      self.connections[0].dataReceived('/switch lobby\r\n/toggleprivate\r\n')
+      self.assertEqual("Active rooms are:\r\n* games (3)\r\n* chat (2)\r\n* chatter (1)\r\nType /rooms size 2 for more.\r\nend of list.\r\n", self._rooms("size"))
+      self.connections[0].dataReceived('/toggleprivate\r\n')
+      return self.assertTrue("* lobby (4)" in self._rooms("size"))
@@ -0,0 +1,81 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+class CountingTransport(proto_helpers.StringTransport):
+   writes = 0
+
+   def write(self, data):
+      self.writes += 1
+      proto_helpers.StringTransport.write(self, data)
+
+   def writeSequence(self, seq):
+      self.writes += 1
+      proto_helpers.StringTransport.write(self, "".join(seq))
+
+class CoalesceTestCase(unittest.TestCase):
+   def _setUp(self, **config):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(coalesce=True, clock=self.clock, **config)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(2)]
+      self.trs = [CountingTransport() for a in self.connections]
+      for i in xrange(2):
+         self.connections[i].makeConnection(self.trs[i])
+         self.connections[i].dataReceived('user{0}\r\n/join lobby\r\n'.format(i))
+      self.clock.advance(1)
+      for t in self.trs:
+         t.clear()
+         t.writes = 0
+
+   def _say(self, message):
+      #from outside dataReceived, e.g. a line relayed by the hub
+      self.factory.channels["lobby"].chat(self.connections[0].me, message)
+
+   def test_one_write(self):
+      self._setUp()
+      self.connections[0].dataReceived('/join games\r\none\r\ntwo\r\n')
+      self.assertEqual(1, self.trs[0].writes)
+      return self.assertTrue(self.trs[0].value().endswith("end of list\r\nuser0: one\r\nuser0: two\r\n"))
+
+   def test_turn(self):
+      self._setUp()
+      self._say("one")
+      self._say("two")
+      self.assertEqual('', self.trs[1].value())
+      self.clock.advance(0)
+      self.assertEqual('user0: one\r\nuser0: two\r\n', self.trs[1].value())
+      return self.assertEqual(1, self.trs[1].writes)
+
+   def test_delay(self):
+      self._setUp(coalesce_delay=0.5)
+      self.connections[0].dataReceived('one\r\n')
+      self.clock.advance(0.4)
+      self.connections[0].dataReceived('two\r\n')
+      self.assertEqual('', self.trs[1].value())
+      self.clock.advance(0.1)
+      self.assertEqual('user0: one\r\nuser0: two\r\n', self.trs[1].value())
+      return self.assertEqual(1, self.trs[1].writes)
+
+   def test_bytes(self):
+      self._setUp(coalesce_bytes=20)
+      self._say("one")
+      self.assertEqual('', self.trs[1].value())
+      self._say("two")
+      return self.assertEqual('user0: one\r\nuser0: two\r\n', self.trs[1].value())
+
+   def test_pause(self):
+      self._setUp()
+      self._say("one")
+      self.connections[1].pauseProducing()
+      self._say("two")
+      self.assertEqual('user0: one\r\n', self.trs[1].value())
+      self.connections[1].resumeProducing()
+      self.clock.advance(0)
+      return self.assertEqual('user0: one\r\nuser0: two\r\n', self.trs[1].value())
+
+   def test_quit(self):
+      self._setUp()
+      self.connections[0].dataReceived('/quit\r\n')
+      self.assertTrue(self.trs[0].value().endswith("BYE\r\n"))
+      return self.assertTrue(self.trs[0].disconnecting)
@@ -0,0 +1,63 @@
+from chat import ChatFactory
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+class FloodTestCase(unittest.TestCase):
+   def _setUp(self, limits, **config):
+      self.clock = task.Clock()
+      self.factory = ChatFactory(limits=limits, clock=self.clock, **config)
+      self.connections = [self.factory.buildProtocol(('127.0.0.1', 0)) for i in xrange(2)]
+      self.trs = [proto_helpers.StringTransport() for a in self.connections]
+      for i in xrange(2):
+         self.connections[i].makeConnection(self.trs[i])
+         self.connections[i].dataReceived('user{0}\r\n/join lobby\r\n'.format(i))
+      self.clock.advance(60) #for the buckets to fill up again after the joins
+      [t.clear() for t in self.trs]
+
+   def test_chat(self):
+      self._setUp({"chat": (1, 2)})
+      self.connections[0].dataReceived('one\r\ntwo\r\nthree\r\nfour\r\n')
+      self.assertEqual('user0: one\r\nuser0: two\r\n', self.trs[1].value())
+      self.assertEqual('paused', self.trs[0].producerState)
+      self.clock.advance(1)
+      self.assertTrue(self.trs[1].value().endswith('user0: three\r\n'))
+      self.clock.advance(1)
+      self.assertTrue(self.trs[1].value().endswith('user0: four\r\n'))
+      return self.assertEqual('producing', self.trs[0].producerState)
+
+   def test_order(self):
+      self._setUp({"chat": (1, 1)})
+      self.connections[0].dataReceived('one\r\ntwo\r\n/part bye\r\n')
+      self.assertEqual('user0: one\r\n', self.trs[1].value())
+      self.clock.advance(1)
+      return self.assertEqual('user0: one\r\nuser0: two\r\nUser user0 has left ("bye")\r\n', self.trs[1].value())
+
+   def test_dropped(self):
+      self._setUp({"line": (1, 2)}, flood_queue=2)
+      self.connections[0].dataReceived(''.join('line {0}\r\n'.format(i) for i in xrange(6)))
+      self.assertEqual(2, self.factory.flood_dropped)
+      self.assertEqual(1, self.trs[0].value().count("You are sending too fast"))
+      self.clock.advance(2)
+      return self.assertTrue(self.trs[1].value().endswith('user0: line 2\r\nuser0: line 3\r\n'))
+
+   def test_command(self):
+      self._setUp({"join": (1, 1)})
+      self.connections[0].dataReceived('/join games\r\n/join music\r\n')
+      self.assertFalse("music" in self.factory.channels)
+      self.clock.advance(1)
+      return self.assertTrue("music" in self.factory.channels)
+
+   def test_room(self):
+      self._setUp({"room": (1, 1)})
+      self.connections[0].dataReceived('one\r\n')
+      self.connections[1].dataReceived('two\r\n')
+      self.assertEqual('user0: one\r\n', self.trs[1].value())
+      self.clock.advance(1)
+      return self.assertEqual('user0: one\r\nuser1: two\r\n', self.trs[1].value())
+
+   def test_lost(self):
+      self._setUp({"chat": (1, 1)})
+      self.connections[0].dataReceived('one\r\ntwo\r\n')
+      self.connections[0].connectionLost(None)
+      return self.assertEqual([], self.clock.getDelayedCalls())
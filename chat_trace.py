@@ -0,0 +1,276 @@
+"""Traffic traces: a recording of everything clients sent the server, and a profiler that plays one back.
+
+Run the server with `--record FILE` and every connection opening, every read and every close is appended to FILE as
+(seconds since recording started, connection, kind, bytes read). Like chat_history, the file is only touched from a
+thread of its own: what arrives in one reactor turn goes over in one batch. A server started again with the same FILE,
+or one taking over with --take-over, carries on where the last one left off, with times from the same start; each
+batch goes in with a single write to the end of the file, so the old process's last batches and the new one's first
+don't overwrite each other.
+
+`python chat_trace.py FILE [--speed N] [--profile cprofile|sample] [server options]` plays a trace back into an
+in-process ChatFactory, made with the same options the server takes (e.g. --flood-control), over StringTransports. The
+factory's clock is a task.Clock moved along with the trace, so timeouts and flood control see the times they saw when
+it was recorded, and a replay comes out the same every time. Without --speed it goes as fast as it can; --speed 1 keeps
+to the recorded pace and --speed 10 goes ten times as fast. Afterwards it prints where the time went, by command and
+by room written to, and optionally a profile of the whole replay: cProfile's, or one that samples the stack every
+millisecond of CPU time, which costs less on a long trace."""
+import os
+import struct
+import sys
+import time
+from collections import defaultdict
+
+from twisted.internet import error, reactor, task
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+from twisted.test import proto_helpers
+
+import chat
+
+MAGIC = "DIE trace 1\n"
+START = struct.Struct("<d") #after MAGIC: when recording started, which the times in the records count from
+RECORD = struct.Struct("<dQBI") #when, connection, kind, how many bytes follow
+OPEN, DATA, CLOSE = range(3)
+
+
+class Recorder(object):
+   def __init__(self, path, clock=reactor):
+      self.clock = clock
+      self.pending = []
+      self.flushing = None
+      self.file = open(path, "ab", 0) #unbuffered, so a batch is one write
+      if os.fstat(self.file.fileno()).st_size == 0:
+         self.start = time.time()
+         self.file.write(MAGIC + START.pack(self.start))
+      else:
+         self.start = header(path)
+      self.pool = ThreadPool(1, 1, "trace")
+      self.pool.start()
+
+   def opened(self, con):
+      self.add(con, OPEN, "")
+
+   def received(self, con, data):
+      self.add(con, DATA, data)
+
+   def closed(self, con):
+      self.add(con, CLOSE, "")
+
+   def add(self, con, kind, data):
+      self.pending.append((time.time() - self.start, id(con), kind, data))
+      if self.flushing is None:
+         self.flushing = self.clock.callLater(0, self.flush)
+
+   def flush(self):
+      if self.flushing is not None:
+         if self.flushing.active():
+            self.flushing.cancel()
+         self.flushing = None
+      if self.pending:
+         self.pool.callInThread(self._write, self.pending)
+         self.pending = []
+
+   def close(self):
+      self.flush()
+      self.pool.stop()
+      self.file.close()
+
+   def _write(self, batch):
+      #in the trace thread
+      self.file.write("".join([RECORD.pack(when, con, kind, len(data)) + data for when, con, kind, data in batch]))
+
+
+def header(path):
+   #when the trace at path started
+   with open(path, "rb") as f:
+      return _header(f, path)
+
+def _header(f, path):
+   data = f.read(len(MAGIC) + START.size)
+   if data[:len(MAGIC)] != MAGIC or len(data) < len(MAGIC) + START.size:
+      raise ValueError("{0} isn't a trace".format(path))
+   return START.unpack_from(data, len(MAGIC))[0]
+
+def read(path):
+   #the (when, connection, kind, data)s in a trace, as far as it got if the server stopped in the middle of a write
+   with open(path, "rb") as f:
+      _header(f, path)
+      while True:
+         header = f.read(RECORD.size)
+         if len(header) < RECORD.size:
+            return
+         when, con, kind, size = RECORD.unpack(header)
+         data = f.read(size)
+         if len(data) < size:
+            return
+         yield when, con, kind, data
+
+
+class ReplayStats(chat.Stats):
+   #Stats that also add up the time spent on each kind of line and on writing to each room, for the hot spots
+   def __init__(self):
+      chat.Stats.__init__(self)
+      self.totals = defaultdict(int)
+      self.rooms = defaultdict(lambda: [0, 0, 0]) #name -> time, writes, lines delivered
+
+   def line(self, kind, elapsed):
+      chat.Stats.line(self, kind, elapsed)
+      self.totals[kind] += elapsed
+
+
+class TimedWrites(object):
+   #mixed into the factory's channel class, to count each room's writes in its ReplayStats
+   __slots__ = ()
+
+   def write(self, message):
+      start = time.time()
+      super(TimedWrites, self).write(message)
+      room = self.stats.rooms[self.name]
+      room[0] += int((time.time() - start) * 1e6)
+      room[1] += 1
+      room[2] += len(self.viewers)
+
+
+class Replay(object):
+   def __init__(self, **options):
+      #options are ChatFactory's, bar the clock
+      self.clock = task.Clock()
+      self.factory = chat.ChatFactory(clock=self.clock, **options)
+      self.factory.stats = ReplayStats()
+      self.factory.channel = type("Timed" + self.factory.channel.__name__, (TimedWrites, self.factory.channel),
+                                  {"__slots__": ()})
+      self.factory.doStart()
+      self.connections = {} #recorded connection -> (ChatProtocol, StringTransport)
+      self.reads = self.bytes = 0
+
+   def run(self, records, speed=None, sleep=time.sleep):
+      start = time.time()
+      for when, con, kind, data in records:
+         if speed:
+            ahead = when / speed - (time.time() - start)
+            if ahead > 0:
+               sleep(ahead)
+         if when > self.clock.seconds():
+            self.clock.advance(when - self.clock.seconds())
+         self.play(con, kind, data)
+      return time.time() - start
+
+   def play(self, con, kind, data):
+      if kind == OPEN:
+         self.close(con)
+         proto = self.factory.buildProtocol(("127.0.0.1", 0))
+         if proto is None: #refused by admission control
+            return
+         tr = proto_helpers.StringTransport()
+         proto.makeConnection(tr)
+         self.connections[con] = proto, tr
+      elif con in self.connections:
+         proto, tr = self.connections[con]
+         if kind == DATA:
+            self.reads += 1
+            self.bytes += len(data)
+            proto.dataReceived(data)
+            tr.clear()
+         else:
+            self.close(con)
+
+   def close(self, con):
+      if con in self.connections:
+         proto, tr = self.connections.pop(con)
+         proto.connectionLost(failure.Failure(error.ConnectionDone()))
+
+   def report(self, elapsed, out=sys.stdout, top=15):
+      stats = self.factory.stats
+      out.write("{0} reads, {1} bytes in {2:.3f}s ({3:.3f}s recorded)\n".format(self.reads, self.bytes, elapsed,
+                                                                            self.clock.seconds()))
+      out.write("By kind of line, most time first:\n")
+      for kind in sorted(stats.totals, key=stats.totals.get, reverse=True)[:top]:
+         h = stats.lines[kind]
+         out.write("   {0}: {1} lines, {2}us in all ({3})\n".format(kind, h.n, stats.totals[kind], h.summary("us")))
+      out.write("Room writes: {0}, viewers per write: {1}\n".format(stats.fanout_size.n, stats.fanout_size.summary()))
+      out.write("By room, most time first:\n")
+      for name, (us, writes, delivered) in sorted(stats.rooms.items(), key=lambda item: item[1][0], reverse=True)[:top]:
+         out.write("   {0}: {1} writes, {2} lines delivered, {3}us in all\n".format(name, writes, delivered, us))
+
+
+class Sampler(object):
+   #A sampling profiler: every interval seconds of CPU time, SIGPROF, and a count for the function running and for
+   #each function it was called from.
+   def __init__(self, interval=0.001):
+      self.interval = interval
+      self.own = defaultdict(int)
+      self.inclusive = defaultdict(int)
+      self.samples = 0
+
+   def start(self):
+      import signal
+      signal.signal(signal.SIGPROF, self.sample)
+      signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+   def stop(self):
+      import signal
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+   def sample(self, signum, frame):
+      self.samples += 1
+      self.own[self.where(frame)] += 1
+      seen = set()
+      while frame is not None:
+         where = self.where(frame)
+         if where not in seen: #count recursion once
+            seen.add(where)
+            self.inclusive[where] += 1
+         frame = frame.f_back
+
+   def where(self, frame):
+      code = frame.f_code
+      return "{0}:{1}({2})".format(code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno, code.co_name)
+
+   def report(self, out=sys.stdout, top=25):
+      out.write("{0} samples; own time, then including what they called:\n".format(self.samples))
+      for counts in (self.own, self.inclusive):
+         for where in sorted(counts, key=counts.get, reverse=True)[:top]:
+            out.write("   {0:5.1f}% {1}\n".format(100.0 * counts[where] / max(1, self.samples), where))
+
+
+def options():
+   from argparse import ArgumentParser
+   parser = ArgumentParser(description="Play a trace recorded with chat.py --record back into an in-process server.",
+                           epilog="Any other options are the server's, as for chat.py.")
+   parser.add_argument("trace")
+   parser.add_argument("--speed", type=float, help="times the recorded pace; as fast as possible without it")
+   parser.add_argument("--profile", choices=("cprofile", "sample"), help="profile the replay, as well")
+   parser.add_argument("--top", type=int, default=15, help="how many of each kind of hot spot to print")
+   return parser
+
+def main(argv):
+   args, rest = options().parse_known_args(argv[1:])
+   server = chat.options().parse_args(rest)
+   server.events = None
+   replay = Replay(**chat.factory_config(server))
+   records = read(args.trace)
+   if args.profile == "cprofile":
+      import cProfile
+      import pstats
+      profile = cProfile.Profile()
+      elapsed = profile.runcall(replay.run, records, args.speed)
+   elif args.profile == "sample":
+      profile = Sampler()
+      profile.start()
+      try:
+         elapsed = replay.run(records, args.speed)
+      finally:
+         profile.stop()
+   else:
+      elapsed = replay.run(records, args.speed)
+   replay.factory.doStop()
+   replay.report(elapsed, top=args.top)
+   if args.profile == "cprofile":
+      pstats.Stats(profile).sort_stats("cumulative").print_stats(args.top)
+   elif args.profile == "sample":
+      profile.report(top=args.top)
+   return 0
+
+if __name__ == "__main__":
+   sys.exit(main(sys.argv))